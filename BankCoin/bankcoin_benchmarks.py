@@ -0,0 +1,89 @@
+import sys
+import benchmarks as bench
+from bankcoin import Bank, Tx, TxIn, TxOut
+from ecdsa import SigningKey, SECP256k1
+
+UTXO_SET_SIZES = {"10k": 10_000, "100k": 100_000, "1m": 1_000_000}
+
+alice_private_key = SigningKey.from_secret_exponent(1, curve=SECP256k1)
+alice_public_key = alice_private_key.get_verifying_key()
+
+bob_private_key = SigningKey.from_secret_exponent(2, curve=SECP256k1)
+bob_public_key = bob_private_key.get_verifying_key()
+
+###########
+# Helpers #
+###########
+
+
+def spend(coin, private_key, public_key):
+    # The whole coin, straight back to its owner
+    tx_id = f"spend-{coin.id}"
+    tx = Tx(
+        id=tx_id,
+        tx_ins=[TxIn(tx_id=coin.id, index=0)],
+        tx_outs=[TxOut(tx_id=tx_id, index=0, amount=1000, public_key=public_key)],
+    )
+    tx.sign_input(0, private_key)
+    return tx
+
+
+def make_txns(count):
+    bank = Bank()
+    coins = [bank.issue(1000, alice_public_key) for _ in range(count)]
+    return bank, [spend(coin, alice_private_key, alice_public_key) for coin in coins]
+
+
+##############
+# Benchmarks #
+##############
+
+
+def bench_validate_tx(count=100):
+    bank, (tx,) = make_txns(1)
+    seconds = bench.measure(lambda: [bank.validate_tx(tx) for _ in range(count)])
+    return bench.result("validate-tx", seconds, count, "txns")
+
+
+def bench_handle_tx(count=100):
+    def run(state):
+        bank, txns = state
+        for tx in txns:
+            bank.handle_tx(tx)
+
+    seconds = bench.measure(run, setup=lambda: make_txns(count))
+    return bench.result("handle-tx", seconds, count, "txns")
+
+
+def bench_fetch_balance():
+    results = []
+    for label, size in UTXO_SET_SIZES.items():
+        bank = Bank()
+        public_keys = [alice_public_key, bob_public_key]
+        for index in range(size):
+            tx_out = TxOut(index, 0, 1, public_keys[index % 2])
+            bank.utxo[tx_out.outpoint] = tx_out
+
+        seconds = bench.measure(lambda: bank.fetch_balance(alice_public_key))
+        results.append(bench.result(f"fetch-balance-{label}", seconds, size, "utxos"))
+    return results
+
+
+def bench_spend_message(count=10_000):
+    _, (tx,) = make_txns(1)
+    tx_in = tx.tx_ins[0]
+    seconds = bench.measure(lambda: [tx_in.spend_message for _ in range(count)])
+    return bench.result("spend-message", seconds, count, "messages")
+
+
+# The bank settles transactions one by one, there are no blocks
+BENCHMARKS = {
+    "validate-tx": bench_validate_tx,
+    "handle-tx": bench_handle_tx,
+    "fetch-balance": bench_fetch_balance,
+    "spend-message": bench_spend_message,
+}
+
+
+if __name__ == "__main__":
+    sys.exit(bench.main(BENCHMARKS))
@@ -6,14 +6,32 @@ Usage:
   bitcoin.py ping [--node <node>]
   bitcoin.py tx <from> <to> <amount> [--node <node>]
   bitcoin.py balance <name> [--node <node>]
+  bitcoin.py memory [--node <node>]
+  bitcoin.py stats [--node <node>]
+  bitcoin.py export <file> [--node <node>]
+  bitcoin.py import <file> [--node <node>]
+  bitcoin.py worker [--node <node>] [--port <port>]
+  bitcoin.py profile (start|stop) [--seconds <seconds>] [--node <node>]
+  bitcoin.py memtrace (start|stop) [--seconds <seconds>] [--node <node>]
+  bitcoin.py replay <file> [--realtime]
 
 Options:
-  -h --help      Show this screen.
-  --node=<node>  Hostname of node [default: node0]
+  -h --help            Show this screen.
+  --node=<node>        Hostname of node [default: node0]
+  --port=<port>        Port workers listen for new work on [default: 10100]
+  --seconds=<seconds>  Stop profiling or tracing after this long [default: 30]
+  --realtime           Replay messages as far apart as they were recorded
 """
 
-import uuid, socketserver, socket, time, os, logging, threading, random, re
+import collections, uuid, socketserver, time, os, logging, threading, itertools, functools
+import logs
+import metrics
 import models as m
+import pipeline as p
+import pool
+import profiling
+import recording
+import tracing
 import utils as u
 
 from docopt import docopt
@@ -22,23 +40,60 @@ from ecdsa import SigningKey, SECP256k1
 # In next iteration import these constants as environment variables
 PORT = 10000
 node = None
+pipeline = None
+work_pool = None
+hooks = None
 lock = threading.Lock()
-mining_interrupt = threading.Event()
 
 SATOSHIS_PER_COIN = 100_000_000
 GET_BLOCKS_CHUNK = 10
+IBD_TIMEOUT_IN_SECS = 30
+EXPORT_CHUNK = 100
 HALVENING_INTERVAL = 60 * 24  # daily (assuming 1 minute blocks)
 
+# Commands handled below, each timed under its own metric
+COMMANDS = [
+    "balance",
+    "block-txns",
+    "blocks",
+    "compact-block",
+    "connect",
+    "connect-response",
+    "get-block",
+    "get-block-txns",
+    "get-blocks",
+    "getwork",
+    "import-blocks",
+    "memory",
+    "peers",
+    "peers-response",
+    "ping",
+    "register-worker",
+    "stats",
+    "submit",
+    "sync",
+    "sync-pruned",
+    "sync-response",
+    "tx",
+    "utxos",
+]
+
 INITIAL_DIFFICULTY_BITS = 17
+
+# Found with mine_genesis_block, paying alice
+GENESIS_NONCE = 137759
+GENESIS_ID = "00000cf29281ea466c64ae5b6860f019175abd1af417bd1d981612611033d7a5"
 BLOCK_TIME_IN_SECS = 1
 BLOCKS_PER_DIFFICULTY_PERIOD = 5
 DIFFICULTY_PERIOD_IN_SECS = BLOCK_TIME_IN_SECS * BLOCKS_PER_DIFFICULTY_PERIOD
 
-logging.basicConfig(level="INFO", format="%(threadName)-6s | %(message)s")
+logs.setup()
 logger = logging.getLogger(__name__)
 
 
-def prepare_simple_tx(utxos, sender_private_key, recipient_public_key, amount, fee):
+def prepare_simple_tx(
+    utxos, sender_private_key, recipient_public_key, amount, fee, tx_id=None
+):
     sender_public_key = sender_private_key.get_verifying_key()
 
     # Construct tx.tx_outs
@@ -54,7 +109,8 @@ def prepare_simple_tx(utxos, sender_private_key, recipient_public_key, amount, f
     assert tx_in_sum >= amount + fee
 
     # Construct tx.tx_outs
-    tx_id = uuid.uuid4()
+    if tx_id is None:
+        tx_id = uuid.uuid4()
     change = tx_in_sum - (amount + fee)
     tx_outs = [
         m.TxOut(tx_id=tx_id, index=0, amount=amount, public_key=recipient_public_key),
@@ -90,49 +146,63 @@ def prepare_coinbase(public_key, block_subsidy, tx_id=None):
 
 def mine_block(block):
     while block.proof >= block.target:
-        if mining_interrupt.is_set():
-            logger.info("Mining interrupted")
-            mining_interrupt.clear()
-            return
         block.nonce += 1
     return block
 
 
-def mine_forever(public_key):
+def prepare_block_template(node, public_key):
+    block_subsidy = node.get_block_subsidy()
+    fees = node.calculate_fees(node.mempool)
+    coinbase = prepare_coinbase(public_key, block_subsidy + fees)
+    return m.Block(
+        txns=[coinbase] + node.mempool,
+        prev_id=node.blocks[-1].id,
+        nonce=0,
+        bits=node.get_next_bits(node.blocks[-1].id),
+        timestamp=time.time(),
+    )
+
+
+def mine_forever():
     logging.info("Starting miner")
     while True:
-        block_subsidy = node.get_block_subsidy()
-        fees = node.calculate_fees(node.mempool)
-        coinbase = prepare_coinbase(public_key, block_subsidy + fees)
-        unmined_block = m.Block(
-            txns=[coinbase] + node.mempool,
-            prev_id=node.blocks[-1].id,
-            nonce=random.randint(0, 1000000000),
-            bits=node.get_next_bits(node.blocks[-1].id),
-            timestamp=time.time(),
-        )
-        mined_block = mine_block(unmined_block)
-
-        if mined_block:
-            logger.info("")
-            logger.info("Mined a block")
-            with lock:
-                node.handle_block(mined_block)
+        # Mine alongside the external workers, moving on when the template changes
+        work = work_pool.getwork()
+        start = time.perf_counter()
+        for nonce in pool.mine_work(work, lambda: not work_pool.is_current(work)):
+            work_pool.submit(work.version, nonce)
+        node.metrics.incr("mining_hashes", work.hashes)
+        node.metrics.incr("mining_seconds", time.perf_counter() - start)
 
 
-def mine_genesis_block(node, public_key):
+def prepare_genesis_block(node, public_key, nonce=0):
     coinbase = prepare_coinbase(public_key, node.get_block_subsidy(), tx_id="abc123")
-    unmined_block = m.Block(
+    return m.Block(
         txns=[coinbase],
         prev_id=None,
-        nonce=0,
+        nonce=nonce,
         bits=INITIAL_DIFFICULTY_BITS,
         timestamp=1698667908.5560372,
     )
-    mined_block = mine_block(unmined_block)
-    node.blocks.append(mined_block)
-    node.connect_tx(coinbase)
-    return mined_block
+
+
+def connect_genesis_block(node, block):
+    node.connect_block(block)
+    node.publish_view()
+    return block
+
+
+def mine_genesis_block(node, public_key):
+    return connect_genesis_block(
+        node, mine_block(prepare_genesis_block(node, public_key))
+    )
+
+
+def load_genesis_block(node):
+    # Checking the known nonce takes one hash instead of mining it again
+    block = prepare_genesis_block(node, lookup_public_key("alice"), GENESIS_NONCE)
+    assert block.id == GENESIS_ID, "Genesis block doesn't match GENESIS_ID"
+    return connect_genesis_block(node, block)
 
 
 ##############
@@ -140,15 +210,17 @@ def mine_genesis_block(node, public_key):
 ##############
 
 
+def command_metric(command):
+    # Clients pick the command, so anything else shares one histogram
+    if command not in COMMANDS:
+        return "command_unknown_time"
+    return f"command_{command}_time"
+
+
 class TCPHandler(socketserver.BaseRequestHandler):
     def get_canonical_peer_address(self):
         ip = self.client_address[0]
-        try:
-            hostname = socket.gethostbyaddr(ip)
-            hostname = re.search(r"_(.*?)_", hostname[0]).group(1)
-        except:
-            hostname = ip
-        return (hostname, PORT)
+        return node.peer_directory.lookup(ip, PORT)
 
     def respond(self, command, data):
         response = u.prepare_message(command, data)
@@ -157,7 +229,14 @@ class TCPHandler(socketserver.BaseRequestHandler):
     def handle(self):
         message = u.read_message(self.request)
         command = message["command"]
-        data = message["data"]
+        node.recorder.record(command, message["data"])
+        with node.metrics.timer(command_metric(command)):
+            self.handle_command(command, message["data"])
+
+    def handle_command(self, command, data):
+        # Peers announce their canonical address during the handshake
+        if command in ["connect", "connect-response"] and data:
+            node.peer_directory.announce(self.client_address[0], data)
 
         peer = self.get_canonical_peer_address()
 
@@ -166,13 +245,16 @@ class TCPHandler(socketserver.BaseRequestHandler):
             if peer not in node.pending_peers and peer not in node.peers:
                 node.pending_peers.append(peer)
                 logger.info(f'(handshake) Accepted "connect" request from "{peer[0]}"')
-                u.send_message(peer, "connect-response", None)
+                u.send_message(peer, "connect-response", node.address)
         elif command == "connect-response":
             if peer in node.pending_peers and peer not in node.peers:
                 node.pending_peers.remove(peer)
                 node.peers.append(peer)
                 logger.info(f'(handshake) Connected to "{peer[0]}"')
-                u.send_message(peer, "connect-response", None)
+                u.send_message(peer, "connect-response", node.address)
+
+                # Initial block download starts with each new peer
+                node.sync(peers=[peer])
 
                 # Request their peers
                 u.send_message(peer, "peers", None)
@@ -189,42 +271,128 @@ class TCPHandler(socketserver.BaseRequestHandler):
             self.respond(command="pong", data="")
 
         if command == "sync":
-            # Find our most recent block peer doesn't know about,
-            # But which build off a block they do know about.
-            peer_block_ids = data
-            for block in node.blocks[::-1]:
-                if block.id not in peer_block_ids and block.prev_id in peer_block_ids:
-                    height = node.blocks.index(block)
-                    blocks = node.blocks[height : height + GET_BLOCKS_CHUNK]
-                    u.send_message(peer, "blocks", blocks)
-                    logger.info('Served "sync" request')
-                    return
-
+            blocks = node.view.find_sync_blocks(data)
+            if blocks and blocks[0].txns is None:
+                # Let them know to ask an archive node instead
+                u.send_message(peer, "sync-pruned", node.pruned_height)
+                logger.info('Could not serve "sync" request, blocks pruned')
+                return
+            if blocks:
+                u.send_message(peer, "sync-response", blocks)
+                logger.info('Served "sync" request')
+                return
+
+            # Nothing newer, an empty chunk tells them they caught up
+            u.send_message(peer, "sync-response", [])
             logger.info('Could not serve "sync" request')
 
-        if command == "blocks":
-            for block in data:
-                try:
-                    with lock:
-                        node.handle_block(block)
-                    mining_interrupt.set()
-                except:
-                    logger.info("Rejected block")
+        if command == "sync-pruned":
+            logger.info("%s pruned blocks up to height %s", peer[0], data)
+            node.sync_done(peer)
+
+        if command == "sync-response":
+            pipeline.submit(data)
 
+            # Request the next chunk while this one is being validated
             if len(data) == GET_BLOCKS_CHUNK:
-                node.sync()
+                node.sync(data, peers=[peer])
+            else:
+                node.sync_done(peer)
+
+        if command == "blocks":
+            pipeline.submit(data)
+
+        if command == "compact-block":
+            if node.find_block(data.block_id):
+                return
+            node.tracer.receive(data.block_id, data.trace)
+            node.tracer.record(data.block_id, "received")
+            try:
+                block, missing = node.reconstruct_block(data)
+            except:
+                logger.info("Compact block reconstruction failed")
+                u.send_message(peer, "get-block", data.block_id)
+                return
+
+            if block:
+                node.tracer.record(block.id, "decoded")
+                pipeline.submit([block])
+            else:
+                logger.info("Requesting %d missing block transactions", len(missing))
+                u.send_message(peer, "get-block-txns", (data.block_id, missing))
+
+        if command == "get-block-txns":
+            block_id, indexes = data
+            block = node.find_block(block_id)
+            if block and block.txns is not None:
+                txns = node.fetch_block_txns(block_id, indexes)
+                u.send_message(peer, "block-txns", (block_id, txns))
+
+        if command == "block-txns":
+            block_id, txns = data
+            try:
+                block = node.fill_block(block_id, txns)
+            except:
+                logger.info("Compact block reconstruction failed")
+                u.send_message(peer, "get-block", block_id)
+                return
+            node.tracer.record(block.id, "decoded")
+            pipeline.submit([block])
+
+        if command == "get-block":
+            block = node.find_block(data)
+            if block and block.txns is not None:
+                u.send_message(peer, "blocks", [block])
 
         if command == "tx":
-            node.handle_tx(data)
+            with lock:
+                node.handle_tx(data)
 
+        # Reads are served from the latest published view, without the lock
         if command == "balance":
-            balance = node.fetch_balance(data)
+            balance = node.view.fetch_balance(data)
             self.respond(command="balance-response", data=balance)
 
         if command == "utxos":
-            utxos = node.fetch_utxos(data)
+            utxos = node.view.fetch_utxos(data)
             self.respond(command="utxos-response", data=utxos)
 
+        if command == "get-blocks":
+            blocks = node.view.fetch_blocks(data, EXPORT_CHUNK)
+            self.respond(command="get-blocks-response", data=blocks)
+
+        if command == "import-blocks":
+            # Answers once the chunk is through, slowing the importer down
+            results = p.Results()
+            pipeline.submit(data, results)
+            self.respond(command="import-blocks-response", data=results.wait())
+
+        if command == "getwork":
+            self.respond(command="work", data=work_pool.getwork())
+
+        if command == "register-worker":
+            # Workers tell us which port to push new templates to
+            work_pool.register((self.client_address[0], data))
+            self.respond(command="work", data=work_pool.getwork())
+
+        if command == "submit":
+            version, nonce = data
+            self.respond(
+                command="submit-response", data=work_pool.submit(version, nonce)
+            )
+
+        if command == "stats":
+            self.respond(command="stats-response", data=node.stats())
+
+        if command == "memory":
+            self.respond(command="memory-response", data=node.view.memory_by_depth())
+
+        # Profile or trace memory for a window, then dump to a file
+        if command in ["profile", "memtrace"]:
+            self.respond(
+                command=f"{command}-response", data=hooks.handle(command, data)
+            )
+
 
 def external_address(node):
     i = int(node[-1])
@@ -256,39 +424,76 @@ def main(args):
     if args["serve"]:
         threading.current_thread().name = "main"
         name = os.environ["NAME"]
+        started = time.perf_counter()
+
+        global node, pipeline, work_pool, hooks, lock
+        prune_depth = os.environ.get("PRUNE_DEPTH")
+        prune_depth = int(prune_depth) if prune_depth else None
+        assume_valid = os.environ.get("ASSUME_VALID") or None
+        assume_valid_height = os.environ.get("ASSUME_VALID_HEIGHT")
+        assume_valid_height = int(assume_valid_height) if assume_valid else None
+        node = m.Node(
+            address=(name, PORT),
+            prune_depth=prune_depth,
+            assume_valid=assume_valid,
+            assume_valid_height=assume_valid_height,
+        )
+        lock = metrics.TimedLock(node.metrics)
+        hooks = profiling.Hooks(name)
 
-        duration = 10 * ["node0", "node1", "node2"].index(name)
-        time.sleep(duration)
+        # Appends propagation timestamps of traced blocks, see tracing.py
+        node.tracer = tracing.TraceLog(name, os.environ.get("TRACE_LOG"))
 
-        global node
-        node = m.Node(address=(name, PORT))
+        # Records inbound messages for the replay command
+        node.recorder = recording.Recorder(os.environ.get("RECORD"))
 
         # Alice is Satoshi!
-        mine_genesis_block(node, lookup_public_key("alice"))
+        load_genesis_block(node)
+
+        # Miners get a fresh template when the tip changes, and new
+        # transactions every TEMPLATE_REFRESH_SECS
+        prepare_template = functools.partial(
+            prepare_block_template, node, lookup_public_key(name)
+        )
+        refresh_interval = os.environ.get("TEMPLATE_REFRESH_SECS")
+        refresh_interval = float(refresh_interval or pool.TEMPLATE_REFRESH_IN_SECS)
+        work_pool = pool.WorkPool(
+            node, lock, prepare_template, refresh_interval=refresh_interval
+        )
+        threading.Thread(
+            target=work_pool.refresh_forever, name="templates", daemon=True
+        ).start()
+        pipeline = p.BlockPipeline(node, lock, on_connected=work_pool.update)
 
         # Start server thread
         server_thread = threading.Thread(target=serve, name="server")
         server_thread.start()
 
-        # Join the network
+        # Join the network, retrying peers which aren't up yet
         peers = [(p, PORT) for p in os.environ["PEERS"].split(",")]
+        peers = [peer for peer in peers if peer != node.address]
         for peer in peers:
-            node.connect(peer)
-
-        # Wait for peer connections
-        time.sleep(1)
-
-        # Do initial block download
-        node.sync()
-
-        # Wait for IBD to finish
-        time.sleep(1)
+            threading.Thread(
+                target=node.connect_with_retry,
+                args=[peer],
+                name=f"connect-{peer[0]}",
+                daemon=True,
+            ).start()
+
+        # Wait until a peer says we caught up and those blocks are connected
+        if peers and not node.synced.wait(IBD_TIMEOUT_IN_SECS):
+            logger.info("Initial block download timed out")
+        pipeline.join()
+
+        # Caught up without the assumed-valid block, verify what we skipped
+        with lock:
+            node.check_assume_valid()
+        ready = time.perf_counter() - started
+        node.metrics.observe("startup_ready_time", ready)
+        logger.info("Ready after %.2fs", ready)
 
         # Start miner thread
-        miner_public_key = lookup_public_key(name)
-        miner_thread = threading.Thread(
-            target=mine_forever, args=[miner_public_key], name="miner"
-        )
+        miner_thread = threading.Thread(target=mine_forever, name="miner")
         miner_thread.start()
 
     elif args["ping"]:
@@ -299,6 +504,73 @@ def main(args):
         address = external_address(args["--node"])
         response = u.send_message(address, "balance", public_key, response=True)
         print(response["data"])
+    elif args["memory"]:
+        address = external_address(args["--node"])
+        response = u.send_message(address, "memory", None, response=True)
+        for depth, entry in response["data"].items():
+            print(
+                f"depth {depth:>6}: {entry['blocks']} blocks "
+                f"({entry['pruned']} pruned) {entry['bytes']} bytes"
+            )
+    elif args["stats"]:
+        address = external_address(args["--node"])
+        stats = u.send_message(address, "stats", None, response=True)["data"]
+        snapshot = stats.pop("metrics")
+        for name, value in stats.items():
+            print(f"{name:<32} {value}")
+        for name, value in sorted(snapshot["counters"].items()):
+            print(f"{name:<32} {value}")
+        for name, summary in sorted(snapshot["histograms"].items()):
+            print(f"{name:<32} {summary['count']} (mean {summary['mean']:.6f})")
+    elif args["export"]:
+        address = external_address(args["--node"])
+        with open(args["<file>"], "wb") as f:
+            height = 0
+            while True:
+                response = u.send_message(address, "get-blocks", height, response=True)
+                blocks = response["data"]
+                if not blocks:
+                    break
+                if any(block.txns is None for block in blocks):
+                    print(f"Node pruned blocks below height {height + len(blocks)}")
+                    break
+                u.write_blocks(f, blocks)
+                height += len(blocks)
+        print(f"Exported {height} blocks")
+    elif args["import"]:
+        address = external_address(args["--node"])
+        counts = collections.Counter()
+        with open(args["<file>"], "rb") as f:
+            blocks = u.read_blocks(f)
+            while True:
+                chunk = list(itertools.islice(blocks, EXPORT_CHUNK))
+                if not chunk:
+                    break
+                response = u.send_message(
+                    address, "import-blocks", chunk, response=True
+                )
+                counts.update(response["data"])
+        print(f"Imported {counts['accepted']} blocks, rejected {counts['rejected']}")
+    elif args["profile"] or args["memtrace"]:
+        command = "profile" if args["profile"] else "memtrace"
+        action = "start" if args["start"] else "stop"
+        data = (action, float(args["--seconds"]))
+        address = external_address(args["--node"])
+        print(u.send_message(address, command, data, response=True)["data"])
+    elif args["replay"]:
+        # A fresh node, fed straight from the recording
+        replay_node = m.Node(address=None)
+        load_genesis_block(replay_node)
+        with open(args["<file>"], "rb") as f:
+            messages = u.read_items(f)
+            results = recording.replay(replay_node, messages, args["--realtime"])
+        for name, value in results.items():
+            if isinstance(value, float):
+                value = f"{value:.4f}"
+            print(f"{name:<18} {value}")
+    elif args["worker"]:
+        address = external_address(args["--node"])
+        pool.Worker(address, int(args["--port"])).run()
     elif args["tx"]:
         # Grab parameters
         sender_private_key = lookup_private_key(args["<from>"])
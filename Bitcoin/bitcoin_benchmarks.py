@@ -0,0 +1,415 @@
+import itertools, logging, logging.handlers, os, queue, socket, socketserver, subprocess, sys, tempfile, threading, time
+import benchmarks as bench
+import bitcoin as b
+import logs
+import models as m
+import pipeline as p
+import utils as u
+
+GENESIS_BITS = 2
+
+UTXO_SET_SIZES = {"10k": 10_000, "100k": 100_000, "1m": 1_000_000}
+
+alice_private_key = b.lookup_private_key("alice")
+alice_public_key = alice_private_key.get_verifying_key()
+
+bob_private_key = b.lookup_private_key("bob")
+bob_public_key = bob_private_key.get_verifying_key()
+
+
+###########
+# Helpers #
+###########
+
+
+def make_node():
+    node = m.Node(address="")
+    coinbase = b.prepare_coinbase(
+        alice_private_key.get_verifying_key(), node.get_block_subsidy(), "abc123"
+    )
+    genesis = m.Block(
+        txns=[coinbase],
+        prev_id=None,
+        nonce=0,
+        bits=GENESIS_BITS,
+        timestamp=1698667908.5560372,
+    )
+    b.connect_genesis_block(node, b.mine_block(genesis))
+    return node
+
+
+def next_block(node, private_key, with_tx=True):
+    prev_block = node.blocks[-1]
+    public_key = private_key.get_verifying_key()
+
+    # Spend our biggest coin back to ourselves
+    txns = []
+    utxos = sorted(node.fetch_utxos(public_key), key=lambda tx_out: tx_out.amount)
+    if with_tx and utxos:
+        txns.append(b.prepare_simple_tx(utxos[-1:], private_key, public_key, 1, 100))
+
+    fees = node.calculate_fees(txns)
+    coinbase = b.prepare_coinbase(public_key, node.get_block_subsidy() + fees)
+
+    # Slow blocks down whenever difficulty climbs, so mining stays cheap
+    spacing = 1 if prev_block.bits <= GENESIS_BITS else 2
+    block = m.Block(
+        txns=[coinbase] + txns,
+        prev_id=prev_block.id,
+        nonce=0,
+        bits=node.get_next_bits(prev_block.id),
+        timestamp=prev_block.timestamp + spacing * b.BLOCK_TIME_IN_SECS,
+    )
+    return b.mine_block(block)
+
+
+def extend(node, private_key, length):
+    for _ in range(length):
+        node.handle_block(next_block(node, private_key))
+
+
+def fork(node, private_key, depth, invalid_tip=False):
+    # Grow a competing chain off node's chain on a second node
+    other = make_node()
+    for block in node.blocks[1:]:
+        other.handle_block(block)
+    extend(other, private_key, depth - 1)
+    tip = next_block(other, private_key)
+    if invalid_tip:
+        # Changing the amount after signing invalidates the transaction
+        tip.txns[1].tx_outs[0].amount += 1
+        tip = b.mine_block(tip)
+    return other.blocks[len(node.blocks) :] + [tip]
+
+
+def serve_sync(source):
+    # Answers "sync" requests like a peer would, over a local socket
+    class Handler(socketserver.BaseRequestHandler):
+        def handle(self):
+            message = u.read_message(self.request)
+            blocks = source.view.find_sync_blocks(message["data"]) or []
+            self.request.sendall(u.prepare_message("sync-response", blocks))
+
+    server = socketserver.TCPServer(("localhost", 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def timed(func, *args):
+    start = time.perf_counter()
+    func(*args)
+    return time.perf_counter() - start
+
+
+##############
+# Benchmarks #
+##############
+
+
+def bench_validate_tx(count=100):
+    node = make_node()
+    utxos = node.fetch_utxos(alice_public_key)
+    tx = b.prepare_simple_tx(utxos, alice_private_key, bob_public_key, 10, 100)
+
+    # Without a cache every validation verifies the signature
+    node.sig_cache = m.SignatureCache(maxsize=0)
+    seconds = bench.measure(lambda: [node.validate_tx(tx) for _ in range(count)])
+    return bench.result("validate-tx", seconds, count, "txns")
+
+
+def bench_handle_block(length=20):
+    source = make_node()
+    extend(source, alice_private_key, length)
+    blocks = source.blocks[1:]
+
+    def run(node):
+        for block in blocks:
+            node.handle_block(block)
+
+    seconds = bench.measure(run, setup=make_node)
+    return bench.result("handle-block", seconds, length, "blocks")
+
+
+def bench_fetch_balance():
+    results = []
+    for label, size in UTXO_SET_SIZES.items():
+        node = make_node()
+        public_keys = [alice_public_key, bob_public_key]
+        for index in range(size):
+            tx_out = m.TxOut(index, 0, 1, public_keys[index % 2])
+            node.utxo_set[tx_out.outpoint] = tx_out
+
+        seconds = bench.measure(lambda: node.fetch_balance(bob_public_key))
+        results.append(bench.result(f"fetch-balance-{label}", seconds, size, "utxos"))
+    return results
+
+
+def bench_publish_view(count=100):
+    results = []
+    for label, size in UTXO_SET_SIZES.items():
+        node = make_node()
+        for index in range(size):
+            tx_out = m.TxOut(index, 0, 1, alice_public_key)
+            node.utxo_set[tx_out.outpoint] = tx_out
+        node.publish_view()
+
+        def run():
+            # A few outputs change between views, like after a block
+            for index in range(count):
+                for outpoint in [(index, 0), (index + count, 0)]:
+                    node.utxo_set[outpoint] = node.utxo_set[outpoint]
+                node.publish_view()
+
+        seconds = bench.measure(run)
+        results.append(bench.result(f"publish-view-{label}", seconds, count, "views"))
+    return results
+
+
+def bench_spend_message(count=10_000):
+    node = make_node()
+    tx = next_block(node, alice_private_key).txns[1]
+    seconds = bench.measure(lambda: [u.spend_message(tx, 0) for _ in range(count)])
+    return bench.result("spend-message", seconds, count, "messages")
+
+
+def bench_serialize(count=100, length=20):
+    node = make_node()
+    extend(node, alice_private_key, length)
+    blocks = node.blocks
+    serialized = [u.serialize(block) for block in blocks]
+
+    serialize = bench.measure(
+        lambda: [u.serialize(block) for _ in range(count) for block in blocks]
+    )
+    deserialize = bench.measure(
+        lambda: [u.deserialize(data) for _ in range(count) for data in serialized]
+    )
+    count *= len(blocks)
+    return [
+        bench.result("serialize", serialize, count, "blocks"),
+        bench.result("deserialize", deserialize, count, "blocks"),
+    ]
+
+
+def bench_mine_block(hashes=5_000):
+    block = next_block(make_node(), alice_private_key)
+
+    def run():
+        # Keep finding the next valid nonce, every nonce tried is a hash
+        block.nonce = 0
+        while block.nonce < hashes:
+            b.mine_block(block)
+            block.nonce += 1
+
+    seconds = bench.measure(run)
+    return bench.result("mine-block", seconds, hashes, "hashes")
+
+
+def race(node, branch):
+    # Both chains grow side by side, the branch pulls ahead on its last block
+    for block in branch[:-1]:
+        node.handle_block(next_block(node, alice_private_key))
+        node.handle_block(block)
+
+
+def bench_reorg(depth=50):
+    node = make_node()
+    extend(node, alice_private_key, 2)
+    branch = fork(node, bob_private_key, depth + 1)
+    race(node, branch)
+
+    tip = node.blocks[-1]
+    seconds = timed(node.handle_block, branch[-1])
+    assert node.blocks[-1] == branch[-1] and tip in node.branches[0]
+
+    return {"name": f"reorg-{depth}", "seconds": seconds}
+
+
+def bench_failed_reorg(depth=50):
+    node = make_node()
+    extend(node, alice_private_key, 2)
+    branch = fork(node, bob_private_key, depth + 1, invalid_tip=True)
+    race(node, branch)
+
+    tip = node.blocks[-1]
+    utxo_set = dict(node.utxo_set)
+    seconds = timed(node.handle_block, branch[-1])
+    assert node.blocks[-1] == tip and node.utxo_set == utxo_set
+
+    return {"name": f"failed-reorg-{depth}", "seconds": seconds}
+
+
+def bench_sync(length=200):
+    source = make_node()
+    extend(source, alice_private_key, length)
+    server = serve_sync(source)
+
+    node = make_node()
+    blocks = p.BlockPipeline(node, threading.Lock())
+
+    def sync():
+        # Ask for the next chunk as soon as one arrives, like the node does
+        block_ids = [node.blocks[-1].id]
+        while True:
+            response = u.send_message(server.server_address, "sync", block_ids, True)
+            chunk = response["data"]
+            blocks.submit(chunk)
+            if len(chunk) < b.GET_BLOCKS_CHUNK:
+                break
+            block_ids = [block.id for block in chunk]
+        blocks.join()
+
+    seconds = timed(sync)
+    server.shutdown()
+    assert node.blocks == source.blocks
+
+    return {"name": f"sync-{length}", "seconds": seconds}
+
+
+def bench_import(length=200):
+    source = make_node()
+    extend(source, alice_private_key, length)
+
+    node = make_node()
+    blocks = p.BlockPipeline(node, threading.Lock())
+
+    def load(f):
+        # What the import command feeds the node, minus the local socket
+        stream = u.read_blocks(f)
+        while True:
+            chunk = list(itertools.islice(stream, b.EXPORT_CHUNK))
+            if not chunk:
+                break
+            blocks.submit(chunk)
+        blocks.join()
+
+    with tempfile.TemporaryFile() as f:
+        u.write_blocks(f, source.blocks)
+        f.seek(0)
+        seconds = timed(load, f)
+    assert node.blocks == source.blocks
+
+    return {"name": f"import-{length}", "seconds": seconds}
+
+
+def launch_node():
+    # A lone node0, its only peer is itself
+    env = dict(os.environ, NAME="node0", PEERS="node0")
+    return subprocess.Popen(
+        [sys.executable, "bitcoin.py", "serve"],
+        env=env,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.PIPE,
+        universal_newlines=True,
+    )
+
+
+def bench_startup():
+    # From launch until the node accepts connections
+    start = time.perf_counter()
+    process = launch_node()
+    try:
+        while True:
+            try:
+                socket.create_connection(("localhost", b.PORT)).close()
+                break
+            except ConnectionRefusedError:
+                assert process.poll() is None, "Node exited during startup"
+                time.sleep(0.01)
+        seconds = time.perf_counter() - start
+    finally:
+        process.kill()
+        process.wait()
+
+    return {"name": "startup", "seconds": seconds}
+
+
+def bench_ready():
+    # From launch until the node finished initial block download and mines
+    start = time.perf_counter()
+    process = launch_node()
+    try:
+        for line in process.stderr:
+            if "Ready after" in line:
+                break
+        seconds = time.perf_counter() - start
+    finally:
+        process.kill()
+        process.wait()
+
+    return {"name": "ready", "seconds": seconds}
+
+
+def log_hot_path(name, handler, count=10_000):
+    # What the connect thread pays per "Extended chain" line
+    logger = logging.getLogger(f"benchmarks.{name}")
+    logger.propagate = False
+    logger.addHandler(handler)
+    logging.disable(logging.NOTSET)
+    try:
+        seconds = timed(
+            lambda: [
+                logger.info("Extended chain to height %d", height)
+                for height in range(count)
+            ]
+        )
+    finally:
+        logging.disable(logging.INFO)
+        logger.removeHandler(handler)
+
+    return {"name": f"{name}-{count}", "seconds": seconds}
+
+
+def devnull_handler():
+    handler = logging.StreamHandler(open(os.devnull, "w"))
+    handler.setFormatter(logs.StructuredFormatter(logs.FORMAT))
+    return handler
+
+
+def bench_logging_sync():
+    return log_hot_path("logging-sync", devnull_handler())
+
+
+def bench_logging_async():
+    handler = logs.AsyncHandler(queue.SimpleQueue())
+    listener = logging.handlers.QueueListener(handler.queue, devnull_handler())
+    listener.start()
+    try:
+        return log_hot_path("logging-async", handler)
+    finally:
+        listener.stop()
+
+
+def bench_logging_limited():
+    handler = logs.AsyncHandler(queue.SimpleQueue())
+    handler.addFilter(logs.RateLimitFilter())
+    listener = logging.handlers.QueueListener(handler.queue, devnull_handler())
+    listener.start()
+    try:
+        return log_hot_path("logging-limited", handler)
+    finally:
+        listener.stop()
+
+
+BENCHMARKS = {
+    "validate-tx": bench_validate_tx,
+    "handle-block": bench_handle_block,
+    "fetch-balance": bench_fetch_balance,
+    "publish-view": bench_publish_view,
+    "spend-message": bench_spend_message,
+    "serialize": bench_serialize,
+    "mine-block": bench_mine_block,
+    "reorg": bench_reorg,
+    "failed-reorg": bench_failed_reorg,
+    "sync": bench_sync,
+    "import": bench_import,
+    "startup": bench_startup,
+    "ready": bench_ready,
+    "logging-sync": bench_logging_sync,
+    "logging-async": bench_logging_async,
+    "logging-limited": bench_logging_limited,
+}
+
+
+if __name__ == "__main__":
+    sys.exit(bench.main(BENCHMARKS))
@@ -0,0 +1,1403 @@
+from copy import deepcopy
+import inspect, io, logging, re, threading, time
+import pytest
+import benchmarks
+import bitcoin as b
+import logs
+import metrics
+import models as m
+import network
+import pipeline
+import pool
+import profiling
+import recording
+import simulator
+import tracing
+import utils as u
+
+###########
+# Helpers #
+###########
+
+# Set difficuly very low
+GENESIS_BITS = 2
+
+alice_private_key = b.lookup_private_key("alice")
+alice_public_key = alice_private_key.get_verifying_key()
+
+bob_private_key = b.lookup_private_key("bob")
+bob_public_key = bob_private_key.get_verifying_key()
+
+
+def send_tx(node, sender_private_key, recipient_public_key, amount, fee=100):
+    utxos = node.fetch_utxos(sender_private_key.get_verifying_key())
+    return b.prepare_simple_tx(
+        utxos, sender_private_key, recipient_public_key, amount, fee
+    )
+
+
+def mine_genesis_block(node, public_key=bob_public_key):
+    coinbase = b.prepare_coinbase(public_key, node.get_block_subsidy(), "abc123")
+    unmined_block = m.Block(
+        txns=[coinbase],
+        prev_id=None,
+        nonce=0,
+        bits=GENESIS_BITS,
+        timestamp=1698667908.5560372,
+    )
+    return b.connect_genesis_block(node, b.mine_block(unmined_block))
+
+
+def mine_block(node, miner_public_key, prev_block, mempool, nonce=0, fees=None):
+    # Blocks extending the chain must follow the difficulty schedule
+    if prev_block == node.blocks[-1]:
+        bits = node.get_next_bits(prev_block.id)
+    else:
+        bits = prev_block.bits
+    if fees is None:
+        fees = node.calculate_fees(mempool)
+    coinbase = b.prepare_coinbase(miner_public_key, node.get_block_subsidy() + fees)
+    unmined_block = m.Block(
+        txns=[coinbase] + deepcopy(mempool),
+        prev_id=prev_block.id,
+        nonce=nonce,
+        bits=bits,
+        timestamp=prev_block.timestamp + 1,
+    )
+    mined_block = b.mine_block(unmined_block)
+    node.handle_block(mined_block)
+    return mined_block
+
+
+def make_nodes(count):
+    nodes = [m.Node(address="") for _ in range(count)]
+    genesis = mine_genesis_block(nodes[0])
+    for node in nodes[1:]:
+        b.connect_genesis_block(node, genesis)
+    return nodes
+
+
+#########
+# Tests #
+#########
+
+
+def test_compact_block_from_mempool():
+    node, peer = make_nodes(2)
+    block = mine_block(node, bob_public_key, node.blocks[-1], [])
+    peer.handle_block(block)
+
+    # Both nodes hear about the same transaction
+    tx = send_tx(node, bob_private_key, alice_public_key, 10)
+    node.handle_tx(tx)
+    peer.handle_tx(deepcopy(tx))
+
+    block = mine_block(node, bob_public_key, node.blocks[-1], [tx])
+    compact = m.CompactBlock.from_block(block)
+    assert compact.block_id == block.id
+    assert len(compact.short_ids) == 1
+
+    # Peer rebuilds the whole block without asking for anything
+    rebuilt, missing = peer.reconstruct_block(compact)
+    assert missing == []
+    assert rebuilt == block
+    peer.handle_block(rebuilt)
+    assert peer.fetch_balance(alice_public_key) == 10
+
+
+def test_compact_block_missing_txns():
+    node, peer = make_nodes(2)
+    block = mine_block(node, bob_public_key, node.blocks[-1], [])
+    peer.handle_block(block)
+
+    # Peer never saw this transaction
+    tx = send_tx(node, bob_private_key, alice_public_key, 10)
+    node.handle_tx(tx)
+    block = mine_block(node, bob_public_key, node.blocks[-1], [tx])
+
+    compact = m.CompactBlock.from_block(block)
+    rebuilt, missing = peer.reconstruct_block(compact)
+    assert rebuilt is None
+    assert missing == [1]
+    assert block.id in peer.partial_blocks
+
+    # Only the missing transaction is sent over
+    txns = node.fetch_block_txns(block.id, missing)
+    assert [tx.id for tx in txns] == [tx.id]
+    rebuilt = peer.fill_block(block.id, txns)
+    assert rebuilt == block
+    assert peer.partial_blocks == {}
+
+
+def test_compact_block_wrong_txns():
+    node, peer = make_nodes(2)
+    block = mine_block(node, bob_public_key, node.blocks[-1], [])
+    peer.handle_block(block)
+
+    tx = send_tx(node, bob_private_key, alice_public_key, 10)
+    block = mine_block(node, bob_public_key, node.blocks[-1], [tx])
+    compact = m.CompactBlock.from_block(block)
+    peer.reconstruct_block(compact)
+
+    # Transactions which don't match the short ids are refused
+    other = send_tx(node, bob_private_key, alice_public_key, 20)
+    with pytest.raises(Exception):
+        peer.fill_block(block.id, [other])
+
+
+def test_partial_blocks_bounded(monkeypatch):
+    monkeypatch.setattr(m, "MAX_PARTIAL_BLOCKS", 2)
+    node, peer = make_nodes(2)
+    tx = send_tx(node, bob_private_key, alice_public_key, 10)
+    block = mine_block(node, bob_public_key, node.blocks[-1], [tx])
+    compact = m.CompactBlock.from_block(block)
+
+    # Replies that never come don't pile up
+    for block_id in ["a", "b", block.id]:
+        other = deepcopy(compact)
+        other.block_id = block_id
+        peer.reconstruct_block(other)
+    assert list(peer.partial_blocks) == ["b", block.id]
+    assert peer.metrics.counters["partial_blocks_evicted"] == 1
+
+    # Nor does one whose block arrives some other way
+    peer.handle_block(block)
+    assert list(peer.partial_blocks) == ["b"]
+
+
+def test_broadcast_never_blocks_on_slow_peer():
+    sent = []
+    release = threading.Event()
+
+    def send(peer, command, data):
+        if peer == ("slow", 0):
+            release.wait()
+        sent.append((peer, command, data))
+
+    broadcaster = network.Broadcaster(send=send)
+    peers = [("slow", 0), ("fast", 0)]
+
+    start = time.time()
+    for i in range(5):
+        broadcaster.broadcast(peers, "tx", i, key=i)
+    assert time.time() - start < 0.5
+
+    # Fast peer gets everything while slow peer is still stuck
+    deadline = time.time() + 5
+    while len(sent) < 5 and time.time() < deadline:
+        time.sleep(0.01)
+    assert [data for peer, _, data in sent] == [0, 1, 2, 3, 4]
+
+    release.set()
+    deadline = time.time() + 5
+    while len(sent) < 10 and time.time() < deadline:
+        time.sleep(0.01)
+    assert len(sent) == 10
+
+    # One worker per peer, no matter how many messages
+    assert len(broadcaster.queues) == 2
+
+
+def test_peer_queue_coalesces_and_drops():
+    release = threading.Event()
+    sent = []
+
+    def send(peer, command, data):
+        release.wait()
+        sent.append(data)
+
+    queue = network.PeerQueue(("peer", 0), send, maxsize=3)
+
+    # Worker grabs the first message and blocks on it
+    queue.put("compact-block", "b0", key="b0")
+    deadline = time.time() + 5
+    while len(queue) and time.time() < deadline:
+        time.sleep(0.01)
+
+    queue.put("tx", "t1", key="t1")
+    queue.put("compact-block", "b1", key="b1")
+    queue.put("tx", "t1-again", key="t1")
+    assert queue.stats["coalesced"] == 1
+    assert len(queue) == 2
+
+    # A full queue drops transactions before blocks
+    queue.put("compact-block", "b2", key="b2")
+    queue.put("compact-block", "b3", key="b3")
+    assert queue.stats["dropped"] == 1
+    assert len(queue) == 3
+
+    release.set()
+    deadline = time.time() + 5
+    while len(sent) < 4 and time.time() < deadline:
+        time.sleep(0.01)
+    assert sent == ["b0", "b1", "b2", "b3"]
+
+
+def test_peer_queue_delays_in_parallel(monkeypatch):
+    monkeypatch.setattr(network.random, "randint", lambda a, b: 1)
+    monkeypatch.setattr(network.random, "random", lambda: 0.3)
+    sent = {}
+    queue = network.PeerQueue(
+        ("peer", 0), lambda peer, command, data: sent.setdefault(data, time.time())
+    )
+
+    # Delayed blocks don't hold up each other or transactions behind them
+    start = time.time()
+    for index in range(3):
+        queue.put("compact-block", f"b{index}", disrupt=True)
+    queue.put("tx", "t0")
+    deadline = time.time() + 5
+    while len(sent) < 4 and time.time() < deadline:
+        time.sleep(0.01)
+
+    assert list(sent) == ["t0", "b0", "b1", "b2"]
+    assert sent["t0"] - start < 0.2
+    assert 0.3 <= sent["b2"] - start < 0.6
+
+
+def test_peer_directory_prefers_announced_address():
+    resolved = []
+
+    def resolve(ip):
+        resolved.append(ip)
+        return ("bitcoin_node2_1.bitcoin_default", [], [ip])
+
+    directory = network.PeerDirectory(metrics.Metrics(), resolve=resolve)
+
+    # Announced in the handshake, no DNS needed
+    directory.announce("10.0.0.1", ["node1", 10000])
+    assert directory.lookup("10.0.0.1", 10000) == ("node1", 10000)
+    assert resolved == []
+
+    # Unknown peers are resolved once and then cached
+    assert directory.lookup("10.0.0.2", 10000) == ("node2", 10000)
+    assert directory.lookup("10.0.0.2", 10000) == ("node2", 10000)
+    assert resolved == ["10.0.0.2"]
+
+    stats = directory.metrics.snapshot()
+    assert stats["counters"]["peer_lookup_announced"] == 1
+    assert stats["counters"]["peer_lookup_dns_cached"] == 1
+    assert stats["histograms"]["peer_dns_resolution_time"]["count"] == 1
+
+
+def test_peer_directory_dns_cache_expires():
+    resolved = []
+
+    def resolve(ip):
+        resolved.append(ip)
+        raise OSError("no reverse dns")
+
+    directory = network.PeerDirectory(metrics.Metrics(), ttl=0, resolve=resolve)
+    assert directory.lookup("10.0.0.3", 10000) == ("10.0.0.3", 10000)
+    assert directory.lookup("10.0.0.3", 10000) == ("10.0.0.3", 10000)
+    assert resolved == ["10.0.0.3", "10.0.0.3"]
+
+
+def test_view_published_after_block():
+    (node,) = make_nodes(1)
+    view = node.view
+    assert view.height == 0
+    assert view.fetch_balance(bob_public_key) == node.get_block_subsidy()
+
+    mine_block(node, bob_public_key, node.blocks[-1], [])
+
+    # Readers holding the old view are unaffected
+    assert view.height == 0
+    assert view.fetch_balance(bob_public_key) == node.get_block_subsidy()
+
+    assert node.view.version > view.version
+    assert node.view.height == 1
+    assert node.view.blocks[-1] == node.blocks[-1]
+    assert node.view.fetch_balance(bob_public_key) == 2 * node.get_block_subsidy()
+
+
+def test_view_ignores_unpublished_writes():
+    (node,) = make_nodes(1)
+    mine_block(node, bob_public_key, node.blocks[-1], [])
+    view = node.view
+
+    # Half applied state never leaks into the published view
+    tx = send_tx(node, bob_private_key, alice_public_key, 10)
+    node.connect_tx(tx)
+    assert node.fetch_balance(alice_public_key) == 10
+    assert node.view.fetch_balance(alice_public_key) == 0
+    assert node.view is view
+    with pytest.raises(TypeError):
+        node.view.utxo_set[("x", 0)] = None
+
+
+def test_view_publishes_utxo_layers(monkeypatch):
+    monkeypatch.setattr(m, "MAX_SNAPSHOT_DEPTH", 2)
+    (node,) = make_nodes(1)
+    views = [node.view]
+    for _ in range(4):
+        tx = send_tx(node, bob_private_key, alice_public_key, 10)
+        mine_block(node, bob_public_key, node.blocks[-1], [tx])
+        views.append(node.view)
+
+    # Each view only holds what its block changed, and layers get flattened
+    assert [view.utxo_set.depth for view in views] == [1, 2, 0, 1, 2]
+    assert len(views[1].utxo_set.changes) == 4
+
+    # Older views still read as they were
+    for height, view in enumerate(views):
+        utxo_set = view.utxo_set
+        assert view.fetch_balance(alice_public_key) == 10 * height
+        assert len(utxo_set) == len(dict(utxo_set.items())) == 1 + 2 * height
+    assert views[-1].utxo_set == node.utxo_set
+
+
+def test_view_sync_blocks():
+    (node,) = make_nodes(1)
+    for _ in range(3):
+        mine_block(node, bob_public_key, node.blocks[-1], [])
+
+    ids = [block.id for block in node.blocks]
+    assert node.view.find_sync_blocks(ids[:2]) == node.blocks[2:]
+    assert node.view.find_sync_blocks(ids) is None
+
+
+def test_utxo_view_layers_writes():
+    base = {("a", 0): 1, ("b", 0): 2}
+    view = m.UTXOView(base)
+
+    del view[("a", 0)]
+    view[("c", 0)] = 3
+    view[("b", 0)] = 4
+    assert ("a", 0) not in view
+    assert dict(view) == {("b", 0): 4, ("c", 0): 3}
+    assert len(view) == 2
+    with pytest.raises(KeyError):
+        del view[("a", 0)]
+
+    # Base untouched until commit
+    assert base == {("a", 0): 1, ("b", 0): 2}
+    assert view.commit() is base
+    assert base == {("b", 0): 4, ("c", 0): 3}
+
+
+def test_successful_reorg():
+    node, alice_node = make_nodes(2)
+
+    # Bob mines height=1,2
+    b0 = node.blocks[0]
+    b1 = mine_block(node, bob_public_key, node.blocks[0], [])
+    # height=2 contains a bob->alice txn
+    bob_to_alice = send_tx(node, bob_private_key, alice_public_key, 10)
+    b2 = mine_block(node, bob_public_key, node.blocks[1], [bob_to_alice])
+
+    # Alice accepts bob's first block, but not the second
+    alice_node.handle_block(b1)
+    a2 = mine_block(alice_node, alice_public_key, node.blocks[1], [])
+    node.handle_block(a2)
+
+    assert node.blocks == [b0, b1, b2]
+    assert node.branches == [[a2]]
+    assert node.fetch_balance(alice_public_key) == 10
+
+    # Alice's second block makes her branch heavier
+    alice_to_bob = send_tx(alice_node, alice_private_key, bob_public_key, 20)
+    a3 = mine_block(
+        node, alice_public_key, node.branches[0][0], [alice_to_bob], fees=100
+    )
+
+    # Chains
+    assert node.blocks == [b0, b1, a2, a3]
+    assert node.branches == [[b2]]
+    assert node.view.blocks == tuple(node.blocks)
+
+    # Balances
+    assert (bob_to_alice.id, 0) not in node.utxo_set
+    assert (alice_to_bob.id, 0) in node.utxo_set
+    assert isinstance(node.utxo_set, dict)
+    subsidy = node.get_block_subsidy()
+    # Alice mined the fee she paid
+    assert node.fetch_balance(alice_public_key) == 2 * subsidy - 20
+    assert node.fetch_balance(bob_public_key) == 2 * subsidy + 20
+
+    # Mempool
+    assert node.mempool == [bob_to_alice]
+
+    assert node.metrics.counters["reorgs"] == 1
+    assert node.metrics.histograms["reorg_depth"].count == 1
+
+
+def test_unsuccessful_reorg():
+    node, alice_node = make_nodes(2)
+
+    # Bob mines height=1,2
+    b1 = mine_block(node, bob_public_key, node.blocks[0], [])
+    mine_block(node, bob_public_key, node.blocks[1], [])
+
+    # Alice accepts bob's first block, but not the second
+    alice_node.handle_block(b1)
+    a2 = mine_block(alice_node, alice_public_key, node.blocks[1], [])
+    node.handle_block(a2)
+
+    # txn invalid b/c changing amount arbitrarily after signing ...
+    alice_to_bob = send_tx(alice_node, alice_private_key, bob_public_key, 20)
+    alice_to_bob.tx_outs[0].amount = 100000
+
+    initial_utxo_set = deepcopy(node.utxo_set)
+    initial_chain = deepcopy(node.blocks)
+    initial_branches = deepcopy(node.branches)
+    initial_view = node.view
+
+    # This block only turns out invalid during the reorg
+    mine_block(node, alice_public_key, node.branches[0][0], [alice_to_bob], fees=100)
+
+    # UTXO, chain, branches unchanged
+    assert node.utxo_set.keys() == initial_utxo_set.keys()
+    assert node.blocks == initial_chain
+    assert node.branches == initial_branches
+    assert node.view is initial_view
+
+
+def test_prune_deep_branches():
+    (node,) = make_nodes(1)
+    mine_block(node, bob_public_key, node.blocks[0], [])
+    fork = mine_block(node, alice_public_key, node.blocks[0], [])
+    assert node.branches == [[fork]]
+
+    # Branch survives while close to the tip
+    for _ in range(m.MAX_BRANCH_DEPTH):
+        mine_block(node, bob_public_key, node.blocks[-1], [])
+    assert node.branches == [[fork]]
+
+    mine_block(node, bob_public_key, node.blocks[-1], [])
+    assert node.branches == []
+    assert node.metrics.counters["pruned_branches"] == 1
+    assert node.metrics.counters["pruned_branch_blocks"] == 1
+
+
+def test_prune_old_branches(monkeypatch):
+    monkeypatch.setattr(m, "MAX_BRANCH_AGE_IN_SECS", 2)
+    (node,) = make_nodes(1)
+    mine_block(node, bob_public_key, node.blocks[0], [])
+    mine_block(node, alice_public_key, node.blocks[0], [])
+    mine_block(node, bob_public_key, node.blocks[-1], [])
+    mine_block(node, bob_public_key, node.blocks[-1], [])
+    assert len(node.branches) == 1
+
+    # Three seconds of chain time later the branch is dropped
+    mine_block(node, bob_public_key, node.blocks[-1], [])
+    assert node.branches == []
+
+
+def test_prune_branches_over_budget(monkeypatch):
+    monkeypatch.setattr(m, "MAX_BRANCH_BLOCKS", 2)
+    (node,) = make_nodes(1)
+    for _ in range(3):
+        mine_block(node, bob_public_key, node.blocks[-1], [])
+    low = mine_block(node, alice_public_key, node.blocks[0], [])
+    high = mine_block(node, alice_public_key, node.blocks[1], [])
+    assert node.branches == [[low], [high]]
+
+    # A third branch pushes out the one furthest behind
+    higher = mine_block(node, alice_public_key, node.blocks[2], [])
+    assert node.branches == [[high], [higher]]
+    assert node.metrics.counters["pruned_branches"] == 1
+
+
+def test_prune_branches_counts_shared_blocks_once(monkeypatch):
+    monkeypatch.setattr(m, "MAX_BRANCH_BLOCKS", 3)
+    (node,) = make_nodes(1)
+    for _ in range(3):
+        mine_block(node, bob_public_key, node.blocks[-1], [])
+    fork = mine_block(node, alice_public_key, node.blocks[1], [])
+    first = mine_block(node, alice_public_key, fork, [])
+    second = mine_block(node, alice_public_key, fork, [], nonce=first.nonce + 1)
+
+    # Three blocks, even though both branches hold a copy of the fork
+    assert node.branches == [[fork, first], [fork, second]]
+    assert node.metrics.counters["pruned_branches"] == 0
+
+
+def test_reorg_reanchors_stranded_branches():
+    (node,) = make_nodes(1)
+    a1 = mine_block(node, bob_public_key, node.blocks[0], [])
+    a2 = mine_block(node, bob_public_key, a1, [])
+    a3 = mine_block(node, bob_public_key, a2, [])
+    b3 = mine_block(node, alice_public_key, a2, [])
+
+    # Reorg away the block b3 forks off
+    c2 = mine_block(node, alice_public_key, a1, [])
+    c3 = mine_block(node, alice_public_key, c2, [])
+    c4 = mine_block(node, alice_public_key, c3, [])
+    assert node.blocks == [node.blocks[0], a1, c2, c3, c4]
+    assert node.branches == [[a2, b3], [a2, a3]]
+
+    # Both the chain and the stranded branch keep growing
+    mine_block(node, bob_public_key, c4, [])
+    b4 = mine_block(node, alice_public_key, b3, [])
+    assert node.branches == [[a2, b3, b4], [a2, a3]]
+    assert len(node.blocks) == 6
+
+
+def test_pruned_node_keeps_headers():
+    node = m.Node(address="", prune_depth=2)
+    mine_genesis_block(node)
+    bob_to_alice = send_tx(node, bob_private_key, alice_public_key, 10)
+    mine_block(node, bob_public_key, node.blocks[-1], [bob_to_alice])
+    for _ in range(3):
+        mine_block(node, bob_public_key, node.blocks[-1], [])
+
+    # Only the last two blocks keep their transactions
+    assert [block.txns is None for block in node.blocks] == [
+        True,
+        True,
+        True,
+        False,
+        False,
+    ]
+    assert node.pruned_height == 2
+    assert bob_to_alice.id not in node.undo
+    assert node.fetch_balance(alice_public_key) == 10
+
+    # Headers are enough to keep validating new blocks
+    mine_block(node, bob_public_key, node.blocks[-1], [])
+    assert len(node.blocks) == 6
+
+    # Peers asking for pruned blocks get told so
+    ids = [node.blocks[0].id]
+    assert node.view.find_sync_blocks(ids)[0].txns is None
+
+    report = node.view.memory_by_depth()
+    assert report["0"] == {"blocks": 1, "pruned": 0, "bytes": report["0"]["bytes"]}
+    assert report["1+"]["blocks"] == 5
+    assert report["1+"]["pruned"] == 4
+
+
+def test_pruned_node_reorg():
+    node = m.Node(address="", prune_depth=2)
+    alice_node = make_nodes(1)[0]
+    b.connect_genesis_block(node, alice_node.blocks[0])
+
+    b1 = mine_block(node, bob_public_key, node.blocks[0], [])
+    alice_node.handle_block(b1)
+    b2 = mine_block(node, bob_public_key, node.blocks[-1], [])
+    mine_block(node, bob_public_key, node.blocks[-1], [])
+
+    # Alice's branch forks within the kept window and wins
+    a2 = mine_block(alice_node, alice_public_key, b1, [])
+    a3 = mine_block(alice_node, alice_public_key, a2, [])
+    node.handle_block(a2)
+    node.handle_block(a3)
+    a4 = mine_block(node, alice_public_key, a3, [])
+    assert node.blocks[-3:] == [a2, a3, a4]
+    assert node.branches[0][0] == b2
+
+
+def test_orphan_blocks_connect_when_parent_arrives():
+    node, peer = make_nodes(2)
+    blocks = [mine_block(node, bob_public_key, node.blocks[-1], []) for _ in range(3)]
+
+    # Children show up before their parent
+    peer.handle_block(blocks[2])
+    peer.handle_block(blocks[1])
+    assert len(peer.blocks) == 1
+    assert set(peer.orphans) == {blocks[0].id, blocks[1].id}
+    with pytest.raises(Exception):
+        peer.handle_block(blocks[2])
+
+    # Parent connects everything waiting on it, in order
+    peer.handle_block(blocks[0])
+    assert peer.blocks == node.blocks
+    assert peer.orphans == {}
+    assert peer.metrics.counters["orphan_blocks_added"] == 2
+    assert peer.metrics.counters["orphan_blocks_connected"] == 2
+
+
+def test_orphan_blocks_expire_and_evict(monkeypatch):
+    node, peer = make_nodes(2)
+    blocks = [mine_block(node, bob_public_key, node.blocks[-1], []) for _ in range(4)]
+
+    monkeypatch.setattr(m, "MAX_ORPHAN_BLOCKS", 2)
+    for block in blocks[1:]:
+        peer.handle_block(block)
+    assert not peer.is_orphan(blocks[1].id)
+    assert peer.is_orphan(blocks[3].id)
+    assert peer.metrics.counters["orphan_blocks_evicted"] == 1
+
+    monkeypatch.setattr(m, "ORPHAN_EXPIRY_IN_SECS", -1)
+    fork = mine_block(node, alice_public_key, blocks[0], [])
+    peer.handle_block(fork)
+    assert list(peer.orphans) == [blocks[0].id]
+    assert peer.metrics.counters["orphan_blocks_expired"] == 2
+
+
+def test_mempool_accepts_unconfirmed_children():
+    (node,) = make_nodes(1)
+    parent = send_tx(node, bob_private_key, alice_public_key, 1000)
+    node.handle_tx(parent)
+
+    # Alice spends her unconfirmed coins right away
+    child = b.prepare_simple_tx(
+        [parent.tx_outs[0]], alice_private_key, bob_public_key, 500, 100
+    )
+    node.handle_tx(child)
+    assert node.mempool == [parent, child]
+
+    # Spending the same coins twice is still refused
+    double_spend = b.prepare_simple_tx(
+        [parent.tx_outs[0]], alice_private_key, alice_public_key, 500, 100
+    )
+    with pytest.raises(Exception):
+        node.handle_tx(double_spend)
+    assert node.orphan_txns == {}
+
+    # Parent and child can be mined in the same block
+    mine_block(node, bob_public_key, node.blocks[-1], node.mempool)
+    assert node.mempool == []
+    assert node.fetch_balance(alice_public_key) == 1000 - 500 - 100
+
+
+def test_block_evicts_conflicting_mempool_txns():
+    (node,) = make_nodes(1)
+    parent = send_tx(node, bob_private_key, alice_public_key, 1000)
+    node.handle_tx(parent)
+    child = b.prepare_simple_tx(
+        [parent.tx_outs[0]], alice_private_key, bob_public_key, 500, 100
+    )
+    node.handle_tx(child)
+
+    # A block confirms a different spend of the parent's coins
+    double_spend = send_tx(node, bob_private_key, bob_public_key, 1000)
+    mine_block(node, bob_public_key, node.blocks[-1], [double_spend])
+    assert node.mempool == []
+    assert node.metrics.counters["mempool_conflicts_evicted"] == 2
+
+    # Later transactions and templates don't trip over the evicted ones
+    tx = send_tx(node, bob_private_key, alice_public_key, 10)
+    node.handle_tx(tx)
+    assert node.mempool == [tx]
+    assert b.prepare_block_template(node, bob_public_key).txns[1:] == [tx]
+
+
+def test_reorg_evicts_txns_spending_lost_coinbases():
+    (node,) = make_nodes(1)
+    genesis = node.blocks[0]
+    b1 = mine_block(node, bob_public_key, genesis, [])
+    spends_coinbase = b.prepare_simple_tx(
+        [b1.txns[0].tx_outs[0]], bob_private_key, alice_public_key, 10, 100
+    )
+    mine_block(node, bob_public_key, b1, [spends_coinbase])
+    child = b.prepare_simple_tx(
+        [spends_coinbase.tx_outs[0]], alice_private_key, bob_public_key, 5, 1
+    )
+    node.handle_tx(child)
+
+    # Alice's fork takes over, b1's coinbase never existed
+    a1 = mine_block(node, alice_public_key, genesis, [])
+    a2 = mine_block(node, alice_public_key, a1, [])
+    mine_block(node, alice_public_key, a2, [])
+    assert node.blocks[1] == a1
+    assert node.mempool == []
+    assert node.metrics.counters["mempool_txns_evicted"] == 2
+
+    # New transactions and templates work as before
+    tx = send_tx(node, bob_private_key, alice_public_key, 10)
+    node.handle_tx(tx)
+    assert node.mempool == [tx]
+    assert b.prepare_block_template(node, bob_public_key).txns[1:] == [tx]
+
+
+def test_orphan_txns_accepted_when_parent_arrives():
+    (node,) = make_nodes(1)
+    parent = send_tx(node, bob_private_key, alice_public_key, 1000)
+    child = b.prepare_simple_tx(
+        [parent.tx_outs[0]], alice_private_key, bob_public_key, 500, 100
+    )
+
+    # Child overtakes its parent on the network
+    node.handle_tx(child)
+    assert node.mempool == []
+    assert list(node.orphan_txns) == [child.id]
+
+    node.handle_tx(parent)
+    assert node.mempool == [parent, child]
+    assert node.orphan_txns == {}
+    assert node.orphan_txns_by_outpoint == {}
+    assert node.metrics.counters["orphan_txns_retried"] == 1
+
+
+def test_orphan_txns_accepted_when_parent_confirmed(monkeypatch):
+    (node,) = make_nodes(1)
+    parent = send_tx(node, bob_private_key, alice_public_key, 1000)
+    child = b.prepare_simple_tx(
+        [parent.tx_outs[0]], alice_private_key, bob_public_key, 500, 100
+    )
+    node.handle_tx(child)
+
+    # Parent arrives in a block instead
+    mine_block(node, bob_public_key, node.blocks[-1], [parent])
+    assert node.mempool == [child]
+
+    # Pool is bounded
+    monkeypatch.setattr(m, "MAX_ORPHAN_TXNS", 1)
+    first = b.prepare_simple_tx(
+        [child.tx_outs[0]], bob_private_key, alice_public_key, 10, 10
+    )
+    second = b.prepare_simple_tx(
+        [child.tx_outs[1]], alice_private_key, bob_public_key, 10, 10
+    )
+    grandchild = b.prepare_simple_tx(
+        [first.tx_outs[0]], alice_private_key, bob_public_key, 1, 1
+    )
+    node.handle_tx(grandchild)
+    node.handle_tx(
+        b.prepare_simple_tx([second.tx_outs[0]], bob_private_key, bob_public_key, 1, 1)
+    )
+    assert len(node.orphan_txns) == 1
+    assert node.metrics.counters["orphan_txns_evicted"] == 1
+
+
+def test_reorg_returns_dependent_txns_in_order():
+    node, alice_node = make_nodes(2)
+    b1 = mine_block(node, bob_public_key, node.blocks[0], [])
+    alice_node.handle_block(b1)
+
+    parent = send_tx(node, bob_private_key, alice_public_key, 1000)
+    child = b.prepare_simple_tx(
+        [parent.tx_outs[0]], alice_private_key, bob_public_key, 500, 100
+    )
+    mine_block(node, bob_public_key, b1, [parent, child])
+
+    a2 = mine_block(alice_node, alice_public_key, b1, [])
+    a3 = mine_block(alice_node, alice_public_key, a2, [])
+    node.handle_block(a2)
+    node.handle_block(a3)
+
+    assert node.blocks[-1] == a3
+    assert node.mempool == [parent, child]
+    assert (parent.tx_outs[0].outpoint) not in node.utxo_set
+
+
+def test_pipeline_connects_blocks_in_order():
+    node, peer = make_nodes(2)
+    mine_block(node, alice_public_key, node.blocks[-1], [])
+    for _ in range(3):
+        tx = send_tx(node, bob_private_key, alice_public_key, 10)
+        mine_block(node, alice_public_key, node.blocks[-1], [tx])
+
+    connected = threading.Event()
+    blocks = pipeline.BlockPipeline(peer, threading.Lock(), connected.set, 2)
+    blocks.submit(deepcopy(node.blocks[1:]))
+    blocks.join()
+
+    assert peer.blocks == node.blocks
+    assert connected.is_set()
+    # Signatures checked ahead of time aren't verified again
+    assert peer.metrics.counters["signature_cache_hits"] == 3
+
+
+def test_pipeline_rejects_bad_signatures():
+    node, peer = make_nodes(2)
+    tx = send_tx(node, bob_private_key, alice_public_key, 10)
+    block = mine_block(node, alice_public_key, node.blocks[-1], [tx])
+
+    # Changing the amount after signing invalidates the transaction
+    block = deepcopy(block)
+    block.txns[1].tx_outs[0].amount += 1
+    block = b.mine_block(block)
+
+    blocks = pipeline.BlockPipeline(peer, threading.Lock(), workers=2)
+    blocks.submit([block])
+    blocks.join()
+
+    assert len(peer.blocks) == 1
+    assert peer.metrics.counters["pipeline_rejected"] == 1
+
+
+def test_pipeline_checks_queued_blocks_together():
+    node, peer = make_nodes(2)
+    mine_block(node, alice_public_key, node.blocks[-1], [])
+    for _ in range(3):
+        tx = send_tx(node, bob_private_key, alice_public_key, 10)
+        mine_block(node, alice_public_key, node.blocks[-1], [tx])
+
+    # A bad signature in the middle of the queue stops the chain there
+    blocks = deepcopy(node.blocks[1:])
+    blocks[2].txns[1].tx_outs[0].amount += 1
+    blocks[2] = b.mine_block(blocks[2])
+    checker = pipeline.BlockPipeline(peer, threading.Lock(), workers=2)
+    checker.submit(blocks)
+    checker.join()
+
+    assert peer.blocks == node.blocks[:3]
+    assert peer.metrics.counters["pipeline_rejected"] == 1
+    assert checker.pending_outputs == {}
+
+
+def test_pipeline_survives_failing_hook(caplog):
+    node, peer = make_nodes(2)
+    for _ in range(2):
+        mine_block(node, alice_public_key, node.blocks[-1], [])
+
+    def on_connected():
+        raise Exception("Hook failed")
+
+    blocks = pipeline.BlockPipeline(peer, threading.Lock(), on_connected, 2)
+    blocks.submit(deepcopy(node.blocks[1:]))
+    blocks.join()
+
+    # Both blocks went in, and neither is reported as rejected
+    assert peer.blocks == node.blocks
+    assert "Rejected block" not in caplog.text
+    assert "Block connected hook failed" in caplog.text
+
+
+def test_assume_valid_skips_signatures():
+    node, peer = make_nodes(2)
+    mine_block(node, alice_public_key, node.blocks[-1], [])
+    for _ in range(3):
+        tx = send_tx(node, bob_private_key, alice_public_key, 10)
+        mine_block(node, alice_public_key, node.blocks[-1], [tx])
+
+    peer.assume_valid = node.blocks[3].id
+    peer.assume_valid_height = 3
+    for block in node.blocks[1:4]:
+        peer.handle_block(block)
+    assert peer.skipped_signatures == 2
+    assert peer.assume_valid is None
+
+    # Past the checkpoint everything is verified again
+    verified = peer.metrics.histograms["signature_verification_time"].count
+    peer.handle_block(node.blocks[4])
+    assert peer.skipped_signatures == 2
+    assert peer.metrics.histograms["signature_verification_time"].count == verified + 1
+    assert peer.blocks == node.blocks
+
+
+def test_assume_valid_is_bounded():
+    (node,) = make_nodes(1)
+    genesis = node.blocks[0]
+
+    def forge(peer):
+        # Alice spends Bob's coins with her own key
+        utxos = peer.fetch_utxos(bob_public_key)
+        return b.prepare_simple_tx(utxos, alice_private_key, alice_public_key, 10, 0)
+
+    # A forgery below the height of an assumed-valid block which never
+    # shows up is only let through until we pass that height
+    peer = m.Node(address="", assume_valid="f" * 64, assume_valid_height=2)
+    b.connect_genesis_block(peer, genesis)
+    forged = mine_block(peer, bob_public_key, genesis, [forge(peer)], fees=0)
+    assert peer.skipped_signatures == 1
+    with pytest.raises(Exception):
+        mine_block(peer, bob_public_key, forged, [], fees=0)
+
+    # The forged block and everything on top of it are gone
+    assert peer.blocks == [genesis]
+    assert peer.view.blocks == (genesis,)
+    assert peer.mempool == []
+    assert peer.fetch_balance(bob_public_key) == peer.get_block_subsidy()
+    assert peer.metrics.counters["blocks_rewound"] == 2
+    assert peer.assume_valid is None
+
+    # Nor are signatures skipped once we caught up with our peers
+    peer = m.Node(address="", assume_valid="f" * 64, assume_valid_height=100)
+    b.connect_genesis_block(peer, genesis)
+    peer.synced.set()
+    with pytest.raises(Exception):
+        mine_block(peer, bob_public_key, peer.blocks[-1], [forge(peer)], fees=0)
+    assert peer.skipped_signatures == 0
+
+
+def test_synced_once_every_peer_ran_out_of_blocks():
+    node = m.Node(address="")
+    node.peers = [("node1", b.PORT), ("node2", b.PORT)]
+    sent = []
+    node.send = lambda peer, command, data: sent.append((peer, command))
+    node.sync()
+    assert len(sent) == 2
+
+    # One peer behind the other doesn't mean we caught up
+    node.sync_done(("node1", b.PORT))
+    assert not node.synced.is_set()
+    node.sync_done(("node2", b.PORT))
+    assert node.synced.is_set()
+
+
+def test_export_and_import_blocks():
+    node, peer = make_nodes(2)
+    for _ in range(3):
+        tx = send_tx(node, bob_private_key, alice_public_key, 10)
+        mine_block(node, alice_public_key, node.blocks[-1], [tx])
+
+    # Page through the chain like the export command does
+    f = io.BytesIO()
+    for height in range(0, len(node.blocks), 2):
+        u.write_blocks(f, node.view.fetch_blocks(height, 2))
+
+    f.seek(0)
+    blocks = pipeline.BlockPipeline(peer, threading.Lock(), workers=2)
+    results = pipeline.Results()
+    blocks.submit(u.read_blocks(f), results)
+
+    # The peer already had the genesis block
+    assert results.wait() == {"accepted": 3, "rejected": 1}
+    assert peer.blocks == node.blocks
+
+
+def make_pool(node, public_key=alice_public_key):
+    prepare_template = lambda: b.prepare_block_template(node, public_key)
+    return pool.WorkPool(node, threading.Lock(), prepare_template, nonce_range=1000)
+
+
+def test_pool_checks_shares():
+    (node,) = make_nodes(1)
+    work_pool = make_pool(node)
+    first, second = work_pool.getwork(), work_pool.getwork()
+    assert first.end == second.start
+
+    # Difficulty is so low every hash is a share and some are blocks
+    nonces = range(first.start, first.end)
+    results = [work_pool.submit(first.version, nonce) for nonce in nonces]
+    found = results.index("block")
+    assert set(results[:found]) <= {"share"}
+    assert set(results[found + 1 :]) == {"stale"}
+    assert node.metrics.counters["pool_shares"] == found + 1
+
+    # Finding a block extends the chain and replaces the template
+    assert len(node.blocks) == 2
+    assert work_pool.is_stale(second)
+    assert work_pool.templates[work_pool.version].prev_id == node.blocks[-1].id
+
+    # Hashes which miss the share target are rejected
+    work = work_pool.getwork()
+    work_pool.templates[work.version].bits = 64
+    assert work_pool.submit(work.version, work.start) == "invalid"
+
+
+def test_pool_rejects_duplicate_and_foreign_shares():
+    (node,) = make_nodes(1)
+    work_pool = make_pool(node)
+    work = work_pool.getwork()
+
+    # A nonce which is a share but not a block
+    block = deepcopy(work.block)
+    for nonce in range(work.start, work.end):
+        block.nonce = nonce
+        if block.proof >= block.target:
+            break
+    assert work_pool.submit(work.version, nonce) == "share"
+
+    # Resubmitting a share, or a nonce we never handed out, earns nothing
+    assert work_pool.submit(work.version, nonce) == "duplicate"
+    assert work_pool.submit(work.version, work.end) == "invalid"
+    assert work_pool.stats()["duplicate_shares"] == 1
+    assert node.metrics.counters["pool_shares"] == 1
+    assert node.metrics.counters["pool_hashes"] == work.hashes_per_share
+
+
+def test_pool_counts_invalid_blocks():
+    (node,) = make_nodes(1)
+    work_pool = make_pool(node)
+    work = work_pool.getwork()
+
+    # A template the node won't accept, claiming too much subsidy
+    template = work_pool.templates[work.version]
+    template.txns[0].tx_outs[0].amount += 1
+    results = [work_pool.submit(work.version, n) for n in range(work.start, work.end)]
+    assert "block" not in results and "invalid" in results
+    assert work_pool.stats()["invalid_blocks"] == results.count("invalid")
+    assert work_pool.stats()["stale_shares"] == 0
+    assert len(node.blocks) == 1
+
+
+def test_pool_pushes_work_on_refresh():
+    (node,) = make_nodes(1)
+    pushed = []
+    node.broadcaster = network.Broadcaster(send=lambda *message: pushed.append(message))
+    work_pool = make_pool(node)
+    work_pool.register(("worker", 10100))
+
+    mine_block(node, bob_public_key, node.blocks[-1], [])
+    work_pool.refresh()
+    node.broadcaster.queue(("worker", 10100)).thread.join(0.1)
+
+    ((peer, command, work),) = pushed
+    assert command == "work" and work.version == work_pool.version
+    assert work.block.prev_id == node.blocks[-1].id
+
+
+def test_pool_refreshes_on_tip_change_only():
+    (node,) = make_nodes(1)
+    work_pool = make_pool(node)
+    genesis = node.blocks[-1]
+    mine_block(node, bob_public_key, genesis, [])
+    work_pool.update()
+    version = work_pool.version
+    assert work_pool.stats()["tip_refreshes"] == 1
+
+    # Blocks on a side branch leave the template alone
+    mine_block(node, bob_public_key, genesis, [])
+    work_pool.update()
+    assert work_pool.version == version
+
+    # New transactions are only picked up on the refresh cadence
+    work = work_pool.getwork()
+    node.handle_tx(send_tx(node, bob_private_key, alice_public_key, 10))
+    work_pool.update()
+    assert work_pool.version == version
+    work_pool.update(mempool=True)
+    assert work_pool.version == version + 1
+    assert len(work_pool.templates[work_pool.version].txns) == 2
+
+    # Miners move to the new template, but the old one still counts
+    assert work_pool.submit(version, work.start) in ("share", "block")
+    assert work_pool.stats()["mempool_refreshes"] == 1
+
+
+def test_pool_keeps_template_when_preparing_fails():
+    (node,) = make_nodes(1)
+    work_pool = make_pool(node)
+    version = work_pool.version
+
+    def prepare_template():
+        raise Exception("Template failed")
+
+    # Miners carry on with the old template until preparing works again
+    work_pool.prepare_template = prepare_template
+    mine_block(node, bob_public_key, node.blocks[-1], [])
+    work_pool.update()
+    assert work_pool.version == version
+    assert node.metrics.counters["pool_template_errors"] == 1
+    work = work_pool.getwork()
+    assert work.version == version
+
+    work_pool.prepare_template = lambda: b.prepare_block_template(
+        node, alice_public_key
+    )
+    work_pool.update()
+    assert work_pool.templates[work_pool.version].prev_id == node.blocks[-1].id
+
+
+def test_pool_submits_blocks_when_preparing_fails():
+    (node,) = make_nodes(1)
+    work_pool = make_pool(node)
+    work = work_pool.getwork()
+
+    def prepare_template():
+        raise Exception("Template failed")
+
+    # The block still counts, miners just keep the old template
+    work_pool.prepare_template = prepare_template
+    results = [work_pool.submit(work.version, n) for n in range(work.start, work.end)]
+    assert "block" in results
+    assert len(node.blocks) == 2
+    assert node.metrics.counters["pool_template_errors"] >= 1
+
+
+def test_pool_limits_workers_templates_and_shares(monkeypatch):
+    monkeypatch.setattr(pool, "MAX_WORKERS", 2)
+    monkeypatch.setattr(pool, "MAX_TEMPLATES", 3)
+    monkeypatch.setattr(pool, "MAX_SHARES", 1)
+    (node,) = make_nodes(1)
+    work_pool = make_pool(node)
+
+    for port in range(3):
+        work_pool.register(("worker", port))
+    assert len(work_pool.workers) == 2
+    assert node.metrics.counters["pool_workers_refused"] == 1
+
+    # Only the newest templates on a tip are kept
+    for _ in range(5):
+        work_pool.refresh()
+    assert sorted(work_pool.templates) == [4, 5, 6]
+    assert sorted(work_pool.shares) == sorted(work_pool.nonce_ranges) == [4, 5, 6]
+
+    # Once a template has all the shares it can hold, miners get a new one
+    work = work_pool.getwork()
+    block = deepcopy(work.block)
+    nonces = []
+    for nonce in range(work.start, work.end):
+        block.nonce = nonce
+        if block.proof >= block.target:
+            nonces.append(nonce)
+    assert work_pool.submit(work.version, nonces[0]) == "share"
+    assert work_pool.submit(work.version, nonces[1]) == "stale"
+    assert work_pool.is_stale(work) is False and not work_pool.is_current(work)
+
+
+def test_pool_counts_wasted_work():
+    (node,) = make_nodes(1)
+    work_pool = make_pool(node)
+    work = work_pool.getwork()
+    mine_block(node, bob_public_key, node.blocks[-1], [])
+    work_pool.update()
+
+    assert work_pool.submit(work.version, work.start) == "stale"
+    stats = work_pool.stats()
+    assert stats["stale_shares"] == 1
+    assert stats["wasted_hashes"] == work.hashes_per_share
+
+
+def test_genesis_block_loads_with_known_nonce():
+    node = m.Node(address="")
+    genesis = b.load_genesis_block(node)
+    assert genesis.id == b.GENESIS_ID
+    assert genesis.proof < genesis.target
+    assert node.fetch_balance(alice_public_key) == node.get_block_subsidy()
+
+
+def test_block_ids_survive_serialization():
+    (node,) = make_nodes(1)
+    tx = send_tx(node, bob_private_key, alice_public_key, 10)
+    block = mine_block(node, alice_public_key, node.blocks[-1], [tx])
+
+    # Signing must not change how keys serialize
+    bob_private_key.sign(b"message")
+    assert u.deserialize(u.serialize(block)).id == block.id
+
+
+def test_connect_retries_with_backoff(monkeypatch):
+    node = m.Node(address=("node0", b.PORT))
+    attempts = []
+
+    def send_message(peer, command, data):
+        attempts.append(time.perf_counter())
+        if len(attempts) < 3:
+            raise ConnectionRefusedError()
+
+    monkeypatch.setattr(m.u, "send_message", send_message)
+    monkeypatch.setattr(m, "CONNECT_RETRY_IN_SECS", 0.01)
+    assert node.connect_with_retry(("node1", b.PORT))
+    assert node.pending_peers == [("node1", b.PORT)]
+
+    # Each wait is longer than the last
+    assert attempts[2] - attempts[1] > attempts[1] - attempts[0]
+
+    # Nodes never connect to themselves
+    assert node.connect_with_retry(node.address)
+    assert len(attempts) == 3
+
+
+def test_simulation_is_deterministic():
+    reports = [
+        simulator.Simulation(nodes=3, seed=1, tx_rate=2).run(blocks=5) for _ in range(2)
+    ]
+    assert reports[0] == reports[1]
+    assert reports[0]["converged"]
+    assert reports[0]["blocks"] == 5
+    assert 0 < reports[0]["propagation_p50"] <= reports[0]["propagation_p99"]
+
+
+def test_simulation_survives_reorgs():
+    # Latency on par with the block time forks the chain all the time
+    simulation = simulator.Simulation(nodes=8, seed=0, latency=1, tx_rate=2)
+    report = simulation.run(blocks=40)
+    assert report["blocks"] == 40
+    assert report["orphan_rate"] > 0
+
+    counters = [node.metrics.counters for node in simulation.nodes]
+    assert sum(counter["reorgs"] for counter in counters) > 0
+    assert sum(counter["pruned_branches"] for counter in counters) > 0
+
+    # Ties may be left standing, but everyone ends up with the most work
+    works = {u.total_work(node.blocks) for node in simulation.nodes}
+    assert len(works) == 1
+
+
+def test_simulated_pow_covers_halvings():
+    simulation = simulator.Simulation(
+        nodes=1, tx_rate=0, simulated_pow=True, hash_rate=2**20
+    )
+    report = simulation.run(blocks=b.HALVENING_INTERVAL)
+    assert report["subsidy"] == 25 * b.SATOSHIS_PER_COIN
+
+    # Difficulty settles around the hash rate
+    assert abs(report["bits"] - 20) <= 2
+    assert 0.5 < report["block_time"] < 2
+
+    # Only nodes in test mode take blocks nobody hashed
+    block = simulation.nodes[0].blocks[-1]
+    assert block.nonce == m.SIMULATED_NONCE
+    with pytest.raises(AssertionError):
+        m.Node(address="").validate_pow(block)
+
+
+def test_metrics_merge_thread_shards():
+    node_metrics = metrics.Metrics()
+
+    def record():
+        for _ in range(1000):
+            node_metrics.incr("messages")
+            node_metrics.observe("reorg_depth", 3, metrics.DEPTH_BUCKETS)
+
+    threads = [threading.Thread(target=record) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert len(node_metrics.shards) == 4
+    snapshot = node_metrics.snapshot()
+    assert snapshot["counters"]["messages"] == 4000
+    assert snapshot["histograms"]["reorg_depth"]["buckets"]["<=5"] == 4000
+
+    # Waiting on a held lock shows up in its histogram
+    lock = metrics.TimedLock(node_metrics)
+
+    def wait():
+        with lock:
+            pass
+
+    with lock:
+        waiter = threading.Thread(target=wait)
+        waiter.start()
+        time.sleep(0.01)
+    waiter.join()
+    wait = node_metrics.histograms["lock_wait_time"]
+    assert wait.count == 2 and wait.total >= 0.01
+
+
+def test_node_stats():
+    (node,) = make_nodes(1)
+    node.handle_tx(send_tx(node, bob_private_key, alice_public_key, 10))
+
+    stats = node.stats()
+    assert stats["height"] == 0
+    assert stats["mempool_txns"] == 1 and stats["mempool_bytes"] > 0
+    assert stats["utxos"] == 1
+    assert stats["branches"] == 0
+    assert stats["hash_rate"] == 0
+
+
+def test_profile_by_thread_name(tmp_path):
+    stopped = threading.Event()
+
+    def spin():
+        while not stopped.is_set():
+            sum(range(1000))
+
+    threading.Thread(target=spin, name="miner", daemon=True).start()
+    hooks = profiling.Hooks("node0", directory=str(tmp_path))
+    hooks.start("profile", 10)
+    time.sleep(0.1)
+    path = hooks.stop("profile").split()[-1]
+    stopped.set()
+
+    report = open(path).read()
+    assert "Thread miner" in report
+    assert "spin (bitcoin_tests.py" in report
+    assert hooks.stop("profile") == "profile not running"
+
+
+def test_trace_propagation(tmp_path):
+    now = [0]
+    clock = lambda: now[0]
+    node0 = tracing.TraceLog("node0", str(tmp_path / "node0.log"), clock)
+    node1 = tracing.TraceLog("node1", str(tmp_path / "node1.log"), clock)
+
+    # Untraced blocks are never logged
+    node1.record("untraced", "received")
+
+    node0.start("block")
+    now[0] = 1
+    trace = node0.relay("block", [("node1", b.PORT)])
+    assert trace == {"origin": "node0", "sender": "node0", "hops": 1}
+
+    for stage in ["received", "decoded", "validated", "connected"]:
+        now[0] += 2
+        node1.receive("block", trace)
+        node1.record("block", stage)
+    assert node1.relay("block", []) == {
+        "origin": "node0",
+        "sender": "node1",
+        "hops": 2,
+    }
+
+    entries = tracing.read_logs(
+        [str(tmp_path / "node0.log"), str(tmp_path / "node1.log")]
+    )
+    blocks, hops, percentiles, slow_hops = tracing.analyze(entries)
+    assert list(blocks) == ["block"]
+    assert hops["block", "node1"] == ("node0", 1)
+    assert percentiles["received"]["p50"] == 3
+    assert percentiles["connected"]["p50"] == 9
+    assert slow_hops == [(2, "node0", "node1", "block")]
+
+
+def test_unknown_commands_share_a_metric():
+    assert b.command_metric("tx") == "command_tx_time"
+    assert b.command_metric("x" * 1000) == "command_unknown_time"
+
+    # Every command the handler knows gets timed on its own
+    source = inspect.getsource(b.TCPHandler.handle_command)
+    handled = set(re.findall(r'command == "([a-z-]+)"', source))
+    assert handled <= set(b.COMMANDS)
+
+
+def test_log_rate_limit(caplog):
+    now = [0]
+    limit = logs.RateLimitFilter(rate=1, burst=2, clock=lambda: now[0])
+    make_record = lambda msg, *args: logging.LogRecord(
+        "models", logging.INFO, "models.py", 1, msg, args, None
+    )
+
+    # Heights share a message type, other messages have their own budget
+    assert [limit.filter(make_record("Height %d", h)) for h in range(4)] == [
+        True,
+        True,
+        False,
+        False,
+    ]
+    assert limit.filter(make_record("Created branch %d", 1))
+
+    now[0] = 1
+    record = make_record("Height %d", 5)
+    assert limit.filter(record)
+    assert record.suppressed == 2
+
+    # Hot paths pass their values as arguments, so the rate limit sees one type
+    (node,) = make_nodes(1)
+    work_pool = make_pool(node)
+    with caplog.at_level(logging.INFO, logger="pool"):
+        for port in range(2):
+            work_pool.register(("worker", port))
+    assert len({record.msg for record in caplog.records}) == 1
+
+    # Dropped counts and extra fields come out as key=value pairs
+    record.bits = "17->18"
+    formatter = logs.StructuredFormatter("%(message)s")
+    assert formatter.format(record) == "Height 5 suppressed=2 bits=17->18"
+
+
+def test_record_and_replay(tmp_path):
+    node, fresh = make_nodes(2)
+    recorder = recording.Recorder(str(tmp_path / "recording"))
+
+    # What the node received, a transaction and then a block confirming it
+    tx = send_tx(node, bob_private_key, alice_public_key, 10)
+    recorder.record("tx", tx)
+    node.handle_tx(tx)
+    block = mine_block(node, alice_public_key, node.blocks[-1], node.mempool)
+    recorder.record("compact-block", m.CompactBlock.from_block(block))
+    recorder.record("ping", "")
+    recorder.record("blocks", [block])
+
+    with open(tmp_path / "recording", "rb") as f:
+        results = recording.replay(fresh, u.read_items(f))
+    assert fresh.blocks == node.blocks
+    assert fresh.utxo_set.keys() == node.utxo_set.keys()
+    assert results["messages"] == 3
+    assert results["mempool_txns"] == 1
+    assert results["blocks"] == 1 and results["rejected_blocks"] == 1
+    assert results["blocks_per_sec"] > 0
+
+
+def test_benchmark_regressions():
+    baseline = {
+        "validate-tx": benchmarks.result("validate-tx", 1.0, 100),
+        "reorg-50": benchmarks.result("reorg-50", 1.0),
+    }
+    results = [
+        # Twice as many in 1.5x the time is faster per transaction
+        benchmarks.result("validate-tx", 1.5, 200),
+        benchmarks.result("reorg-50", 1.2),
+        benchmarks.result("sync-200", 9.0),
+    ]
+    assert benchmarks.compare(baseline, results, threshold=0.1) == ["reorg-50"]
+    assert benchmarks.compare(baseline, results, threshold=0.25) == []
@@ -0,0 +1,84 @@
+import atexit, collections, logging, logging.handlers, queue, threading, time
+
+FORMAT = "%(threadName)-6s | %(message)s"
+
+# Every message type, i.e. format string, may burst this many records and
+# then log LOG_RATE records per second
+LOG_RATE = 10
+LOG_BURST = 20
+
+# Message types we keep a token bucket for
+MAX_MESSAGE_TYPES = 1000
+
+# Attributes of every record, anything else was passed as `extra`
+RESERVED = set(vars(logging.makeLogRecord({}))) | {"message", "asctime"}
+
+
+class RateLimitFilter(logging.Filter):
+    # Counts what it drops, the next record let through carries the count
+    def __init__(self, rate=LOG_RATE, burst=LOG_BURST, clock=time.monotonic):
+        super().__init__()
+        self.rate = rate
+        self.burst = burst
+        self.clock = clock
+        self.buckets = collections.OrderedDict()
+        self.suppressed = collections.Counter()
+        self.mutex = threading.Lock()
+
+    def filter(self, record):
+        key = (record.name, record.msg)
+        now = self.clock()
+        with self.mutex:
+            tokens, last = self.buckets.pop(key, (self.burst, now))
+            tokens = min(self.burst, tokens + (now - last) * self.rate)
+            allowed = tokens >= 1
+            self.buckets[key] = (tokens - 1 if allowed else tokens, now)
+            if len(self.buckets) > MAX_MESSAGE_TYPES:
+                self.buckets.popitem(last=False)
+
+            if not allowed:
+                self.suppressed[key] += 1
+                return False
+            suppressed = self.suppressed.pop(key, 0)
+
+        if suppressed:
+            record.suppressed = suppressed
+        return True
+
+
+class StructuredFormatter(logging.Formatter):
+    # Appends fields passed as `extra` as key=value pairs
+    def format(self, record):
+        message = super().format(record)
+        fields = [
+            f"{key}={value}"
+            for key, value in vars(record).items()
+            if key not in RESERVED
+        ]
+        return " ".join([message] + fields)
+
+
+class AsyncHandler(logging.handlers.QueueHandler):
+    # Leaves formatting to the writer thread, so callers only pay for the
+    # queue. Arguments must not change after logging them.
+    def prepare(self, record):
+        return record
+
+
+def setup(level="INFO", stream=None):
+    root = logging.getLogger()
+    if any(isinstance(handler, AsyncHandler) for handler in root.handlers):
+        return
+
+    output = logging.StreamHandler(stream)
+    output.setFormatter(StructuredFormatter(FORMAT))
+    handler = AsyncHandler(queue.SimpleQueue())
+    handler.addFilter(RateLimitFilter())
+    listener = logging.handlers.QueueListener(handler.queue, output)
+    listener.start()
+
+    # Write out whatever is still queued when we exit
+    atexit.register(listener.stop)
+
+    root.addHandler(handler)
+    root.setLevel(level)
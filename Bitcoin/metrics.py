@@ -0,0 +1,118 @@
+import bisect, collections, contextlib, threading, time
+
+# Upper bounds (in seconds) of the latency histogram buckets
+LATENCY_BUCKETS = [0.0001, 0.001, 0.01, 0.1, 1, 10]
+
+# Upper bounds of histograms counting blocks, like reorg depths
+DEPTH_BUCKETS = [1, 2, 5, 10, 100]
+
+
+class Histogram:
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.total = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.total += value
+
+    def merge(self, other):
+        for index, count in enumerate(other.counts):
+            self.counts[index] += count
+        self.count += other.count
+        self.total += other.total
+
+    def summary(self):
+        labels = [f"<={bound}" for bound in self.buckets] + ["inf"]
+        return {
+            "count": self.count,
+            "total": self.total,
+            "mean": self.total / self.count if self.count else 0,
+            "buckets": dict(zip(labels, self.counts)),
+        }
+
+
+class Shard:
+    def __init__(self):
+        self.counters = collections.Counter()
+        self.histograms = {}
+
+
+class Metrics:
+    # Every thread writes to its own shard, so recording never takes a lock.
+    # Readers merge the shards, tolerating a write or two in flight.
+    def __init__(self):
+        self.local = threading.local()
+        self.shards = []
+        self.shards_lock = threading.Lock()
+
+    @property
+    def shard(self):
+        try:
+            return self.local.shard
+        except AttributeError:
+            self.local.shard = Shard()
+            with self.shards_lock:
+                self.shards.append(self.local.shard)
+            return self.local.shard
+
+    def incr(self, name, value=1):
+        self.shard.counters[name] += value
+
+    def observe(self, name, value, buckets=LATENCY_BUCKETS):
+        histograms = self.shard.histograms
+        if name not in histograms:
+            histograms[name] = Histogram(buckets)
+        histograms[name].observe(value)
+
+    @contextlib.contextmanager
+    def timer(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start)
+
+    @property
+    def counters(self):
+        counters = collections.Counter()
+        for shard in list(self.shards):
+            counters.update(shard.counters.copy())
+        return counters
+
+    @property
+    def histograms(self):
+        histograms = {}
+        for shard in list(self.shards):
+            for name, histogram in list(shard.histograms.items()):
+                if name not in histograms:
+                    histograms[name] = Histogram(histogram.buckets)
+                histograms[name].merge(histogram)
+        return histograms
+
+    def snapshot(self):
+        return {
+            "counters": dict(self.counters),
+            "histograms": {
+                name: histogram.summary() for name, histogram in self.histograms.items()
+            },
+        }
+
+
+class TimedLock:
+    # Records how long callers wait to get the lock
+    def __init__(self, metrics, name="lock_wait_time"):
+        self.lock = threading.Lock()
+        self.metrics = metrics
+        self.name = name
+
+    def __enter__(self):
+        start = time.perf_counter()
+        self.lock.acquire()
+        self.metrics.observe(self.name, time.perf_counter() - start)
+
+    def __exit__(self, *exc_info):
+        self.lock.release()
@@ -1,6 +1,7 @@
-import utils as u, hashlib, logging, time
+import utils as u, logs, metrics, network, recording, tracing, collections, collections.abc, hashlib, logging, threading, time
+from ecdsa import VerifyingKey, SECP256k1
 
-logging.basicConfig(level="INFO", format="%(threadName)-6s | %(message)s")
+logs.setup()
 logger = logging.getLogger(__name__)
 
 # In next iteration import these constants as environment variables
@@ -11,6 +12,35 @@ BLOCK_TIME_IN_SECS = 1
 BLOCKS_PER_DIFFICULTY_PERIOD = 5
 DIFFICULTY_PERIOD_IN_SECS = BLOCK_TIME_IN_SECS * BLOCKS_PER_DIFFICULTY_PERIOD
 
+# Side branches we stop tracking
+MAX_BRANCH_DEPTH = 2 * BLOCKS_PER_DIFFICULTY_PERIOD  # blocks behind the tip
+MAX_BRANCH_AGE_IN_SECS = 10 * DIFFICULTY_PERIOD_IN_SECS
+MAX_BRANCH_BLOCKS = 100
+
+# Blocks whose parent we haven't seen yet
+MAX_ORPHAN_BLOCKS = 100
+ORPHAN_EXPIRY_IN_SECS = 10 * DIFFICULTY_PERIOD_IN_SECS
+
+# Transactions whose inputs we haven't seen yet
+MAX_ORPHAN_TXNS = 100
+
+# Compact blocks waiting for their missing transactions
+MAX_PARTIAL_BLOCKS = 20
+
+# Nonce of blocks from a statistical mining backend, only test mode accepts them
+SIMULATED_NONCE = -1
+
+# Backoff for peers which aren't listening yet
+CONNECT_RETRY_IN_SECS = 0.1
+MAX_CONNECT_RETRY_IN_SECS = 5
+CONNECT_ATTEMPTS = 20
+
+# Signatures already verified, e.g. ahead of time by the block pipeline
+MAX_SIGNATURE_CACHE = 10_000
+
+# Published UTXO snapshots are layers of changes, flattened every this many
+MAX_SNAPSHOT_DEPTH = 16
+
 
 class Tx:
     def __init__(self, id, tx_ins, tx_outs):
@@ -20,7 +50,7 @@ class Tx:
 
     def sign_input(self, index, private_key):
         message = u.spend_message(self, index)
-        signature = private_key.sign(message)
+        signature = private_key.sign_deterministic(message)
         self.tx_ins[index].signature = signature
 
     def verify_input(self, index, public_key):
@@ -58,6 +88,19 @@ class TxOut:
     def outpoint(self):
         return (self.tx_id, self.index)
 
+    def __getstate__(self):
+        # Pickled keys drag along curve precomputation which grows as keys
+        # get used, so keep the raw key to make serialized blocks stable
+        state = self.__dict__.copy()
+        state["public_key"] = self.public_key.to_string()
+        return state
+
+    def __setstate__(self, state):
+        # setattr interns the names, which keeps the pickle memo the same
+        for name, value in state.items():
+            setattr(self, name, value)
+        self.public_key = VerifyingKey.from_string(self.public_key, curve=SECP256k1)
+
 
 class Block:
     def __init__(self, txns, prev_id, nonce, bits, timestamp):
@@ -91,30 +134,392 @@ class Block:
         return f"Block(prev_id={prev_id}... id={self.id[:10]}...)"
 
 
+class BlockHeader:
+    # What's left of a block once its transactions are pruned
+    def __init__(self, id, prev_id, nonce, bits, timestamp):
+        self.id = id
+        self.prev_id = prev_id
+        self.nonce = nonce
+        self.bits = bits
+        self.timestamp = timestamp
+        self.txns = None
+
+    @classmethod
+    def from_block(cls, block):
+        return cls(
+            id=block.id,
+            prev_id=block.prev_id,
+            nonce=block.nonce,
+            bits=block.bits,
+            timestamp=block.timestamp,
+        )
+
+    @property
+    def target(self):
+        return 2 ** (256 - self.bits)
+
+    def __eq__(self, other):
+        return self.id == other.id
+
+    def __repr__(self):
+        prev_id = self.prev_id[:10] if self.prev_id else None
+        return f"BlockHeader(prev_id={prev_id}... id={self.id[:10]}...)"
+
+
+class CompactBlock:
+    def __init__(
+        self, block_id, prev_id, nonce, bits, timestamp, coinbase, short_ids, trace=None
+    ):
+        self.block_id = block_id
+        self.prev_id = prev_id
+        self.nonce = nonce
+        self.bits = bits
+        self.timestamp = timestamp
+        self.coinbase = coinbase
+        self.short_ids = short_ids
+        # Propagation trace metadata, not part of the block
+        self.trace = trace
+
+    @classmethod
+    def from_block(cls, block):
+        return cls(
+            block_id=block.id,
+            prev_id=block.prev_id,
+            nonce=block.nonce,
+            bits=block.bits,
+            timestamp=block.timestamp,
+            coinbase=block.txns[0],
+            short_ids=[u.short_id(tx.id) for tx in block.txns[1:]],
+        )
+
+    def to_block(self, txns):
+        return Block(
+            txns=txns,
+            prev_id=self.prev_id,
+            nonce=self.nonce,
+            bits=self.bits,
+            timestamp=self.timestamp,
+        )
+
+    def __repr__(self):
+        return (
+            f"CompactBlock(id={self.block_id[:10]}... txns={len(self.short_ids) + 1})"
+        )
+
+
+class UTXOView(collections.abc.MutableMapping):
+    # Cache on top of a UTXO set, writes stay here until committed
+    def __init__(self, base):
+        self.base = base
+        self.cache = {}
+        self.spent = set()
+
+    def __getitem__(self, outpoint):
+        if outpoint in self.cache:
+            return self.cache[outpoint]
+        if outpoint in self.spent:
+            raise KeyError(outpoint)
+        return self.base[outpoint]
+
+    def __setitem__(self, outpoint, tx_out):
+        self.spent.discard(outpoint)
+        self.cache[outpoint] = tx_out
+
+    def __delitem__(self, outpoint):
+        if outpoint not in self:
+            raise KeyError(outpoint)
+        self.cache.pop(outpoint, None)
+        if outpoint in self.base:
+            self.spent.add(outpoint)
+
+    def __iter__(self):
+        yield from self.cache
+        for outpoint in self.base:
+            if outpoint not in self.spent and outpoint not in self.cache:
+                yield outpoint
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+    def commit(self):
+        for outpoint in self.spent:
+            del self.base[outpoint]
+        self.base.update(self.cache)
+        return self.base
+
+
+class UTXOSet(dict):
+    # Remembers which outpoints changed since the last snapshot
+    def __init__(self, *args):
+        super().__init__(*args)
+        self.changed = set()
+
+    def __setitem__(self, outpoint, tx_out):
+        super().__setitem__(outpoint, tx_out)
+        self.changed.add(outpoint)
+
+    def __delitem__(self, outpoint):
+        super().__delitem__(outpoint)
+        self.changed.add(outpoint)
+
+    def pop(self, outpoint, *default):
+        self.changed.add(outpoint)
+        return super().pop(outpoint, *default)
+
+    def update(self, other):
+        super().update(other)
+        self.changed.update(other)
+
+    def snapshot(self, parent):
+        # Only the changes since the parent, unless there are too many layers
+        if parent.depth >= MAX_SNAPSHOT_DEPTH:
+            snapshot = UTXOSnapshot(dict(self))
+        else:
+            changes = {outpoint: self.get(outpoint) for outpoint in self.changed}
+            snapshot = UTXOSnapshot(changes, parent)
+        self.changed = set()
+        return snapshot
+
+
+class UTXOSnapshot(collections.abc.Mapping):
+    # Frozen UTXO set, the changes of one publish on top of the snapshot
+    # before it. Spent outputs map to None.
+    def __init__(self, changes, parent=None):
+        self.changes = changes
+        self.parent = parent
+        if parent is None:
+            self.depth, self.size = 0, len(changes)
+        else:
+            self.depth, self.size = parent.depth + 1, parent.size
+            for outpoint, tx_out in changes.items():
+                self.size += (tx_out is not None) - (outpoint in parent)
+
+    def __getitem__(self, outpoint):
+        layer = self
+        while layer is not None:
+            if outpoint in layer.changes:
+                tx_out = layer.changes[outpoint]
+                if tx_out is None:
+                    break
+                return tx_out
+            layer = layer.parent
+        raise KeyError(outpoint)
+
+    def items(self):
+        # Upper layers are small, so only remember what they shadow
+        shadowed = set()
+        layer = self
+        while layer.parent is not None:
+            for outpoint, tx_out in layer.changes.items():
+                if outpoint not in shadowed:
+                    shadowed.add(outpoint)
+                    if tx_out is not None:
+                        yield outpoint, tx_out
+            layer = layer.parent
+        for outpoint, tx_out in layer.changes.items():
+            if outpoint not in shadowed:
+                yield outpoint, tx_out
+
+    def values(self):
+        return (tx_out for _, tx_out in self.items())
+
+    def __iter__(self):
+        return (outpoint for outpoint, _ in self.items())
+
+    def __len__(self):
+        return self.size
+
+
+class SignatureCache:
+    def __init__(self, maxsize=MAX_SIGNATURE_CACHE):
+        self.maxsize = maxsize
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def key(self, tx, index, public_key):
+        # Commit to everything verification looked at
+        message = u.spend_message(tx, index)
+        signature = tx.tx_ins[index].signature
+        return hashlib.sha256(message + signature + public_key.to_string()).digest()
+
+    def add(self, tx, index, public_key):
+        key = self.key(tx, index, public_key)
+        with self.lock:
+            self.entries[key] = True
+            if len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+
+    def contains(self, tx, index, public_key):
+        key = self.key(tx, index, public_key)
+        with self.lock:
+            return key in self.entries
+
+
+class ChainView:
+    # Read-only snapshot of chain state, replaced wholesale by the writer
+    def __init__(self, version, blocks, utxo_set, mempool):
+        self.version = version
+        self.blocks = blocks
+        self.utxo_set = utxo_set
+        self.mempool = mempool
+
+    @property
+    def height(self):
+        return len(self.blocks) - 1
+
+    def fetch_utxos(self, public_key):
+        return [
+            tx_out
+            for tx_out in self.utxo_set.values()
+            if tx_out.public_key == public_key
+        ]
+
+    def fetch_balance(self, public_key):
+        return sum([tx_out.amount for tx_out in self.fetch_utxos(public_key)])
+
+    def find_sync_blocks(self, peer_block_ids):
+        # Find our most recent block peer doesn't know about,
+        # But which build off a block they do know about.
+        for height in range(len(self.blocks) - 1, -1, -1):
+            block = self.blocks[height]
+            if block.id not in peer_block_ids and block.prev_id in peer_block_ids:
+                return list(self.blocks[height : height + GET_BLOCKS_CHUNK])
+
+    def fetch_blocks(self, start, count):
+        return list(self.blocks[start : start + count])
+
+    def memory_by_depth(self):
+        # Serialized size of the chain, bucketed by depth below the tip
+        report = {}
+        for height, block in enumerate(self.blocks):
+            depth = len(self.blocks) - 1 - height
+            bucket = f"{10 ** len(str(depth)) // 10}+" if depth else "0"
+            entry = report.setdefault(bucket, {"blocks": 0, "pruned": 0, "bytes": 0})
+            entry["blocks"] += 1
+            entry["pruned"] += block.txns is None
+            entry["bytes"] += len(u.serialize(block))
+        return report
+
+
 class Node:
-    def __init__(self, address):
+    def __init__(
+        self,
+        address,
+        prune_depth=None,
+        assume_valid=None,
+        assume_valid_height=None,
+        clock=time.time,
+        simulated_pow=False,
+    ):
         self.blocks = []
+        self.heights = {}
         self.branches = []
-        self.utxo_set = {}
+        self.utxo_set = UTXOSet()
         self.mempool = []
+        self.partial_blocks = collections.OrderedDict()
+        self.orphans = {}
+        self.orphan_txns = collections.OrderedDict()
+        self.orphan_txns_by_outpoint = {}
+        self.sig_cache = SignatureCache()
         self.peers = []
+        self.synced = threading.Event()
+        # Peers asked to sync which haven't run out of blocks for us yet
+        self.syncing = set()
         self.pending_peers = []
         self.address = address
+        self.clock = clock
+        self.simulated_pow = simulated_pow
+        self.metrics = metrics.Metrics()
+        self.broadcaster = network.Broadcaster()
+        self.peer_directory = network.PeerDirectory(self.metrics)
+        self.tracer = tracing.TraceLog(clock=clock)
+        self.recorder = recording.Recorder(clock=clock)
+        self.view = ChainView(0, (), UTXOSnapshot({}), ())
+
+        # Pruned nodes only keep transactions of the last prune_depth blocks
+        self.prune_depth = prune_depth
+        self.pruned_height = -1
+        self.undo = {}
+
+        # Signatures of blocks up to this trusted block id and its height
+        # aren't verified, but only until we caught up with our peers
+        assert (assume_valid is None) == (assume_valid_height is None)
+        self.assume_valid = assume_valid
+        self.assume_valid_height = assume_valid_height
+        self.skipped_signatures = 0
+        # Inputs we skipped, by block, until the assumed-valid block shows up
+        self.unverified = {}
+
+    def stats(self):
+        view = self.view
+        counters = self.metrics.counters
+        mining_seconds = counters["mining_seconds"]
+        return {
+            "height": view.height,
+            "mempool_txns": len(view.mempool),
+            "mempool_bytes": sum(len(u.serialize(tx)) for tx in view.mempool),
+            "utxos": len(view.utxo_set),
+            "branches": len(self.branches),
+            "hash_rate": (
+                counters["mining_hashes"] / mining_seconds if mining_seconds else 0
+            ),
+            "metrics": self.metrics.snapshot(),
+        }
+
+    def publish_view(self, utxos_changed=True):
+        # Readers keep whatever view they grabbed, UTXOs are published as a
+        # layer with what changed since the last view
+        utxo_set = self.view.utxo_set
+        if utxos_changed:
+            utxo_set = self.utxo_set.snapshot(utxo_set)
+        self.view = ChainView(
+            version=self.view.version + 1,
+            blocks=tuple(self.blocks),
+            utxo_set=utxo_set,
+            mempool=tuple(self.mempool),
+        )
 
     def connect(self, peer):
-        if peer not in self.peers and peer != self.address:
-            logger.info(f'(handshake) Sent "connect" to {peer[0]}')
-            try:
-                u.send_message(peer, "connect", None)
-                self.pending_peers.append(peer)
-            except:
-                logger.info(f"(handshake) Node {peer[0]} offline")
-
-    def sync(self):
-        blocks = self.blocks[-GET_BLOCKS_CHUNK:]
+        if peer in self.peers or peer == self.address:
+            return True
+        logger.info(f'(handshake) Sent "connect" to {peer[0]}')
+        try:
+            self.send(peer, "connect", self.address)
+            self.pending_peers.append(peer)
+            return True
+        except:
+            logger.info("(handshake) Node %s offline", peer[0])
+            return False
+
+    def connect_with_retry(self, peer, attempts=CONNECT_ATTEMPTS):
+        # Peers starting alongside us may not be listening yet
+        delay = CONNECT_RETRY_IN_SECS
+        for _ in range(attempts):
+            if self.connect(peer):
+                return True
+            time.sleep(delay)
+            delay = min(delay * 2, MAX_CONNECT_RETRY_IN_SECS)
+        return False
+
+    def send(self, peer, command, data):
+        u.send_message(peer, command, data)
+
+    def sync(self, blocks=None, peers=None):
+        # Ask for whatever comes after our tip, or after the given blocks
+        if blocks is None:
+            blocks = self.blocks[-GET_BLOCKS_CHUNK:]
+        if peers is None:
+            peers = self.peers
         block_ids = [block.id for block in blocks]
-        for peer in self.peers:
-            u.send_message(peer, "sync", block_ids)
+        for peer in peers:
+            self.syncing.add(peer)
+            self.send(peer, "sync", block_ids)
+
+    def sync_done(self, peer):
+        # Caught up once every peer we asked has nothing more to send
+        self.syncing.discard(peer)
+        if not self.syncing:
+            self.synced.set()
 
     def fetch_utxos(self, public_key):
         return [
@@ -123,15 +528,21 @@ class Node:
             if tx_out.public_key == public_key
         ]
 
-    def connect_tx(self, tx):
-        # Remove utxos that were just spent
+    def apply_tx(self, utxo_set, tx):
+        # Spend inputs and create outputs, returning what was spent
+        spent = []
         if not tx.is_coinbase:
             for tx_in in tx.tx_ins:
-                del self.utxo_set[tx_in.outpoint]
-
-        # Save utxos which were just created
+                spent.append(utxo_set.pop(tx_in.outpoint))
         for tx_out in tx.tx_outs:
-            self.utxo_set[tx_out.outpoint] = tx_out
+            utxo_set[tx_out.outpoint] = tx_out
+        return spent
+
+    def connect_tx(self, tx):
+        # Update utxos, remembering the spent ones for reorgs
+        spent = self.apply_tx(self.utxo_set, tx)
+        if not tx.is_coinbase:
+            self.undo[tx.id] = spent
 
         # Clean up mempool
         if tx in self.mempool:
@@ -140,18 +551,17 @@ class Node:
     def disconnect_tx(self, tx):
         # Add back UTXOs spent by this transaction
         if not tx.is_coinbase:
-            for tx_in in tx.tx_ins:
-                tx_out = u.tx_in_to_tx_out(tx_in, self.blocks)
+            for tx_out in self.undo[tx.id]:
                 self.utxo_set[tx_out.outpoint] = tx_out
 
         # Remove UTXOs created by this transaction
         for tx_out in tx.tx_outs:
             del self.utxo_set[tx_out.outpoint]
 
-        # Put it back in mempool
+        # Put it back in mempool, ahead of anything spending it
         if tx not in self.mempool and not tx.is_coinbase:
-            self.mempool.append(tx)
-            logging.info(f"Added tx to mempool")
+            self.mempool.insert(0, tx)
+            logging.info("Added tx to mempool")
 
     def fetch_balance(self, public_key):
         # Fetch utxos associated with this public key
@@ -159,19 +569,27 @@ class Node:
         # Sum the amounts
         return sum([tx_out.amount for tx_out in utxos])
 
-    def validate_tx(self, tx):
+    def validate_tx(self, tx, utxo_set=None, skipped=None):
+        if utxo_set is None:
+            utxo_set = self.utxo_set
+
         in_sum = 0
         out_sum = 0
         for index, tx_in in enumerate(tx.tx_ins):
             # TxIn spending an unspent output
-            assert tx_in.outpoint in self.utxo_set
+            assert tx_in.outpoint in utxo_set
 
             # Grab the tx_out
-            tx_out = self.utxo_set[tx_in.outpoint]
+            tx_out = utxo_set[tx_in.outpoint]
 
-            # Verify signature using public key of TxOut we're spending
+            # Verify signature using public key of TxOut we're spending,
+            # or just note it down when skipping signatures
             public_key = tx_out.public_key
-            tx.verify_input(index, public_key)
+            if skipped is None:
+                self.verify_input(tx, index, public_key)
+            else:
+                self.skipped_signatures += 1
+                skipped.append((tx, index, public_key))
 
             # Sum up the total inputs
             amount = tx_out.amount
@@ -184,28 +602,114 @@ class Node:
         # Check no value created or destroyed
         assert in_sum >= out_sum
 
+    def verify_input(self, tx, index, public_key):
+        if self.sig_cache.contains(tx, index, public_key):
+            self.metrics.incr("signature_cache_hits")
+            return
+        with self.metrics.timer("signature_verification_time"):
+            tx.verify_input(index, public_key)
+        self.sig_cache.add(tx, index, public_key)
+
     def validate_coinbase(self, block):
         tx = block.txns[0]
         assert len(tx.tx_ins) == len(tx.tx_outs) == 1
         fees = self.calculate_fees(block.txns[1:])
         assert tx.tx_outs[0].amount == self.get_block_subsidy() + fees
 
+    def mempool_utxo_set(self):
+        # Confirmed utxos plus those created by the mempool, dropping
+        # transactions whose inputs are gone along with their descendants
+        utxo_set = UTXOView(self.utxo_set)
+        mempool = []
+        for tx in self.mempool:
+            if all(tx_in.outpoint in utxo_set for tx_in in tx.tx_ins):
+                self.apply_tx(utxo_set, tx)
+                mempool.append(tx)
+            else:
+                self.metrics.incr("mempool_txns_evicted")
+        self.mempool = mempool
+        return utxo_set
+
+    def spent_in_mempool(self, outpoints):
+        for tx in self.mempool:
+            for tx_in in tx.tx_ins:
+                if tx_in.outpoint in outpoints:
+                    return True
+        return False
+
     def handle_tx(self, tx):
-        if tx not in self.mempool:
-            self.validate_tx(tx)
-            self.mempool.append(tx)
+        if tx in self.mempool or tx.id in self.orphan_txns:
+            return
 
-            # Propogate transaction
-            for peer in self.peers:
-                u.send_message(peer, "tx", tx)
+        # Parents may still be on their way, so wait for them
+        utxo_set = self.mempool_utxo_set()
+        missing = [
+            tx_in.outpoint for tx_in in tx.tx_ins if tx_in.outpoint not in utxo_set
+        ]
+        if missing and not self.spent_in_mempool(missing):
+            self.add_orphan_tx(tx, missing)
+            return
+
+        self.validate_tx(tx, utxo_set)
+        self.mempool.append(tx)
+        self.publish_view(utxos_changed=False)
+
+        # Propogate transaction
+        self.broadcaster.broadcast(self.peers, "tx", tx, key=tx.id)
+
+        self.accept_orphan_txns(tx)
+
+    def add_orphan_tx(self, tx, missing):
+        # Make room by evicting the oldest
+        while len(self.orphan_txns) >= MAX_ORPHAN_TXNS:
+            _, (orphan, _) = self.orphan_txns.popitem(last=False)
+            self.remove_orphan_tx(orphan)
+            self.metrics.incr("orphan_txns_evicted")
+
+        self.orphan_txns[tx.id] = (tx, missing)
+        for outpoint in missing:
+            self.orphan_txns_by_outpoint.setdefault(outpoint, []).append(tx)
+        self.metrics.incr("orphan_txns_added")
+        logger.info("Stored orphan tx, missing %d inputs", len(missing))
+
+    def remove_orphan_tx(self, tx):
+        _, missing = self.orphan_txns.pop(tx.id, (None, []))
+        for outpoint in missing:
+            orphans = self.orphan_txns_by_outpoint.get(outpoint, [])
+            orphans[:] = [orphan for orphan in orphans if orphan.id != tx.id]
+            if not orphans:
+                self.orphan_txns_by_outpoint.pop(outpoint, None)
+
+    def accept_orphan_txns(self, tx):
+        # Retry orphans waiting on one of this transaction's outputs
+        for tx_out in tx.tx_outs:
+            for orphan in self.orphan_txns_by_outpoint.get(tx_out.outpoint, [])[:]:
+                self.remove_orphan_tx(orphan)
+                self.metrics.incr("orphan_txns_retried")
+                try:
+                    self.handle_tx(orphan)
+                except:
+                    logger.info("Rejected orphan tx")
+
+    def validate_pow(self, block):
+        if self.simulated_pow and block.nonce == SIMULATED_NONCE:
+            return
+        assert block.proof < block.target, "Insufficient Proof-of-Work"
+
+    def check_block(self, block):
+        # Checks which don't depend on chain state
+        self.validate_pow(block)
+        assert block.txns and block.txns[0].is_coinbase, "Missing coinbase"
+        for tx in block.txns[1:]:
+            assert tx.tx_ins and not tx.is_coinbase, "Unexpected coinbase"
 
     def validate_block(self, block, validate_txns=False):
-        assert block.proof < block.target, "Insufficient Proof-of-Work"
+        self.validate_pow(block)
 
         if validate_txns:
             # Check block timestamps cannot be too far in future
             assert (
-                block.timestamp - time.time() < DIFFICULTY_PERIOD_IN_SECS
+                block.timestamp - self.clock() < DIFFICULTY_PERIOD_IN_SECS
             ), "Block too far in future"
 
             # Block timestamps must advance every block period
@@ -220,9 +724,60 @@ class Node:
             # Validate coinbase separately
             self.validate_coinbase(block)
 
-            # Check the transactions are valid
+            # Check the transactions are valid, later ones may spend earlier ones
+            skipped = [] if self.skips_signatures(len(self.blocks)) else None
+            utxo_set = UTXOView(self.utxo_set)
             for tx in block.txns[1:]:
-                self.validate_tx(tx)
+                self.validate_tx(tx, utxo_set, skipped)
+                self.apply_tx(utxo_set, tx)
+            if skipped:
+                self.unverified[block.id] = skipped
+
+    def find_block(self, block_id):
+        if block_id in self.heights:
+            return self.blocks[self.heights[block_id]]
+        branch, _, height = self.find_in_branch(block_id)
+        if branch:
+            return branch[height]
+
+    def reconstruct_block(self, compact):
+        # Fill in every transaction we already hold in our mempool
+        mempool = {u.short_id(tx.id): tx for tx in self.mempool}
+        txns = [compact.coinbase]
+        txns += [mempool.get(short_id) for short_id in compact.short_ids]
+
+        # Remember what we have and ask for the rest
+        missing = [index for index, tx in enumerate(txns) if tx is None]
+        if missing:
+            # Replies may never come, so only wait on the most recent blocks
+            self.partial_blocks[compact.block_id] = (compact, txns)
+            self.partial_blocks.move_to_end(compact.block_id)
+            while len(self.partial_blocks) > MAX_PARTIAL_BLOCKS:
+                self.partial_blocks.popitem(last=False)
+                self.metrics.incr("partial_blocks_evicted")
+            return None, missing
+
+        return self.assemble_block(compact, txns), []
+
+    def fill_block(self, block_id, txns):
+        compact, partial = self.partial_blocks.pop(block_id)
+        missing = [index for index, tx in enumerate(partial) if tx is None]
+        assert len(missing) == len(txns), "Wrong number of block transactions"
+        for index, tx in zip(missing, txns):
+            assert u.short_id(tx.id) == compact.short_ids[index - 1]
+            partial[index] = tx
+        return self.assemble_block(compact, partial)
+
+    def assemble_block(self, compact, txns):
+        block = compact.to_block(txns)
+        # Short id collisions would produce a different block
+        assert block.id == compact.block_id, "Compact block reconstruction failed"
+        return block
+
+    def fetch_block_txns(self, block_id, indexes):
+        block = self.find_block(block_id)
+        assert block.txns is not None, "Block transactions pruned"
+        return [block.txns[index] for index in indexes]
 
     def find_in_branch(self, block_id):
         for branch_index, branch in enumerate(self.branches):
@@ -231,11 +786,103 @@ class Node:
                     return branch, branch_index, height
         return None, None, None
 
+    def find_height(self, block_id):
+        return self.heights.get(block_id)
+
+    def prune_branches(self):
+        tip = self.blocks[-1]
+        tip_height = len(self.blocks) - 1
+
+        # Drop branches too far behind the tip, or too old
+        pruned = []
+        heights = {}
+        for index, branch in enumerate(self.branches):
+            # Every branch forks off our chain, anything else is unreachable
+            fork_height = self.find_height(branch[0].prev_id)
+            if fork_height is None:
+                pruned.append(index)
+                continue
+            branch_tip_height = fork_height + len(branch)
+            too_deep = tip_height - branch_tip_height > MAX_BRANCH_DEPTH
+            too_old = tip.timestamp - branch[-1].timestamp > MAX_BRANCH_AGE_IN_SECS
+            if too_deep or too_old:
+                pruned.append(index)
+            else:
+                heights[index] = branch_tip_height
+
+        # Stay within budget, keeping the highest branches. Branches share
+        # the blocks before they split, which only count once.
+        kept = set()
+        for index in sorted(heights, key=heights.get, reverse=True):
+            block_ids = {block.id for block in self.branches[index]} - kept
+            if len(kept) + len(block_ids) > MAX_BRANCH_BLOCKS:
+                pruned.append(index)
+            else:
+                kept |= block_ids
+
+        for index in pruned:
+            self.metrics.incr("pruned_branches")
+            self.metrics.incr("pruned_branch_blocks", len(self.branches[index]))
+        if pruned:
+            self.branches = [
+                branch
+                for index, branch in enumerate(self.branches)
+                if index not in pruned
+            ]
+            logger.info("Pruned %d stale branches", len(pruned))
+
+    def add_orphan(self, block):
+        now = self.clock()
+        orphans = [
+            (received, orphan)
+            for siblings in self.orphans.values()
+            for orphan, received in siblings
+        ]
+        orphans.sort(key=lambda item: item[0])
+
+        # Expire orphans whose parent never showed up, then evict the oldest
+        for index, (received, orphan) in enumerate(orphans):
+            if now - received > ORPHAN_EXPIRY_IN_SECS:
+                self.remove_orphan(orphan)
+                self.metrics.incr("orphan_blocks_expired")
+            elif len(orphans) - index >= MAX_ORPHAN_BLOCKS:
+                self.remove_orphan(orphan)
+                self.metrics.incr("orphan_blocks_evicted")
+
+        self.orphans.setdefault(block.prev_id, []).append((block, now))
+        self.metrics.incr("orphan_blocks_added")
+        logger.info("Stored orphan block %s...", block.id[:10])
+
+    def remove_orphan(self, block):
+        siblings = self.orphans[block.prev_id]
+        siblings[:] = [item for item in siblings if item[0] != block]
+        if not siblings:
+            del self.orphans[block.prev_id]
+
+    def is_orphan(self, block_id):
+        for siblings in self.orphans.values():
+            for orphan, _ in siblings:
+                if orphan.id == block_id:
+                    return True
+        return False
+
+    def connect_orphans(self, block):
+        # Children that were waiting on this block, in arrival order
+        for orphan, _ in self.orphans.pop(block.id, []):
+            self.metrics.incr("orphan_blocks_connected")
+            try:
+                self.handle_block(orphan)
+            except:
+                logger.info("Rejected orphan block")
+
     def handle_block(self, block):
+        # Whatever transactions we asked for, we have the block now
+        self.partial_blocks.pop(block.id, None)
+
         # Ignore if we've already seen it
-        found_in_chain = block in self.blocks
+        found_in_chain = block.id in self.heights
         found_in_branch = self.find_in_branch(block.id)[0] is not None
-        if found_in_chain or found_in_branch:
+        if found_in_chain or found_in_branch or self.is_orphan(block.id):
             raise Exception("Received duplicate block")
 
         # Look up previous block
@@ -243,9 +890,7 @@ class Node:
 
         # Conditions
         extends_chain = block.prev_id == self.blocks[-1].id
-        forks_chain = not extends_chain and block.prev_id in [
-            block.id for block in self.blocks
-        ]
+        forks_chain = not extends_chain and block.prev_id in self.heights
         extends_branch = branch and height == len(branch) - 1
         forks_branch = branch and height != len(branch) - 1
 
@@ -253,85 +898,262 @@ class Node:
         self.validate_block(block, validate_txns=extends_chain)
 
         # Handle each condition separately
+        connected = []
         if extends_chain:
             self.connect_block(block)
-            logger.info(f"Extended chain to height {len(self.blocks)-1}")
+            connected = [block]
+            self.prune_blocks()
+            self.publish_view()
+            self.tracer.record(block.id, "connected")
+            logger.info("Extended chain to height %d", len(self.blocks) - 1)
         elif forks_chain:
             self.branches.append([block])
-            logger.info(f"Created branch {len(self.branches)}")
+            logger.info("Created branch %d", len(self.branches))
         elif extends_branch:
             branch.append(block)
-            logger.info(f"Extended branch {branch_index} to {len(branch)}")
+            logger.info("Extended branch %d to %d", branch_index, len(branch))
 
             # Reorg if branch now has more work than main chain
-
-            chain_ids = [block.id for block in self.blocks]
-            fork_height = chain_ids.index(branch[0].prev_id)
+            fork_height = self.heights[branch[0].prev_id]
             chain_since_fork = self.blocks[fork_height + 1 :]
             if u.total_work(branch) > u.total_work(chain_since_fork):
-                logger.info(f"Reorging to branch {branch_index}")
-                self.reorg(branch, branch_index)
+                logger.info("Reorging to branch %d", branch_index)
+                if self.reorg(branch, branch_index):
+                    connected = branch
+                    self.prune_blocks()
+                    self.publish_view()
+                    self.tracer.record(block.id, "connected", reorg=True)
         elif forks_branch:
             self.branches.append(branch[: height + 1] + [block])
             logger.info(
-                f"Created branch {len(self.branches)-1} to height {len(self.branches[-1]) - 1}"
+                "Created branch %d to height %d",
+                len(self.branches) - 1,
+                len(self.branches[-1]) - 1,
             )
         else:
+            # Hold on to it until its parent arrives
+            self.add_orphan(block)
             self.sync()
-            raise Exception("Encountered block with unknown parent. Syncing.")
+            return
 
-        # Block propogation
-        for peer in self.peers:
-            u.disrupt(func=u.send_message, args=[peer, "blocks", [block]])
+        if connected and not self.check_assume_valid():
+            raise Exception("Invalid signature below assumed-valid height")
 
-    def reorg(self, branch, branch_index):
-        # Disconnect to fork block, preserving as a branch
-        disconnected_blocks = []
-        while self.blocks[-1].id != branch[0].prev_id:
-            block = self.blocks.pop()
-            for tx in block.txns:
-                self.disconnect_tx(tx)
-            disconnected_blocks.insert(0, block)
+        self.prune_branches()
 
-        # Replace branch with newly disconnected blocks
-        self.branches[branch_index] = disconnected_blocks
+        # Block propogation, peers rebuild the rest from their mempools
+        compact = CompactBlock.from_block(block)
+        compact.trace = self.tracer.relay(block.id, self.peers)
+        self.broadcaster.broadcast(
+            self.peers, "compact-block", compact, key=block.id, disrupt=True
+        )
 
-        # Connect branch, rollback if error encountered
-        for block in branch:
-            try:
+        # Newly confirmed transactions may be what orphan transactions wait on
+        for connected_block in connected:
+            for tx in connected_block.txns:
+                self.accept_orphan_txns(tx)
+
+        self.connect_orphans(block)
+
+    def reorg(self, branch, branch_index):
+        # Apply everything to a layer above the real state
+        blocks, utxo_set, mempool = self.blocks, self.utxo_set, self.mempool
+        heights, undo = self.heights, self.undo
+        self.blocks = list(blocks)
+        self.heights = dict(heights)
+        self.utxo_set = UTXOView(utxo_set)
+        self.mempool = list(mempool)
+        self.undo = collections.ChainMap({}, undo)
+
+        height = len(branch)
+        try:
+            # Disconnect to fork block, preserving as a branch
+            disconnected_blocks = []
+            while self.blocks[-1].id != branch[0].prev_id:
+                block = self.blocks.pop()
+                del self.heights[block.id]
+                for tx in reversed(block.txns):
+                    self.disconnect_tx(tx)
+                disconnected_blocks.insert(0, block)
+
+            # Connect branch
+            for height, block in enumerate(branch):
                 self.validate_block(block, validate_txns=True)
                 self.connect_block(block)
-            except:
-                self.reorg(disconnected_blocks, branch_index)
-                logger.info(f"Reorg failed")
-                return
+        except:
+            # Throw the layer away and forget the invalid part of the branch
+            self.blocks, self.utxo_set, self.mempool = blocks, utxo_set, mempool
+            self.heights, self.undo = heights, undo
+            del branch[height:]
+            if not branch:
+                del self.branches[branch_index]
+            self.metrics.incr("reorgs_failed")
+            logger.info("Reorg failed")
+            return False
+
+        # Commit the layer and replace branch with newly disconnected blocks
+        self.utxo_set = self.utxo_set.commit()
+        undo.update(self.undo.maps[0])
+        self.undo = undo
+        self.reanchor_branches(disconnected_blocks)
+        self.branches[branch_index] = disconnected_blocks
+
+        # Transactions put back may spend coinbases which are gone now
+        self.mempool_utxo_set()
+        self.metrics.incr("reorgs")
+        self.metrics.observe(
+            "reorg_depth", len(disconnected_blocks), metrics.DEPTH_BUCKETS
+        )
+        return True
+
+    def reanchor_branches(self, disconnected_blocks):
+        # Branches forking off blocks we just disconnected now fork where
+        # those blocks do, so they start with their share of them
+        disconnected = {
+            block.id: index for index, block in enumerate(disconnected_blocks)
+        }
+        for index, branch in enumerate(self.branches):
+            fork_index = disconnected.get(branch[0].prev_id)
+            if fork_index is not None:
+                self.branches[index] = disconnected_blocks[: fork_index + 1] + branch
+
+    def prune_blocks(self):
+        # Blocks may still be rewound until skipped signatures are verified
+        if self.prune_depth is None or self.unverified:
+            return
+
+        # Swap old blocks for their headers and forget their undo data
+        prune_height = len(self.blocks) - 1 - self.prune_depth
+        for height in range(self.pruned_height + 1, prune_height + 1):
+            block = self.blocks[height]
+            for tx in block.txns:
+                self.undo.pop(tx.id, None)
+            self.blocks[height] = BlockHeader.from_block(block)
+            self.pruned_height = height
 
     def connect_block(self, block):
         # Add the block to our chain
+        self.heights[block.id] = len(self.blocks)
         self.blocks.append(block)
 
         # If they're all good, update UTXO set / mempool
         for tx in block.txns:
             self.connect_tx(tx)
+        self.evict_conflicts(block)
+
+        if block.id == self.assume_valid:
+            self.reach_assume_valid()
+
+    def evict_conflicts(self, block):
+        # Mempool transactions spending what the block spent can never
+        # confirm, and neither can anything spending their outputs
+        spent = {tx_in.outpoint for tx in block.txns[1:] for tx_in in tx.tx_ins}
+        mempool = []
+        for tx in self.mempool:
+            if any(tx_in.outpoint in spent for tx_in in tx.tx_ins):
+                spent.update(tx_out.outpoint for tx_out in tx.tx_outs)
+                self.metrics.incr("mempool_conflicts_evicted")
+            else:
+                mempool.append(tx)
+        self.mempool = mempool
+
+    def skips_signatures(self, height=None):
+        # Without a height, whether we might skip any at all
+        if self.assume_valid is None or self.synced.is_set():
+            return False
+        return height is None or height <= self.assume_valid_height
+
+    def check_assume_valid(self):
+        # Once we pass its height or catch up without the assumed-valid
+        # block, whatever we skipped has to be verified after all
+        if self.assume_valid is None:
+            return True
+        if len(self.blocks) <= self.assume_valid_height and not self.synced.is_set():
+            return True
+        self.assume_valid = None
+        logger.info(
+            "Assumed-valid block not found, verifying %d skipped signatures",
+            self.skipped_signatures,
+        )
+        return self.verify_skipped()
+
+    def verify_skipped(self):
+        # Drop the first block with a bad signature and everything after it
+        unverified, self.unverified = self.unverified, {}
+        connected = sorted(
+            (self.heights[block_id], inputs)
+            for block_id, inputs in unverified.items()
+            if block_id in self.heights
+        )
+        for height, inputs in connected:
+            for tx, index, public_key in inputs:
+                try:
+                    self.verify_input(tx, index, public_key)
+                except:
+                    self.rewind(height - 1)
+                    return False
+        return True
+
+    def rewind(self, height):
+        # Disconnect every block above height for good, unlike a reorg
+        rewound = set()
+        while len(self.blocks) - 1 > height:
+            block = self.blocks.pop()
+            del self.heights[block.id]
+            for tx in reversed(block.txns):
+                self.disconnect_tx(tx)
+                rewound.add(tx.id)
+            self.metrics.incr("blocks_rewound")
+        self.mempool = [tx for tx in self.mempool if tx.id not in rewound]
+        self.mempool_utxo_set()
+        self.publish_view()
+        logger.info("Rewound chain to height %d", height)
+
+    def reach_assume_valid(self):
+        # Estimate what we saved from how long a verification takes
+        histogram = self.metrics.histograms.get("signature_verification_time")
+        if histogram is None and self.unverified:
+            tx, index, public_key = next(iter(self.unverified.values()))[0]
+            self.verify_input(tx, index, public_key)
+            histogram = self.metrics.histograms["signature_verification_time"]
+        seconds = (
+            self.skipped_signatures * histogram.total / histogram.count
+            if histogram
+            else 0
+        )
+
+        # Everything below it leads here, and from here on is verified in full
+        self.assume_valid = None
+        self.unverified = {}
+        logger.info(
+            "Reached assumed-valid block at height %d, "
+            "skipped %d signatures (~%.2fs saved)",
+            len(self.blocks) - 1,
+            self.skipped_signatures,
+            seconds,
+        )
 
     def get_block_subsidy(self):
         halvings = len(self.blocks) // HALVENING_INTERVAL
         return (50 * SATOSHIS_PER_COIN) // (2**halvings)
 
     def calculate_fees(self, txns):
+        # Transactions may spend outputs of the ones before them
+        utxo_set = UTXOView(self.utxo_set)
         fees = 0
         for txn in txns:
             inputs = outputs = 0
             for tx_in in txn.tx_ins:
-                inputs += self.utxo_set[tx_in.outpoint].amount
+                inputs += utxo_set[tx_in.outpoint].amount
             for tx_out in txn.tx_outs:
                 outputs += tx_out.amount
             fees += inputs - outputs
+            self.apply_tx(utxo_set, txn)
         return fees
 
     def get_next_bits(self, block_id, log=False):
         # Find the block
-        height = [block.id for block in self.blocks].index(block_id)
+        height = self.heights[block_id]
         block = self.blocks[height]
 
         # Will we enter a new difficulty period?
@@ -357,11 +1179,13 @@ class Node:
         # Log some information
         if log:
             logger.info(
-                "(difficulty adjustment) "
-                f"period={next_block_period} "
-                f"target={DIFFICULTY_PERIOD_IN_SECS} "
-                f"duration={period_duration} "
-                f"bits={block.bits}->{next_bits} "
+                "(difficulty adjustment)",
+                extra={
+                    "period": next_block_period,
+                    "target": DIFFICULTY_PERIOD_IN_SECS,
+                    "duration": period_duration,
+                    "bits": f"{block.bits}->{next_bits}",
+                },
             )
 
         return next_bits
@@ -0,0 +1,163 @@
+import collections, heapq, itertools, logging, random, re, socket, threading, time
+import utils as u
+
+logger = logging.getLogger(__name__)
+
+PEER_QUEUE_SIZE = 100
+DNS_CACHE_TTL_IN_SECS = 60
+
+# Transactions are dropped before blocks when a peer falls behind
+LOW_PRIORITY_COMMANDS = ["tx"]
+
+
+class PeerQueue:
+    def __init__(self, peer, send, maxsize=PEER_QUEUE_SIZE):
+        self.peer = peer
+        self.send = send
+        self.maxsize = maxsize
+        self.messages = collections.OrderedDict()
+        self.condition = threading.Condition()
+        # Messages held back by simulated latency, by when they're due
+        self.delayed = []
+        self.sequence = itertools.count()
+        self.stats = collections.Counter()
+        self.thread = threading.Thread(
+            target=self.run, name=f"relay-{peer[0]}", daemon=True
+        )
+        self.thread.start()
+
+    def put(self, command, data, key=None, disrupt=False):
+        if key is None:
+            key = (command, id(data))
+        else:
+            key = (command, key)
+
+        with self.condition:
+            # Coalesce with a message that is still waiting to be sent
+            if key in self.messages:
+                self.messages[key] = (command, data, disrupt)
+                self.stats["coalesced"] += 1
+                return
+
+            if len(self.messages) >= self.maxsize:
+                self.drop()
+            self.messages[key] = (command, data, disrupt)
+            self.condition.notify()
+
+    def drop(self):
+        # Evict the oldest low priority message, or the oldest message
+        for key, (command, _, _) in self.messages.items():
+            if command in LOW_PRIORITY_COMMANDS:
+                break
+        else:
+            key = next(iter(self.messages))
+        del self.messages[key]
+        self.stats["dropped"] += 1
+
+    def get(self):
+        # Next queued message, or None once a delayed message is due
+        with self.condition:
+            while not self.messages:
+                timeout = None
+                if self.delayed:
+                    timeout = self.delayed[0][0] - time.monotonic()
+                    if timeout <= 0:
+                        return None
+                self.condition.wait(timeout)
+            _, message = self.messages.popitem(last=False)
+            return message
+
+    def run(self):
+        while True:
+            self.send_due()
+            message = self.get()
+            if message is None:
+                continue
+            command, data, disrupt = message
+
+            if disrupt:
+                # Simulate packet loss
+                if random.randint(0, 10) == 0:
+                    self.stats["lost"] += 1
+                    continue
+                # Simulate network latency, without holding up what's behind
+                due = time.monotonic() + random.random()
+                heapq.heappush(self.delayed, (due, next(self.sequence), command, data))
+                continue
+
+            self.deliver(command, data)
+
+    def send_due(self):
+        now = time.monotonic()
+        while self.delayed and self.delayed[0][0] <= now:
+            _, _, command, data = heapq.heappop(self.delayed)
+            self.deliver(command, data)
+
+    def deliver(self, command, data):
+        try:
+            self.send(self.peer, command, data)
+            self.stats["sent"] += 1
+        except:
+            self.stats["failed"] += 1
+            logger.info(f'Failed to relay "{command}" to {self.peer[0]}')
+
+    def __len__(self):
+        return len(self.messages)
+
+
+class Broadcaster:
+    def __init__(self, send=u.send_message, maxsize=PEER_QUEUE_SIZE):
+        self.send = send
+        self.maxsize = maxsize
+        self.queues = {}
+        self.lock = threading.Lock()
+
+    def queue(self, peer):
+        # One worker thread per peer, started on first use
+        with self.lock:
+            if peer not in self.queues:
+                self.queues[peer] = PeerQueue(peer, self.send, self.maxsize)
+            return self.queues[peer]
+
+    def broadcast(self, peers, command, data, key=None, disrupt=False):
+        for peer in peers:
+            self.queue(peer).put(command, data, key=key, disrupt=disrupt)
+
+    def stats(self):
+        return {peer[0]: dict(queue.stats) for peer, queue in self.queues.items()}
+
+
+class PeerDirectory:
+    def __init__(
+        self, metrics, ttl=DNS_CACHE_TTL_IN_SECS, resolve=socket.gethostbyaddr
+    ):
+        self.metrics = metrics
+        self.ttl = ttl
+        self.resolve = resolve
+        # Canonical addresses peers announced in their handshake, by ip
+        self.addresses = {}
+        self.dns_cache = {}
+
+    def announce(self, ip, address):
+        self.addresses[ip] = tuple(address)
+
+    def lookup(self, ip, port):
+        if ip in self.addresses:
+            self.metrics.incr("peer_lookup_announced")
+            return self.addresses[ip]
+
+        # Peers which never announced themselves fall back to reverse DNS
+        hostname, expires = self.dns_cache.get(ip, (None, 0))
+        if time.time() < expires:
+            self.metrics.incr("peer_lookup_dns_cached")
+            return (hostname, port)
+
+        with self.metrics.timer("peer_dns_resolution_time"):
+            try:
+                hostname = self.resolve(ip)
+                hostname = re.search(r"_(.*?)_", hostname[0]).group(1)
+            except:
+                hostname = ip
+        self.metrics.incr("peer_lookup_dns")
+        self.dns_cache[ip] = (hostname, time.time() + self.ttl)
+        return (hostname, port)
@@ -0,0 +1,188 @@
+import collections, concurrent.futures, logging, multiprocessing, os, queue, threading
+import utils as u
+
+logger = logging.getLogger(__name__)
+
+PIPELINE_QUEUE_SIZE = 20
+SIGNATURE_WORKERS = os.cpu_count() or 1
+
+
+class Results:
+    # Counts how each block of a submission fared, once they're through
+    def __init__(self):
+        self.counts = collections.Counter()
+        self.pending = 0
+        self.condition = threading.Condition()
+
+    def expect(self):
+        with self.condition:
+            self.pending += 1
+
+    def add(self, outcome):
+        with self.condition:
+            self.counts[outcome] += 1
+            self.pending -= 1
+            self.condition.notify_all()
+
+    def wait(self):
+        with self.condition:
+            self.condition.wait_for(lambda: not self.pending)
+            return {
+                "accepted": self.counts["accepted"],
+                "rejected": self.counts["rejected"],
+            }
+
+
+class BlockPipeline:
+    # Blocks flow through three stages linked by bounded queues:
+    # decoded (network) -> checked (PoW, structure, signatures) -> connected
+    def __init__(self, node, lock, on_connected=None, workers=SIGNATURE_WORKERS):
+        self.node = node
+        self.lock = lock
+        self.on_connected = on_connected
+        self.decoded = queue.Queue(PIPELINE_QUEUE_SIZE)
+        self.checked = queue.Queue(PIPELINE_QUEUE_SIZE)
+        # Forking once the node's threads are running can copy a held lock
+        self.executor = concurrent.futures.ProcessPoolExecutor(
+            workers, mp_context=multiprocessing.get_context("forkserver")
+        )
+
+        # Outputs of blocks still in the pipeline, later blocks may spend them.
+        # Both stages use these, so they're behind their own lock
+        self.pending_outputs = {}
+        self.outputs_lock = threading.Lock()
+
+        for target, name in [
+            (self.check_forever, "check"),
+            (self.connect_forever, "connect"),
+        ]:
+            threading.Thread(target=target, name=name, daemon=True).start()
+
+    def submit(self, blocks, results=None):
+        # Blocks when full, so the network can't run too far ahead
+        for block in blocks:
+            if results:
+                results.expect()
+            self.decoded.put((block, results))
+
+    def join(self):
+        self.decoded.join()
+        self.checked.join()
+
+    def add_outputs(self, block):
+        with self.outputs_lock:
+            for tx in block.txns:
+                for tx_out in tx.tx_outs:
+                    self.pending_outputs[tx_out.outpoint] = tx_out
+
+    def drop_outputs(self, block):
+        with self.outputs_lock:
+            for tx in block.txns:
+                for tx_out in tx.tx_outs:
+                    self.pending_outputs.pop(tx_out.outpoint, None)
+
+    def check(self, block):
+        # Returns signature checks still running, as (tx, index, key, future)
+        self.node.check_block(block)
+
+        # Nothing to verify up to the assumed-valid block, the connect stage
+        # verifies whatever turns out to be past its height
+        checks = []
+        if not self.node.skips_signatures():
+            checks = self.verify_signatures(block)
+
+        self.add_outputs(block)
+        return checks
+
+    def verify_signatures(self, block):
+        # Find the public keys of everything spent we know about already
+        jobs = []
+        for tx in block.txns[1:]:
+            for index, tx_in in enumerate(tx.tx_ins):
+                with self.outputs_lock:
+                    tx_out = self.pending_outputs.get(tx_in.outpoint)
+                if tx_out is None:
+                    tx_out = self.node.view.utxo_set.get(tx_in.outpoint)
+                if tx_out is not None:
+                    jobs.append((tx, index, tx_out.public_key))
+
+        # Verify signatures in parallel, the connect stage skips these
+        return [
+            (
+                tx,
+                index,
+                public_key,
+                self.executor.submit(
+                    u.verify_signature,
+                    public_key.to_string(),
+                    tx.tx_ins[index].signature,
+                    u.spend_message(tx, index),
+                ),
+            )
+            for tx, index, public_key in jobs
+        ]
+
+    def reject(self, block, results):
+        self.node.metrics.incr("pipeline_rejected")
+        logger.info("Rejected block")
+        if results:
+            results.add("rejected")
+
+    def finish(self, block, results, checks):
+        try:
+            with self.node.metrics.timer("pipeline_verify_time"):
+                for tx, index, public_key, future in checks:
+                    assert future.result(), "Invalid signature"
+                    self.node.sig_cache.add(tx, index, public_key)
+            self.node.tracer.record(block.id, "validated")
+            self.checked.put((block, results))
+        except:
+            self.drop_outputs(block)
+            self.reject(block, results)
+        self.decoded.task_done()
+
+    def check_forever(self):
+        # Signatures of every block waiting are verified at once, but blocks
+        # still move on in the order they came
+        checking = collections.deque()
+        while True:
+            if checking and (
+                self.decoded.empty() or len(checking) >= PIPELINE_QUEUE_SIZE
+            ):
+                self.finish(*checking.popleft())
+                continue
+
+            block, results = self.decoded.get()
+            try:
+                with self.node.metrics.timer("pipeline_check_time"):
+                    checking.append((block, results, self.check(block)))
+            except:
+                self.reject(block, results)
+                self.decoded.task_done()
+
+    def connect(self, block):
+        with self.lock:
+            self.node.handle_block(block)
+
+    def connect_forever(self):
+        while True:
+            block, results = self.checked.get()
+            connected = False
+            try:
+                with self.node.metrics.timer("pipeline_connect_time"):
+                    self.connect(block)
+                connected = True
+            except:
+                self.reject(block, results)
+            finally:
+                self.drop_outputs(block)
+            if connected and results:
+                results.add("accepted")
+
+            # The block is in, whatever the hook makes of it
+            if connected and self.on_connected:
+                try:
+                    self.on_connected()
+                except:
+                    logger.exception("Block connected hook failed")
+            self.checked.task_done()
@@ -0,0 +1,295 @@
+import collections, copy, logging, random, socketserver, threading, time
+import utils as u
+
+logger = logging.getLogger(__name__)
+
+NONCE_RANGE = 100_000
+
+# How often templates pick up new mempool transactions
+TEMPLATE_REFRESH_IN_SECS = 5
+
+# Shares prove work at a difficulty this many bits below the block's
+SHARE_BITS = 4
+
+# Limits on what a pool keeps around for miners
+MAX_WORKERS = 100
+MAX_TEMPLATES = 10
+MAX_SHARES = 100_000
+
+
+class Work:
+    def __init__(self, version, block, start, end):
+        self.version = version
+        self.block = block
+        self.start = start
+        self.end = end
+        self.hashes = 0
+
+    @property
+    def share_target(self):
+        return self.block.target * 2**SHARE_BITS
+
+    @property
+    def hashes_per_share(self):
+        return max(2 ** (self.block.bits - SHARE_BITS), 1)
+
+    def __repr__(self):
+        return f"Work(version={self.version}, nonces={self.start}-{self.end})"
+
+
+def mine_work(work, stale):
+    # Yields every nonce in range meeting the share target, until work goes stale
+    block = copy.copy(work.block)
+    for nonce in range(work.start, work.end):
+        if stale():
+            return
+        block.nonce = nonce
+        work.hashes += 1
+        if block.proof < work.share_target:
+            yield nonce
+
+
+class WorkPool:
+    # Hands out templates with disjoint nonce ranges to miners in and out of process
+    def __init__(
+        self,
+        node,
+        lock,
+        prepare_template,
+        nonce_range=NONCE_RANGE,
+        refresh_interval=TEMPLATE_REFRESH_IN_SECS,
+    ):
+        self.node = node
+        self.lock = lock
+        self.prepare_template = prepare_template
+        self.nonce_range = nonce_range
+        self.refresh_interval = refresh_interval
+        self.version = 0
+        self.templates = {}
+        self.next_nonce = 0
+        self.workers = []
+        self.mutex = threading.Lock()
+
+        # Nonces handed out and shares accepted, per template version
+        self.nonce_ranges = {}
+        self.shares = {}
+        self.refresh()
+
+    def refresh(self):
+        try:
+            with self.lock:
+                template = self.prepare_template()
+        except:
+            # Miners keep the template they have, there's nothing before the first
+            if not self.templates:
+                raise
+            self.node.metrics.incr("pool_template_errors")
+            logger.exception("Failed to prepare a block template")
+            return
+        with self.mutex:
+            # Older templates on the same tip can still be submitted
+            self.version += 1
+            versions = [
+                version
+                for version, block in self.templates.items()
+                if block.prev_id == template.prev_id
+            ]
+            self.templates = {
+                version: self.templates[version]
+                for version in versions[-(MAX_TEMPLATES - 1) :]
+            }
+            self.templates[self.version] = template
+            self.next_nonce = random.randint(0, 1000000000)
+            self.nonce_ranges = {
+                version: self.nonce_ranges.get(
+                    version, (self.next_nonce, self.next_nonce)
+                )
+                for version in self.templates
+            }
+            self.shares = {
+                version: self.shares.get(version, set()) for version in self.templates
+            }
+
+        # Replace whatever work each worker still has queued
+        for worker in self.workers:
+            queue = self.node.broadcaster.queue(worker)
+            queue.put("work", self.getwork(), key="work")
+
+    def update(self, mempool=False):
+        # Only a new tip makes work stale, new transactions are optional
+        template = self.templates[self.version]
+        with self.lock:
+            tip_changed = template.prev_id != self.node.blocks[-1].id
+            mempool_changed = [tx.id for tx in self.node.mempool] != [
+                tx.id for tx in template.txns[1:]
+            ]
+
+        if tip_changed:
+            self.node.metrics.incr("pool_tip_refreshes")
+            self.refresh()
+            stats = self.stats()
+            logger.info(
+                "Wasted %d of %d hashes (%d stale shares)",
+                stats["wasted_hashes"],
+                stats["hashes"],
+                stats["stale_shares"],
+            )
+        elif mempool and mempool_changed:
+            self.node.metrics.incr("pool_mempool_refreshes")
+            self.refresh()
+
+    def try_update(self, mempool=False):
+        # Mining and serving miners carry on with the old template
+        try:
+            self.update(mempool)
+        except:
+            logger.exception("Failed to refresh block templates")
+
+    def refresh_forever(self):
+        while True:
+            time.sleep(self.refresh_interval)
+            self.try_update(mempool=True)
+
+    def stats(self):
+        counters = self.node.metrics.counters
+        return {
+            "hashes": counters["pool_hashes"],
+            "wasted_hashes": counters["pool_wasted_hashes"],
+            "stale_shares": counters["pool_stale_shares"],
+            "duplicate_shares": counters["pool_duplicate_shares"],
+            "invalid_blocks": counters["pool_invalid_blocks"],
+            "tip_refreshes": counters["pool_tip_refreshes"],
+            "mempool_refreshes": counters["pool_mempool_refreshes"],
+        }
+
+    def register(self, worker):
+        if worker in self.workers:
+            return
+        if len(self.workers) >= MAX_WORKERS:
+            self.node.metrics.incr("pool_workers_refused")
+            logger.info("Refused worker %s:%s, pool is full", *worker)
+            return
+        self.workers.append(worker)
+        logger.info("Registered worker %s:%s", *worker)
+
+    def getwork(self):
+        with self.mutex:
+            start = self.next_nonce
+            self.next_nonce += self.nonce_range
+            self.nonce_ranges[self.version] = (
+                self.nonce_ranges[self.version][0],
+                self.next_nonce,
+            )
+            template = self.templates[self.version]
+            return Work(self.version, template, start, start + self.nonce_range)
+
+    def is_stale(self, work):
+        return work.version not in self.templates
+
+    def is_current(self, work):
+        return work.version == self.version
+
+    def submit(self, version, nonce):
+        # Each share stands for the hashes it took to find on average
+        with self.mutex:
+            template = self.templates.get(version)
+            nonce_range = self.nonce_ranges.get(version)
+            shares = self.shares.get(version)
+        if template is None:
+            # Close enough, difficulty rarely changes between templates
+            current = Work(version, self.templates[self.version], nonce, nonce + 1)
+            self.node.metrics.incr("pool_stale_shares")
+            self.node.metrics.incr("pool_wasted_hashes", current.hashes_per_share)
+            return "stale"
+
+        # Only nonces we handed out count, and each of them only once
+        start, end = nonce_range
+        if not start <= nonce < end:
+            self.node.metrics.incr("pool_invalid_shares")
+            return "invalid"
+        with self.mutex:
+            duplicate = nonce in shares
+            full = len(shares) >= MAX_SHARES
+            if not duplicate and not full:
+                shares.add(nonce)
+        if duplicate:
+            self.node.metrics.incr("pool_duplicate_shares")
+            return "duplicate"
+        if full:
+            # Move miners to a fresh template rather than remember more shares
+            self.node.metrics.incr("pool_stale_shares")
+            if version == self.version:
+                self.refresh()
+            return "stale"
+
+        work = Work(version, template, nonce, nonce + 1)
+        block = copy.copy(template)
+        block.nonce = nonce
+        if block.proof >= work.share_target:
+            self.node.metrics.incr("pool_invalid_shares")
+            return "invalid"
+
+        self.node.metrics.incr("pool_shares")
+        self.node.metrics.incr("pool_hashes", work.hashes_per_share)
+        if block.proof >= block.target:
+            return "share"
+
+        logger.info("")
+        logger.info("Mined a block")
+        self.node.tracer.start(block.id)
+        self.node.recorder.record("mined", [block])
+        try:
+            with self.lock:
+                self.node.handle_block(block)
+        except:
+            # Someone else submitted the same block first, or it's invalid
+            with self.lock:
+                known = self.node.find_block(block.id)
+            if known:
+                self.node.metrics.incr("pool_stale_shares")
+                return "stale"
+            self.node.metrics.incr("pool_invalid_blocks")
+            logger.info("Mined an invalid block")
+            return "invalid"
+        self.try_update()
+        return "block"
+
+
+class Worker:
+    # Mines a node's templates from another process
+    def __init__(self, node_address, port):
+        self.node_address = node_address
+        self.port = port
+        self.work = None
+        self.stats = collections.Counter()
+
+    def request(self, command, data):
+        return u.send_message(self.node_address, command, data, response=True)["data"]
+
+    def serve(self):
+        worker = self
+
+        class Handler(socketserver.BaseRequestHandler):
+            def handle(self):
+                message = u.read_message(self.request)
+                if message["command"] == "work":
+                    worker.work = message["data"]
+
+        server = socketserver.TCPServer(("0.0.0.0", self.port), Handler)
+        threading.Thread(
+            target=server.serve_forever, name="server", daemon=True
+        ).start()
+
+    def run(self):
+        self.serve()
+        self.work = self.request("register-worker", self.port)
+        while True:
+            work = self.work
+            for nonce in mine_work(work, lambda: self.work is not work):
+                result = self.request("submit", (work.version, nonce))
+                self.stats[result] += 1
+                logger.info("Submitted share: %s %s", result, dict(self.stats))
+
+            # Ran out of nonces without hearing of a new template
+            if self.work is work:
+                self.work = self.request("getwork", None)
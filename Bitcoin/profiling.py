@@ -0,0 +1,156 @@
+import collections, os, sys, threading, time, tracemalloc
+
+# How often the profiler looks at every thread's stack
+SAMPLE_INTERVAL_IN_SECS = 0.005
+
+# Windows close by themselves after this long, in case nobody stops them
+WINDOW_IN_SECS = 30
+
+# Entries per thread (or allocation sites) written to a report
+REPORT_ENTRIES = 25
+
+# Frames tracemalloc keeps per allocation
+TRACE_FRAMES = 5
+
+
+def describe(frame):
+    code = frame.f_code
+    return (
+        f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+    )
+
+
+class Profiler:
+    # Samples the stacks of all running threads. cProfile only sees the thread
+    # which enabled it, and threads started before that are never traced.
+    def __init__(self, interval=SAMPLE_INTERVAL_IN_SECS):
+        self.interval = interval
+        self.samples = collections.Counter()
+        self.own = collections.Counter()
+        self.total = collections.Counter()
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, name="profiler", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+
+    def run(self):
+        ident = threading.get_ident()
+        while not self.stopped.wait(self.interval):
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for thread, frame in sys._current_frames().items():
+                if thread != ident:
+                    self.sample(names.get(thread, str(thread)), frame)
+
+    def sample(self, name, frame):
+        self.samples[name] += 1
+        self.own[name, describe(frame)] += 1
+
+        # Recursive functions only count once per sample
+        functions = set()
+        while frame is not None:
+            functions.add(describe(frame))
+            frame = frame.f_back
+        for function in functions:
+            self.total[name, function] += 1
+
+    def report(self):
+        lines = []
+        for name, samples in sorted(self.samples.items()):
+            lines += ["", f"Thread {name}: {samples} samples", "  own%  total%"]
+            functions = [
+                (count, function)
+                for (thread, function), count in self.total.items()
+                if thread == name
+            ]
+            for count, function in sorted(functions, reverse=True)[:REPORT_ENTRIES]:
+                own = 100 * self.own[name, function] / samples
+                lines.append(f"{own:>6.1f} {100 * count / samples:>7.1f}  {function}")
+        return "\n".join(lines[1:]) + "\n"
+
+
+class MemoryTracer:
+    # Reports where memory grew while tracing. Allocations don't record the
+    # thread making them, so these are broken down by line instead.
+    def start(self):
+        tracemalloc.start(TRACE_FRAMES)
+        self.baseline = tracemalloc.take_snapshot()
+
+    def stop(self):
+        self.snapshot = tracemalloc.take_snapshot()
+        self.current, self.peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+    def report(self):
+        lines = [f"Traced {self.current} bytes (peak {self.peak} bytes)", ""]
+        growth = self.snapshot.compare_to(self.baseline, "lineno")
+        lines += [str(stat) for stat in growth[:REPORT_ENTRIES]]
+        return "\n".join(lines) + "\n"
+
+
+class Window:
+    # Runs a profiler or tracer until stopped, or for at most `seconds`
+    def __init__(self, session, path, seconds):
+        self.session = session
+        self.path = path
+        self.timer = threading.Timer(seconds, self.close)
+        self.timer.name = "window"
+        self.timer.daemon = True
+        self.closed = False
+        self.mutex = threading.Lock()
+
+    def open(self):
+        self.session.start()
+        self.timer.start()
+
+    def close(self):
+        with self.mutex:
+            if self.closed:
+                return self.path
+            self.closed = True
+            self.timer.cancel()
+            self.session.stop()
+            with open(self.path, "w") as f:
+                f.write(self.session.report())
+        return self.path
+
+
+class Hooks:
+    # Lets a running node switch profiling and memory tracing on and off
+    SESSIONS = {"profile": Profiler, "memtrace": MemoryTracer}
+
+    def __init__(self, name, directory="."):
+        self.name = name
+        self.directory = directory
+        self.windows = {}
+        self.mutex = threading.Lock()
+
+    def start(self, kind, seconds=WINDOW_IN_SECS):
+        with self.mutex:
+            window = self.windows.get(kind)
+            if window and not window.closed:
+                return f"{kind} already running, will write {window.path}"
+            stamp = time.strftime("%Y%m%d-%H%M%S")
+            path = os.path.join(self.directory, f"{kind}-{self.name}-{stamp}.txt")
+            window = Window(self.SESSIONS[kind](), path, seconds)
+            window.open()
+            self.windows[kind] = window
+        return f"{kind} running for {seconds}s, will write {path}"
+
+    def stop(self, kind):
+        with self.mutex:
+            window = self.windows.pop(kind, None)
+        if window is None:
+            return f"{kind} not running"
+        return f"Wrote {window.close()}"
+
+    def handle(self, kind, data):
+        action, seconds = data
+        if action == "start":
+            return self.start(kind, seconds)
+        return self.stop(kind)
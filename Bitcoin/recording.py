@@ -0,0 +1,94 @@
+import collections, threading, time
+import utils as u
+
+# Commands replay feeds to the node, everything else is networking
+REPLAYED_COMMANDS = [
+    "blocks",
+    "sync-response",
+    "mined",
+    "compact-block",
+    "block-txns",
+    "tx",
+]
+
+
+class Recorder:
+    # Appends every inbound message, and blocks we mined ourselves, with the
+    # time they arrived. Does nothing without a path.
+    def __init__(self, path=None, clock=time.time):
+        self.file = open(path, "ab") if path else None
+        self.clock = clock
+        self.mutex = threading.Lock()
+
+    def record(self, command, data):
+        if self.file is None:
+            return
+        with self.mutex:
+            u.write_items(self.file, [(self.clock(), command, data)])
+            self.file.flush()
+
+
+def feed_block(node, block, stats):
+    try:
+        node.handle_block(block)
+        stats["blocks"] += 1
+        stats["txns"] += len(block.txns)
+    except:
+        stats["rejected_blocks"] += 1
+
+
+def feed(node, command, data, stats):
+    # What the node's handlers do with each message, minus the network
+    if command in ["blocks", "sync-response", "mined"]:
+        for block in data:
+            feed_block(node, block, stats)
+    elif command == "compact-block":
+        if node.find_block(data.block_id):
+            return
+        block, _ = node.reconstruct_block(data)
+        if block:
+            feed_block(node, block, stats)
+    elif command == "block-txns":
+        block_id, txns = data
+        feed_block(node, node.fill_block(block_id, txns), stats)
+    elif command == "tx":
+        try:
+            node.handle_tx(data)
+            stats["mempool_txns"] += 1
+        except:
+            stats["rejected_txns"] += 1
+
+
+def replay(node, messages, realtime=False):
+    # As fast as possible, or spaced out like the messages originally arrived
+    stats = collections.Counter()
+    seconds = 0
+    started = first = None
+    for at, command, data in messages:
+        if command not in REPLAYED_COMMANDS:
+            continue
+        stats["messages"] += 1
+
+        if realtime:
+            if first is None:
+                started, first = time.perf_counter(), at
+            delay = (at - first) - (time.perf_counter() - started)
+            if delay > 0:
+                time.sleep(delay)
+
+        # Only time spent in the node counts towards throughput
+        start = time.perf_counter()
+        try:
+            feed(node, command, data, stats)
+        except:
+            stats["failed_messages"] += 1
+        seconds += time.perf_counter() - start
+
+    txns = stats["txns"] + stats["mempool_txns"]
+    return dict(
+        stats,
+        height=len(node.blocks) - 1,
+        seconds=seconds,
+        blocks_per_sec=stats["blocks"] / seconds if seconds else 0,
+        txns_per_sec=txns / seconds if seconds else 0,
+    )
@@ -0,0 +1,385 @@
+"""
+Bitcoin network simulator
+
+Usage:
+  simulator.py [options]
+
+Options:
+  -h --help              Show this screen.
+  --nodes=<n>            Number of nodes [default: 5]
+  --peers=<n>            Peers each node connects to [default: 2]
+  --blocks=<n>           Stop after this many blocks are mined [default: 50]
+  --seed=<seed>          Seed for every random choice [default: 0]
+  --latency=<secs>       Mean one-way latency [default: 0.1]
+  --loss=<rate>          Fraction of messages dropped [default: 0.01]
+  --bandwidth=<bytes>    Link bandwidth in bytes per second [default: 1000000]
+  --tx-rate=<rate>       Transactions per second [default: 5]
+  --simulated-pow        Skip hashing, blocks are only valid in test mode
+  --hash-rate=<rate>     Total hashes per second [default: 64]
+"""
+
+import heapq, logging, math, random, uuid
+import bitcoin as b
+import models as m
+import utils as u
+from docopt import docopt
+from ecdsa import SigningKey, SECP256k1
+
+# Low enough that blocks are found with a handful of real hashes
+GENESIS_BITS = 6
+GENESIS_TIMESTAMP = 1698667908.5560372
+
+WALLETS = 10
+FEE = 100
+
+
+class Clock:
+    # Virtual time, only moves when the simulator runs the next event
+    def __init__(self, now=GENESIS_TIMESTAMP):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+
+class SimulatedBroadcaster:
+    def __init__(self, network, sender):
+        self.network = network
+        self.sender = sender
+
+    def broadcast(self, peers, command, data, key=None, disrupt=False):
+        for peer in peers:
+            self.network.send(self.sender, peer, command, data)
+
+    def stats(self):
+        return {}
+
+
+class SimulatedNode(m.Node):
+    def __init__(self, address, network, simulated_pow=False):
+        super().__init__(address, clock=network.clock, simulated_pow=simulated_pow)
+        self.network = network
+        self.broadcaster = SimulatedBroadcaster(network, address)
+        self.private_key = SigningKey.from_secret_exponent(
+            len(network.nodes) + 1000, curve=SECP256k1
+        )
+        # When each block first made it onto our chain or a branch
+        self.seen = {}
+
+    def send(self, peer, command, data):
+        self.network.send(self.address, peer, command, data)
+
+    def handle_block(self, block):
+        super().handle_block(block)
+        if not self.is_orphan(block.id):
+            self.seen.setdefault(block.id, self.clock())
+
+
+class Network:
+    def __init__(self, seed=0, latency=0.1, loss=0.01, bandwidth=1_000_000):
+        self.random = random.Random(seed)
+        self.clock = Clock()
+        self.latency = latency
+        self.loss = loss
+        self.bandwidth = bandwidth
+        self.events = []
+        self.sequence = 0
+        self.nodes = {}
+        # When each link finishes sending what's already queued on it
+        self.link_busy_until = {}
+        self.stats = {"sent": 0, "lost": 0, "bytes": 0}
+
+    def schedule(self, delay, callback):
+        self.sequence += 1
+        heapq.heappush(self.events, (self.clock.now + delay, self.sequence, callback))
+
+    def run_next(self):
+        self.clock.now, _, callback = heapq.heappop(self.events)
+        callback()
+
+    def send(self, sender, peer, command, data):
+        self.stats["sent"] += 1
+        if self.random.random() < self.loss:
+            self.stats["lost"] += 1
+            return
+
+        # Queue behind earlier messages on the link, then cross it
+        serialized = u.serialize(data)
+        self.stats["bytes"] += len(serialized)
+        link = (sender, peer)
+        start = max(self.clock.now, self.link_busy_until.get(link, 0))
+        self.link_busy_until[link] = start + len(serialized) / self.bandwidth
+        latency = self.random.expovariate(1 / self.latency)
+        delay = self.link_busy_until[link] + latency - self.clock.now
+
+        node = self.nodes[peer]
+        message = lambda: self.deliver(node, sender, command, u.deserialize(serialized))
+        self.schedule(delay, message)
+
+    def handle_block(self, node, block):
+        try:
+            node.handle_block(block)
+        except:
+            node.metrics.incr("simulator_rejected")
+
+    def deliver(self, node, peer, command, data):
+        # What TCPHandler.handle does for relay, minus the handshake
+        try:
+            if command == "compact-block":
+                if node.find_block(data.block_id):
+                    return
+                try:
+                    block, missing = node.reconstruct_block(data)
+                except:
+                    return node.send(peer, "get-block", data.block_id)
+                if block:
+                    self.handle_block(node, block)
+                else:
+                    node.send(peer, "get-block-txns", (data.block_id, missing))
+            elif command == "get-block-txns":
+                block_id, indexes = data
+                txns = node.fetch_block_txns(block_id, indexes)
+                node.send(peer, "block-txns", (block_id, txns))
+            elif command == "block-txns":
+                block_id, txns = data
+                try:
+                    block = node.fill_block(block_id, txns)
+                except:
+                    return node.send(peer, "get-block", block_id)
+                self.handle_block(node, block)
+            elif command == "get-block":
+                block = node.find_block(data)
+                if block:
+                    node.send(peer, "blocks", [block])
+            elif command in ("blocks", "sync-response"):
+                for block in data:
+                    self.handle_block(node, block)
+            elif command == "sync":
+                blocks = node.view.find_sync_blocks(data)
+                if blocks:
+                    node.send(peer, "sync-response", blocks)
+            elif command == "tx":
+                node.handle_tx(data)
+        except:
+            node.metrics.incr("simulator_rejected")
+
+
+class Simulation:
+    def __init__(
+        self,
+        nodes=5,
+        peers=2,
+        seed=0,
+        latency=0.1,
+        loss=0.01,
+        bandwidth=1_000_000,
+        tx_rate=5,
+        simulated_pow=False,
+        hash_rate=2**GENESIS_BITS / b.BLOCK_TIME_IN_SECS,
+    ):
+        self.network = Network(seed, latency, loss, bandwidth)
+        self.random = self.network.random
+        self.clock = self.network.clock
+        self.tx_rate = tx_rate
+        self.simulated_pow = simulated_pow
+
+        for index in range(nodes):
+            address = (f"node{index}", index)
+            node = SimulatedNode(address, self.network, simulated_pow)
+            self.network.nodes[address] = node
+        self.nodes = list(self.network.nodes.values())
+
+        # Random peering, every node reaching at least a few others
+        for node in self.nodes:
+            others = [other for other in self.nodes if other is not node]
+            for other in self.random.sample(others, min(peers, len(others))):
+                if other.address not in node.peers:
+                    node.peers.append(other.address)
+                    other.peers.append(node.address)
+
+        # Each node mines an equal share of the hash rate
+        self.hash_rate = hash_rate / nodes
+        self.mining = {}
+
+        # Wallets which spend genesis and everything after it back and forth
+        self.wallets = [
+            SigningKey.from_secret_exponent(index + 100, curve=SECP256k1)
+            for index in range(WALLETS)
+        ]
+        genesis = self.prepare_genesis_block()
+        for node in self.nodes:
+            b.connect_genesis_block(node, genesis)
+        self.coins = [(genesis.txns[0].tx_outs[0], self.wallets[0])]
+
+        self.mined = {}
+        self.txns_sent = 0
+        self.running = False
+
+    def make_id(self):
+        return uuid.UUID(int=self.random.getrandbits(128))
+
+    def prepare_genesis_block(self):
+        public_key = self.wallets[0].get_verifying_key()
+        subsidy = self.nodes[0].get_block_subsidy()
+        coinbase = b.prepare_coinbase(public_key, subsidy, self.make_id())
+        block = m.Block(
+            txns=[coinbase],
+            prev_id=None,
+            nonce=0,
+            bits=GENESIS_BITS,
+            timestamp=self.clock.now,
+        )
+        if not self.simulated_pow:
+            return b.mine_block(block)
+
+        # Start at the difficulty our hash rate settles on, rather than
+        # racing through thousands of forks to get there
+        hash_rate = self.hash_rate * len(self.nodes)
+        block.bits = max(round(math.log2(hash_rate * b.BLOCK_TIME_IN_SECS)), 1)
+        block.nonce = m.SIMULATED_NONCE
+        return block
+
+    def schedule_mining(self, node):
+        # Finding a block is memoryless, so starting over on a new tip is fair
+        bits = node.get_next_bits(node.blocks[-1].id)
+        delay = self.random.expovariate(self.hash_rate / 2**bits)
+        tip = node.blocks[-1].id
+        self.mining[node.address] = tip
+        self.network.schedule(delay, lambda: self.mine(node, tip))
+
+    def mine(self, node, tip):
+        if not self.running or self.mining[node.address] != tip:
+            return
+        public_key = node.private_key.get_verifying_key()
+        fees = node.calculate_fees(node.mempool)
+        coinbase = b.prepare_coinbase(
+            public_key, node.get_block_subsidy() + fees, self.make_id()
+        )
+        block = m.Block(
+            txns=[coinbase] + node.mempool,
+            prev_id=tip,
+            nonce=0,
+            bits=node.get_next_bits(tip),
+            timestamp=self.clock.now,
+        )
+        if self.simulated_pow:
+            # The find time above already stands in for the hashing
+            block.nonce = m.SIMULATED_NONCE
+        else:
+            block = b.mine_block(block)
+        self.mined[block.id] = self.clock.now
+        self.network.handle_block(node, block)
+
+    def send_tx(self):
+        if not self.running:
+            return
+
+        # Split a random coin between the sender and someone else
+        index = self.random.randrange(len(self.coins))
+        tx_out, private_key = self.coins[index]
+        if tx_out.amount > 2 * FEE:
+            self.coins.pop(index)
+            recipient = self.random.choice(self.wallets)
+            amount = (tx_out.amount - FEE) // 2
+            tx = b.prepare_simple_tx(
+                [tx_out],
+                private_key,
+                recipient.get_verifying_key(),
+                amount,
+                FEE,
+                self.make_id(),
+            )
+            self.coins += [(tx.tx_outs[0], recipient), (tx.tx_outs[1], private_key)]
+            self.txns_sent += 1
+
+            node = self.random.choice(self.nodes)
+            try:
+                node.handle_tx(tx)
+            except:
+                node.metrics.incr("simulator_rejected")
+
+        self.network.schedule(self.random.expovariate(self.tx_rate), self.send_tx)
+
+    def run(self, blocks=50):
+        started = self.clock.now
+        self.running = True
+        tips = {}
+        for node in self.nodes:
+            self.schedule_mining(node)
+            tips[node.address] = node.blocks[-1].id
+        if self.tx_rate:
+            self.network.schedule(0, self.send_tx)
+
+        while len(self.mined) < blocks:
+            self.network.run_next()
+
+            # Miners only start over when their tip moves
+            for node in self.nodes:
+                if node.blocks[-1].id != tips[node.address]:
+                    tips[node.address] = node.blocks[-1].id
+                    self.schedule_mining(node)
+        seconds = self.clock.now - started
+
+        # Stop mining and sending, then let relay settle before measuring
+        self.running = False
+        while self.network.events:
+            self.network.run_next()
+        return self.report(seconds)
+
+    def report(self, seconds):
+        # How long each mined block took to reach every other node
+        delays = [
+            node.seen[block_id] - mined
+            for block_id, mined in self.mined.items()
+            for node in self.nodes
+            if block_id in node.seen and node.seen[block_id] > mined
+        ]
+        node = max(self.nodes, key=lambda node: u.total_work(node.blocks))
+        chain = node.blocks
+        in_chain = {block.id for block in chain}
+        txns = sum(len(block.txns) - 1 for block in chain)
+
+        # Mined blocks which didn't make it into the best chain
+        orphaned = len(
+            [block_id for block_id in self.mined if block_id not in in_chain]
+        )
+
+        return {
+            "seconds": seconds,
+            "blocks": len(self.mined),
+            "height": len(chain) - 1,
+            "propagation_p50": u.percentile(delays, 0.5),
+            "propagation_p90": u.percentile(delays, 0.9),
+            "propagation_p99": u.percentile(delays, 0.99),
+            "orphan_rate": orphaned / len(self.mined) if self.mined else 0,
+            "block_time": seconds / len(self.mined) if self.mined else 0,
+            "bits": chain[-1].bits,
+            "subsidy": node.get_block_subsidy(),
+            "txns_sent": self.txns_sent,
+            "txns_per_sec": txns / seconds if seconds else 0,
+            "converged": len({node.blocks[-1].id for node in self.nodes}) == 1,
+            "network": dict(self.network.stats),
+        }
+
+
+def main(args):
+    logging.disable(logging.INFO)
+    simulation = Simulation(
+        nodes=int(args["--nodes"]),
+        peers=int(args["--peers"]),
+        seed=int(args["--seed"]),
+        latency=float(args["--latency"]),
+        loss=float(args["--loss"]),
+        bandwidth=float(args["--bandwidth"]),
+        tx_rate=float(args["--tx-rate"]),
+        simulated_pow=args["--simulated-pow"],
+        hash_rate=float(args["--hash-rate"]),
+    )
+    for name, value in simulation.run(int(args["--blocks"])).items():
+        if isinstance(value, float):
+            value = f"{value:.4f}"
+        print(f"{name:<18} {value}")
+
+
+if __name__ == "__main__":
+    main(docopt(__doc__))
@@ -0,0 +1,166 @@
+"""
+Block propagation timelines, merged from the trace logs of every node
+
+Usage:
+  tracing.py <log>... [--blocks <n>] [--hops <n>]
+
+Options:
+  -h --help       Show this screen.
+  --blocks=<n>    Timelines of the most recent blocks to show [default: 5]
+  --hops=<n>      Slowest hops to show [default: 10]
+"""
+
+import collections, json, threading, time
+import utils as u
+from docopt import docopt
+
+# Stages a block goes through on each node, in order
+STAGES = ["mined", "received", "decoded", "validated", "connected", "relayed"]
+
+# Blocks we hold trace metadata for, until they are relayed
+MAX_TRACES = 1000
+
+
+class TraceLog:
+    # Blocks carry trace metadata from the node which mined them. Every node
+    # on the way appends a JSON line per stage, if it was given a log path.
+    def __init__(self, name=None, path=None, clock=time.time):
+        self.name = name
+        self.file = open(path, "a") if path else None
+        self.clock = clock
+        self.traces = collections.OrderedDict()
+        self.mutex = threading.Lock()
+
+    def start(self, block_id):
+        self.receive(block_id, {"origin": self.name, "sender": None, "hops": 0})
+        self.record(block_id, "mined")
+
+    def receive(self, block_id, trace):
+        # Untraced blocks are relayed without metadata, and never logged.
+        # The first peer to send a block is the hop we measure.
+        if trace is None or block_id in self.traces:
+            return
+        with self.mutex:
+            self.traces[block_id] = trace
+            if len(self.traces) > MAX_TRACES:
+                self.traces.popitem(last=False)
+
+    def record(self, block_id, stage, **fields):
+        trace = self.traces.get(block_id)
+        if trace is None or self.file is None:
+            return
+        entry = dict(
+            trace, node=self.name, block=block_id, stage=stage, time=self.clock()
+        )
+        entry.update(fields)
+        with self.mutex:
+            self.file.write(json.dumps(entry) + "\n")
+            self.file.flush()
+
+    def relay(self, block_id, peers):
+        # Metadata for the next hop
+        trace = self.traces.get(block_id)
+        if trace is None:
+            return None
+        self.record(block_id, "relayed", peers=len(peers))
+        with self.mutex:
+            self.traces.pop(block_id, None)
+        return dict(trace, sender=self.name, hops=trace["hops"] + 1)
+
+
+def read_logs(paths):
+    entries = []
+    for path in paths:
+        with open(path) as f:
+            entries += [json.loads(line) for line in f if line.strip()]
+    return entries
+
+
+def timelines(entries):
+    # block id -> node -> stage -> first time it happened
+    blocks = collections.defaultdict(lambda: collections.defaultdict(dict))
+    hops = {}
+    for entry in sorted(entries, key=lambda entry: entry["time"]):
+        stages = blocks[entry["block"]][entry["node"]]
+        stages.setdefault(entry["stage"], entry["time"])
+        hops.setdefault(
+            (entry["block"], entry["node"]), (entry["sender"], entry["hops"])
+        )
+    return blocks, hops
+
+
+def started(nodes):
+    # When the first node saw the block, which is when it was mined if we
+    # have the miner's log
+    return min(min(stages.values()) for stages in nodes.values())
+
+
+def analyze(entries):
+    blocks, hops = timelines(entries)
+
+    # Time since the block was mined, by stage, over every node
+    since_mined = collections.defaultdict(list)
+    slow_hops = []
+    for block_id, nodes in blocks.items():
+        mined = [stages["mined"] for stages in nodes.values() if "mined" in stages]
+        if not mined:
+            continue
+        for node, stages in nodes.items():
+            for stage, at in stages.items():
+                since_mined[stage].append(at - mined[0])
+
+            # From when the sender relayed it until we had it
+            sender, _ = hops[block_id, node]
+            relayed = nodes.get(sender, {}).get("relayed")
+            if relayed is not None and "received" in stages:
+                slow_hops.append((stages["received"] - relayed, sender, node, block_id))
+
+    percentiles = {
+        stage: {
+            "count": len(since_mined[stage]),
+            "p50": u.percentile(since_mined[stage], 0.5),
+            "p90": u.percentile(since_mined[stage], 0.9),
+            "p99": u.percentile(since_mined[stage], 0.99),
+        }
+        for stage in STAGES
+        if since_mined[stage]
+    }
+    return blocks, hops, percentiles, sorted(slow_hops, reverse=True)
+
+
+def print_timeline(block_id, nodes, hops):
+    mined = started(nodes)
+    print(f"Block {block_id[:16]}...")
+    print(f"  {'node':<10} {'hops':>4} " + " ".join(f"{s:>9}" for s in STAGES))
+    for node, stages in sorted(nodes.items(), key=lambda item: min(item[1].values())):
+        times = [
+            f"{stages[stage] - mined:>9.3f}" if stage in stages else f"{'-':>9}"
+            for stage in STAGES
+        ]
+        print(f"  {node:<10} {hops[block_id, node][1]:>4} " + " ".join(times))
+    print()
+
+
+def main(args):
+    blocks, hops, percentiles, slow_hops = analyze(read_logs(args["<log>"]))
+
+    recent = sorted(blocks, key=lambda block_id: started(blocks[block_id]))
+    for block_id in recent[-int(args["--blocks"]) :]:
+        print_timeline(block_id, blocks[block_id], hops)
+
+    print("Seconds since mined")
+    for stage, summary in percentiles.items():
+        print(
+            f"  {stage:<10} {summary['count']:>6} "
+            f"p50 {summary['p50']:.3f}  p90 {summary['p90']:.3f}  "
+            f"p99 {summary['p99']:.3f}"
+        )
+
+    print()
+    print("Slowest hops")
+    for seconds, sender, node, block_id in slow_hops[: int(args["--hops"])]:
+        print(f"  {sender:>10} -> {node:<10} {seconds:.3f}s  {block_id[:16]}...")
+
+
+if __name__ == "__main__":
+    main(docopt(__doc__))
@@ -1,8 +1,10 @@
-import pickle, socket, random, threading
+import pickle, socket, hashlib
+from ecdsa import VerifyingKey, BadSignatureError, SECP256k1
 
 
 def serialize(coin):
-    return pickle.dumps(coin)
+    # Pinned so block ids agree across Python versions
+    return pickle.dumps(coin, protocol=4)
 
 
 def deserialize(serialized):
@@ -14,6 +16,20 @@ def spend_message(tx, index):
     return serialize(outpoint) + serialize(tx.tx_outs)
 
 
+def short_id(tx_id):
+    # 6 byte transaction ids for compact block relay
+    return hashlib.sha256(str(tx_id).encode()).digest()[:6]
+
+
+def verify_signature(public_key, signature, message):
+    # Takes the key as bytes so it can run in another process
+    public_key = VerifyingKey.from_string(public_key, curve=SECP256k1)
+    try:
+        return public_key.verify(signature, message)
+    except BadSignatureError:
+        return False
+
+
 def prepare_message(command, data):
     message = {
         "command": command,
@@ -47,19 +63,36 @@ def send_message(address, command, data, response=False):
             return read_message(s)
 
 
-def total_work(blocks):
-    return sum([2**block.bits for block in blocks])
+def write_items(f, items):
+    # Files use the same length prefix as our messages
+    for item in items:
+        serialized_item = serialize(item)
+        f.write(len(serialized_item).to_bytes(4, "big") + serialized_item)
+
 
+def read_items(f):
+    # Yields one item at a time, so files never sit in memory whole
+    while True:
+        raw_length = f.read(4)
+        if not raw_length:
+            return
+        yield deserialize(f.read(int.from_bytes(raw_length, "big")))
 
-def tx_in_to_tx_out(tx_in, blocks):
-    for block in blocks:
-        for tx in block.txns:
-            if tx.id == tx_in.tx_id:
-                return tx.tx_outs[tx_in.index]
+
+def write_blocks(f, blocks):
+    write_items(f, blocks)
+
+
+def read_blocks(f):
+    return read_items(f)
+
+
+def total_work(blocks):
+    return sum([2**block.bits for block in blocks])
 
 
-def disrupt(func, args):
-    # Simulate packet loss
-    if random.randint(0, 10) != 0:
-        # Simulate network latency
-        threading.Timer(random.random(), func, args).start()
+def percentile(values, fraction):
+    if not values:
+        return 0
+    values = sorted(values)
+    return values[min(int(fraction * len(values)), len(values) - 1)]
@@ -0,0 +1,92 @@
+import argparse, json, logging, time
+
+# Slower than the baseline per operation by more than this fraction is a regression
+THRESHOLD = 0.1
+
+# Timings keep the best of this many runs, which shaves off most of the noise
+REPEAT = 3
+
+
+def measure(run, setup=None, repeat=REPEAT):
+    # Setup runs before every attempt and isn't timed, run gets what it returns
+    best = float("inf")
+    for _ in range(repeat):
+        state = setup() if setup else None
+        start = time.perf_counter()
+        if setup:
+            run(state)
+        else:
+            run()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def result(name, seconds, count=1, unit="ops"):
+    return {"name": name, "seconds": seconds, "count": count, "unit": unit}
+
+
+def per_op(result):
+    return result["seconds"] / result["count"]
+
+
+def print_result(result):
+    rate = ""
+    if result["count"] > 1:
+        rate = f"{result['count'] / result['seconds']:>14,.0f} {result['unit']}/s"
+    print(f"{result['name']:<24} {result['seconds']:>9.4f}s {rate}")
+
+
+def compare(baseline, results, threshold=THRESHOLD):
+    # Compares time per operation, in case counts changed between versions
+    regressions = []
+    print()
+    print(f"{'':<24} {'baseline':>10} {'current':>10} {'change':>8}")
+    for result in results:
+        before = baseline.get(result["name"])
+        if before is None:
+            continue
+        change = per_op(result) / per_op(before) - 1
+        flag = ""
+        if change > threshold:
+            regressions.append(result["name"])
+            flag = "REGRESSION"
+        print(
+            f"{result['name']:<24} {before['seconds']:>9.4f}s "
+            f"{result['seconds']:>9.4f}s {change:>+8.1%} {flag}"
+        )
+    return regressions
+
+
+def main(benchmarks, argv=None):
+    parser = argparse.ArgumentParser()
+    parser.add_argument("names", nargs="*", help=", ".join(benchmarks))
+    parser.add_argument("--save", metavar="FILE", help="write results as JSON")
+    parser.add_argument(
+        "--compare", metavar="FILE", help="flag regressions against saved results"
+    )
+    parser.add_argument("--threshold", type=float, default=THRESHOLD)
+    args = parser.parse_args(argv)
+
+    logging.disable(logging.INFO)
+    results = []
+    for name in args.names or benchmarks:
+        # Benchmarks report one result, or one per size they cover
+        outcome = benchmarks[name]()
+        for result in outcome if isinstance(outcome, list) else [outcome]:
+            result.setdefault("count", 1)
+            result.setdefault("unit", "ops")
+            print_result(result)
+            results.append(result)
+
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump({result["name"]: result for result in results}, f, indent=2)
+
+    # A non-zero exit status fails CI
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare(json.load(f), results, args.threshold)
+        if regressions:
+            print(f"\n{len(regressions)} regressions over {args.threshold:.0%}")
+            return 1
+    return 0
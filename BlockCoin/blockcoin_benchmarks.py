@@ -0,0 +1,115 @@
+import sys
+import benchmarks as bench
+import identities as ids
+import utils as u
+from blockcoin import airdrop_tx, prepare_simple_tx
+from models import Bank, Block, TxOut
+
+UTXO_SET_SIZES = {"10k": 10_000, "100k": 100_000, "1m": 1_000_000}
+
+###########
+# Helpers #
+###########
+
+
+def make_bank():
+    # Never its turn, so handling blocks doesn't schedule any of its own
+    bank = Bank(id=99, private_key=ids.bank_private_key(99))
+    bank.airdrop(airdrop_tx())
+    return bank
+
+
+def spend(bank, name):
+    # Our biggest coin, straight back to ourselves
+    public_key = ids.user_public_key(name)
+    utxos = sorted(bank.fetch_utxos(public_key), key=lambda tx_out: tx_out.amount)
+    return prepare_simple_tx(
+        utxos[-1:], ids.user_private_key(name), public_key, utxos[-1].amount
+    )
+
+
+def extend(bank, length):
+    # Blocks of one transaction each, signed by whichever bank's turn it is
+    blocks = []
+    for _ in range(length):
+        block = Block(txns=[spend(bank, "alice")])
+        block.sign(ids.bank_private_key(bank.next_id))
+        bank.handle_block(block)
+        blocks.append(block)
+    return blocks
+
+
+##############
+# Benchmarks #
+##############
+
+
+def bench_validate_tx(count=100):
+    bank = make_bank()
+    tx = spend(bank, "alice")
+    seconds = bench.measure(lambda: [bank.validate_tx(tx) for _ in range(count)])
+    return bench.result("validate-tx", seconds, count, "txns")
+
+
+def bench_handle_block(length=20):
+    blocks = extend(make_bank(), length)
+
+    def run(bank):
+        for block in blocks:
+            bank.handle_block(block)
+
+    seconds = bench.measure(run, setup=make_bank)
+    return bench.result("handle-block", seconds, length, "blocks")
+
+
+def bench_fetch_balance():
+    results = []
+    for label, size in UTXO_SET_SIZES.items():
+        bank = make_bank()
+        public_keys = [ids.alice_public_key, ids.bob_public_key]
+        for index in range(size):
+            tx_out = TxOut(index, 0, 1, public_keys[index % 2])
+            bank.utxo_set[tx_out.outpoint] = tx_out
+
+        seconds = bench.measure(lambda: bank.fetch_balance(ids.alice_public_key))
+        results.append(bench.result(f"fetch-balance-{label}", seconds, size, "utxos"))
+    return results
+
+
+def bench_spend_message(count=10_000):
+    tx = spend(make_bank(), "alice")
+    seconds = bench.measure(lambda: [u.spend_message(tx, 0) for _ in range(count)])
+    return bench.result("spend-message", seconds, count, "messages")
+
+
+def bench_serialize(count=100, length=20):
+    bank = make_bank()
+    extend(bank, length)
+    blocks = bank.blocks
+    serialized = [u.serialize(block) for block in blocks]
+
+    serialize = bench.measure(
+        lambda: [u.serialize(block) for _ in range(count) for block in blocks]
+    )
+    deserialize = bench.measure(
+        lambda: [u.deserialize(data) for _ in range(count) for data in serialized]
+    )
+    count *= len(blocks)
+    return [
+        bench.result("serialize", serialize, count, "blocks"),
+        bench.result("deserialize", deserialize, count, "blocks"),
+    ]
+
+
+# Banks take turns signing blocks, there is nothing to mine or reorg
+BENCHMARKS = {
+    "validate-tx": bench_validate_tx,
+    "handle-block": bench_handle_block,
+    "fetch-balance": bench_fetch_balance,
+    "spend-message": bench_spend_message,
+    "serialize": bench_serialize,
+}
+
+
+if __name__ == "__main__":
+    sys.exit(bench.main(BENCHMARKS))
@@ -0,0 +1,48 @@
+from copy import deepcopy
+import types
+import pytest
+import powcoin as p
+import models as m
+import identities as ids
+
+# Chains several tests start from, mined once per session. Every test gets
+# its own deep copy, so tests are free to change them.
+
+
+def mine_block(node, miner_public_key, prev_block):
+    coinbase = p.prepare_coinbase(miner_public_key)
+    unmined_block = m.Block(txns=[coinbase], prev_id=prev_block.id, nonce=0)
+    mined_block = p.mine_block(unmined_block)
+    node.handle_block(mined_block)
+    return mined_block
+
+
+@pytest.fixture(scope="session")
+def mined_bob_chain():
+    # Bob mines height=0,1,2
+    node = m.Node(address="")
+    p.mine_genesis_block(node, ids.bob_public_key)
+    mine_block(node, ids.bob_public_key, node.blocks[0])
+    mine_block(node, ids.bob_public_key, node.blocks[1])
+    return node
+
+
+@pytest.fixture
+def bob_chain(mined_bob_chain):
+    return deepcopy(mined_bob_chain)
+
+
+@pytest.fixture(scope="session")
+def mined_shared_chain():
+    # Bob mines height=0,1 and alice accepts both
+    node = m.Node(address="")
+    alice_node = m.Node(address="")
+    p.mine_genesis_block(node, ids.bob_public_key)
+    p.mine_genesis_block(alice_node, ids.bob_public_key)
+    alice_node.handle_block(mine_block(node, ids.bob_public_key, node.blocks[0]))
+    return types.SimpleNamespace(node=node, alice_node=alice_node)
+
+
+@pytest.fixture
+def shared_chain(mined_shared_chain):
+    return deepcopy(mined_shared_chain)
@@ -6,15 +6,19 @@ Usage:
   powcoin.py ping [--node <node>]
   powcoin.py tx <from> <to> <amount> [--node <node>]
   powcoin.py balance <name> [--node <node>]
+  powcoin.py profile (start|stop) [--seconds <seconds>] [--node <node>]
+  powcoin.py memtrace (start|stop) [--seconds <seconds>] [--node <node>]
 
 Options:
-  -h --help      Show this screen.
-  --node=<node>  Hostname of node [default: node0]
+  -h --help            Show this screen.
+  --node=<node>        Hostname of node [default: node0]
+  --seconds=<seconds>  Stop profiling or tracing after this long [default: 30]
 """
 
 import uuid, socketserver, socket, time, os, logging, threading, random, re
 import utils as u
 import models as m
+import profiling
 
 from docopt import docopt
 from ecdsa import SigningKey, SECP256k1
@@ -24,6 +28,7 @@ PORT = 10000
 GET_BLOCKS_CHUNK = 10
 BLOCK_SUBSIDY = 50
 node = None
+hooks = None
 lock = threading.Lock()
 
 logging.basicConfig(level="INFO", format="%(threadName)-6s | %(message)s")
@@ -215,6 +220,10 @@ class TCPHandler(socketserver.BaseRequestHandler):
             utxos = node.fetch_utxos(data)
             self.respond(command="utxos-response", data=utxos)
 
+        # Profile or trace memory for a window, then dump to a file
+        if command in ["profile", "memtrace"]:
+            self.respond(command=f"{command}-response", data=hooks.handle(command, data))
+
 
 def external_address(node):
     i = int(node[-1])
@@ -250,8 +259,9 @@ def main(args):
         duration = 10 * ["node0", "node1", "node2"].index(name)
         time.sleep(duration)
 
-        global node
+        global node, hooks
         node = m.Node(address=(name, PORT))
+        hooks = profiling.Hooks(name)
 
         # Alice is Satoshi!
         mine_genesis_block(node, lookup_public_key("alice"))
@@ -289,6 +299,12 @@ def main(args):
         address = external_address(args["--node"])
         response = u.send_message(address, "balance", public_key, response=True)
         print(response["data"])
+    elif args["profile"] or args["memtrace"]:
+        command = "profile" if args["profile"] else "memtrace"
+        action = "start" if args["start"] else "stop"
+        data = (action, float(args["--seconds"]))
+        address = external_address(args["--node"])
+        print(u.send_message(address, command, data, response=True)["data"])
     elif args["tx"]:
         # Grab parameters
         sender_private_key = lookup_private_key(args["<from>"])
@@ -0,0 +1,159 @@
+import sys
+import benchmarks as bench
+import identities as ids
+import models as m
+import powcoin as p
+import utils as u
+
+UTXO_SET_SIZES = {"10k": 10_000, "100k": 100_000, "1m": 1_000_000}
+
+###########
+# Helpers #
+###########
+
+
+def make_node():
+    node = m.Node(address="")
+    p.mine_genesis_block(node, ids.alice_public_key)
+    return node
+
+
+def spend(node, private_key):
+    # Our biggest coin, straight back to ourselves
+    public_key = private_key.get_verifying_key()
+    utxos = sorted(node.fetch_utxos(public_key), key=lambda tx_out: tx_out.amount)
+    return p.prepare_simple_tx(utxos[-1:], private_key, public_key, utxos[-1].amount)
+
+
+def next_block(node, private_key):
+    public_key = private_key.get_verifying_key()
+    txns = [spend(node, private_key)] if node.fetch_utxos(public_key) else []
+    block = m.Block(
+        txns=[p.prepare_coinbase(public_key)] + txns,
+        prev_id=node.blocks[-1].id,
+        nonce=0,
+    )
+    return p.mine_block(block)
+
+
+def extend(node, private_key, length):
+    blocks = []
+    for _ in range(length):
+        blocks.append(next_block(node, private_key))
+        node.handle_block(blocks[-1])
+    return blocks
+
+
+##############
+# Benchmarks #
+##############
+
+
+def bench_validate_tx(count=100):
+    node = make_node()
+    tx = spend(node, ids.alice_private_key)
+    seconds = bench.measure(lambda: [node.validate_tx(tx) for _ in range(count)])
+    return bench.result("validate-tx", seconds, count, "txns")
+
+
+def bench_handle_block(length=20):
+    blocks = extend(make_node(), ids.alice_private_key, length)
+
+    def run(node):
+        for block in blocks:
+            node.handle_block(block)
+
+    seconds = bench.measure(run, setup=make_node)
+    return bench.result("handle-block", seconds, length, "blocks")
+
+
+def bench_fetch_balance():
+    results = []
+    for label, size in UTXO_SET_SIZES.items():
+        node = m.Node(address="")
+        public_keys = [ids.alice_public_key, ids.bob_public_key]
+        for index in range(size):
+            tx_out = m.TxOut(index, 0, 1, public_keys[index % 2])
+            node.utxo_set[tx_out.outpoint] = tx_out
+
+        seconds = bench.measure(lambda: node.fetch_balance(ids.alice_public_key))
+        results.append(bench.result(f"fetch-balance-{label}", seconds, size, "utxos"))
+    return results
+
+
+def bench_spend_message(count=10_000):
+    tx = spend(make_node(), ids.alice_private_key)
+    seconds = bench.measure(lambda: [u.spend_message(tx, 0) for _ in range(count)])
+    return bench.result("spend-message", seconds, count, "messages")
+
+
+def bench_serialize(count=100, length=20):
+    node = make_node()
+    extend(node, ids.alice_private_key, length)
+    blocks = node.blocks
+    serialized = [u.serialize(block) for block in blocks]
+
+    serialize = bench.measure(
+        lambda: [u.serialize(block) for _ in range(count) for block in blocks]
+    )
+    deserialize = bench.measure(
+        lambda: [u.deserialize(data) for _ in range(count) for data in serialized]
+    )
+    count *= len(blocks)
+    return [
+        bench.result("serialize", serialize, count, "blocks"),
+        bench.result("deserialize", deserialize, count, "blocks"),
+    ]
+
+
+def bench_mine_block(hashes=5_000):
+    node = make_node()
+    block = m.Block(
+        txns=[p.prepare_coinbase(ids.alice_public_key)],
+        prev_id=node.blocks[-1].id,
+        nonce=0,
+    )
+
+    def run():
+        # Keep finding the next valid nonce, every nonce tried is a hash
+        block.nonce = 0
+        while block.nonce < hashes:
+            p.mine_block(block)
+            block.nonce += 1
+
+    seconds = bench.measure(run)
+    return bench.result("mine-block", seconds, hashes, "hashes")
+
+
+def bench_reorg(depth=10):
+    # Both chains grow side by side, the branch pulls ahead on its last block
+    node, other = make_node(), make_node()
+    for block in extend(node, ids.alice_private_key, 2):
+        other.handle_block(block)
+    extend(node, ids.alice_private_key, depth)
+    branch = extend(other, ids.bob_private_key, depth + 1)
+    chain = node.blocks[1:]
+
+    def setup():
+        node = make_node()
+        for block in chain + branch[:-1]:
+            node.handle_block(block)
+        return node
+
+    seconds = bench.measure(lambda node: node.handle_block(branch[-1]), setup)
+    return bench.result(f"reorg-{depth}", seconds)
+
+
+BENCHMARKS = {
+    "validate-tx": bench_validate_tx,
+    "handle-block": bench_handle_block,
+    "fetch-balance": bench_fetch_balance,
+    "spend-message": bench_spend_message,
+    "serialize": bench_serialize,
+    "mine-block": bench_mine_block,
+    "reorg": bench_reorg,
+}
+
+
+if __name__ == "__main__":
+    sys.exit(bench.main(BENCHMARKS))
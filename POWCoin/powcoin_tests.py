@@ -3,6 +3,7 @@ import pytest
 import powcoin as p
 import models as m
 import identities as ids
+import profiling
 
 ###########
 # Helpers #
@@ -101,13 +102,8 @@ def test_fork_chain():
     assert node.branches[0] == [alice_block]
 
 
-def test_block_extending_fork():
-    node = m.Node(address="")
-
-    # Bob mines height=0,1,2
-    p.mine_genesis_block(node, ids.bob_public_key)
-    mine_block(node, ids.bob_public_key, node.blocks[0], [])
-    mine_block(node, ids.bob_public_key, node.blocks[1], [])
+def test_block_extending_fork(bob_chain):
+    node = bob_chain
 
     # Alice mines height=1
     mine_block(node, ids.alice_public_key, node.blocks[0], [])
@@ -124,13 +120,8 @@ def test_block_extending_fork():
     assert len(node.branches[0]) == 2
 
 
-def test_block_forking_fork():
-    node = m.Node(address="")
-
-    # Bob mines height=0,1,2
-    p.mine_genesis_block(node, ids.bob_public_key)
-    mine_block(node, ids.bob_public_key, node.blocks[0], [])
-    mine_block(node, ids.bob_public_key, node.blocks[1], [])
+def test_block_forking_fork(bob_chain):
+    node = bob_chain
 
     # Alice mines height=1
     first = mine_block(node, ids.alice_public_key, node.blocks[0], [])
@@ -152,22 +143,15 @@ def test_block_forking_fork():
     assert node.branches[1] == [first, third]
 
 
-def test_successful_reorg():
-    node = m.Node(address="")
-    alice_node = m.Node(address="")
+def test_successful_reorg(shared_chain):
+    # Alice accepts bob's first two blocks, but not the third
+    node, alice_node = shared_chain.node, shared_chain.alice_node
+    b0, b1 = node.blocks
 
-    # Bob mines height=0,1,2
-    b0 = p.mine_genesis_block(node, ids.bob_public_key)
-    b1 = mine_block(node, ids.bob_public_key, node.blocks[0], [])
-    # height=2 contains a bob->alice txn
+    # Bob mines height=2, which contains a bob->alice txn
     bob_to_alice = send_tx(node, ids.bob_private_key, ids.alice_public_key, 10)
     b2 = mine_block(node, ids.bob_public_key, node.blocks[1], [bob_to_alice])
 
-    # Alice accepts bob's first two blocks, but not the third
-    p.mine_genesis_block(alice_node, ids.bob_public_key)  # FIXME confusing
-    alice_node.handle_block(b1)
-
-    # FIXME just borrow everything up until this point from another test
     # Create and handle two blocks atop Alice's chain
     a2 = mine_block(alice_node, ids.alice_public_key, node.blocks[1], [])
     node.handle_block(a2)
@@ -208,20 +192,13 @@ def test_successful_reorg():
     assert bob_to_alice in node.mempool
 
 
-def test_unsuccessful_reorg():
-    node = m.Node(address="")
-    alice_node = m.Node(address="")
+def test_unsuccessful_reorg(shared_chain):
+    # Alice accepts bob's first two blocks, but not the third
+    node, alice_node = shared_chain.node, shared_chain.alice_node
 
-    # Bob mines height=0,1,2
-    p.mine_genesis_block(node, ids.bob_public_key)
-    b1 = mine_block(node, ids.bob_public_key, node.blocks[0], [])
+    # Bob mines height=2
     mine_block(node, ids.bob_public_key, node.blocks[1], [])
 
-    # Alice accepts bob's first two blocks, but not the third
-    p.mine_genesis_block(alice_node, ids.bob_public_key)  # FIXME confusing
-    alice_node.handle_block(b1)
-
-    # FIXME just borrow everything up until this point from another test
     # Create one valid block for Alice
     a2 = mine_block(alice_node, ids.alice_public_key, node.blocks[1], [])
     node.handle_block(a2)
@@ -244,3 +221,14 @@ def test_unsuccessful_reorg():
     assert str(node.utxo_set.keys()) == str(initial_utxo_set.keys())  # FIXME
     assert node.blocks == initial_chain
     assert node.branches == initial_branches
+
+
+def test_memtrace(tmp_path):
+    hooks = profiling.Hooks("node0", directory=str(tmp_path))
+    hooks.start("memtrace", 10)
+    blocks = [bytearray(1000) for _ in range(100)]
+    path = hooks.stop("memtrace").split()[-1]
+
+    report = open(path).read()
+    assert "powcoin_tests.py" in report
+    assert hooks.stop("memtrace") == "memtrace not running"